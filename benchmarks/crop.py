@@ -0,0 +1,141 @@
+"""
+compares the crop/pad decision of squaring.determine_image_crop with the previous, full resolution implementation:
+time per thumbnail and whether both decide the same. runs on a generated corpus of youtube-like thumbnails,
+or on a folder of real ones (--corpus).
+
+uv run python -m benchmarks.crop [--corpus folder]
+"""
+import random
+import time
+from io import BytesIO
+from pathlib import Path
+from statistics import mean, stdev
+
+import click
+from PIL import Image, ImageDraw, ImageFilter
+
+from shiradl import squaring
+from shiradl.squaring import AVG_THRESHOLD, CHANNEL_THRESHOLD, determine_image_crop, sample_image_corners
+
+SIZES = [(1280, 720), (640, 480), (480, 360)] # maxresdefault, sddefault, hqdefault
+
+
+def determine_image_crop_reference(image_bytes: bytes):
+	"""determine_image_crop before it worked on a reduced copy, kept as the reference. also returns the average deviation"""
+	pil_img = Image.open(BytesIO(image_bytes))
+	filt_image = pil_img.filter(ImageFilter.SMOOTH).convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
+	rgb_filt_image = filt_image.convert("RGB")
+
+	width, height = rgb_filt_image.size
+	sample_colors50 = sample_image_corners(rgb_filt_image, width, height, 50)
+	sample_colors0 = sample_image_corners(rgb_filt_image, width, height, 1)
+
+	reds, greens, blues = [], [], []
+	for r,g,b in sample_colors50:
+		reds.append(r)
+		greens.append(g)
+		blues.append(b)
+
+	dev_red = stdev(reds)
+	dev_green = stdev(greens)
+	dev_blue = stdev(blues)
+	avg_dev = mean([dev_red, dev_green, dev_blue])
+	fill_recc = sample_colors0[0] if len(set(sample_colors0)) == 1 else None
+
+	if avg_dev < AVG_THRESHOLD and dev_red < CHANNEL_THRESHOLD and dev_green < CHANNEL_THRESHOLD and dev_blue < CHANNEL_THRESHOLD:
+		return "crop", fill_recc, avg_dev
+	else:
+		return "pad", fill_recc, avg_dev
+
+
+def random_color(rng: random.Random):
+	return tuple(rng.randrange(256) for _ in range(3))
+
+
+def make_artwork(rng: random.Random, size: tuple[int, int]):
+	"""square-ish 'album art': noise, blobs and shapes"""
+	art = Image.effect_noise(size, rng.randrange(20, 90)).convert("RGB")
+	art = Image.blend(art, Image.new("RGB", size, random_color(rng)), 0.6)
+	draw = ImageDraw.Draw(art)
+	for _ in range(rng.randrange(3, 12)):
+		x, y = rng.randrange(size[0]), rng.randrange(size[1])
+		r = rng.randrange(10, max(11, size[0] // 3))
+		draw.ellipse((x - r, y - r, x + r, y + r), fill=random_color(rng))
+	return art
+
+
+def make_thumbnail(rng: random.Random):
+	"""a youtube-like thumbnail, with the artwork on solid bars, on a blurred copy of itself, or filling the frame"""
+	width, height = rng.choice(SIZES)
+	kind = rng.choice(["bars", "bars", "blurred", "full", "gradient"])
+	if kind == "full":
+		img = make_artwork(rng, (width, height))
+	elif kind == "gradient":
+		img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+		img = Image.blend(img, Image.new("RGB", (width, height), random_color(rng)), rng.random())
+		img.paste(make_artwork(rng, (height, height)), ((width - height) // 2, 0))
+	else:
+		art = make_artwork(rng, (height, height))
+		if kind == "bars":
+			img = Image.new("RGB", (width, height), random_color(rng))
+		else:
+			img = art.resize((width, width)).crop((0, (width - height) // 2, width, (width + height) // 2)).filter(ImageFilter.GaussianBlur(rng.randrange(10, 60)))
+		inset = rng.choice([0, 0, 0, rng.randrange(10, 80)]) # some artworks are narrower than the frame, bars of 10-80px
+		img.paste(art.resize((height - 2 * inset, height - 2 * inset)), ((width - height) // 2 + inset, inset))
+	out = BytesIO()
+	img.save(out, "JPEG", quality=rng.randrange(70, 96))
+	return out.getvalue()
+
+
+def load_corpus(corpus: Path | None, count: int, seed: int):
+	if corpus is not None:
+		files = sorted(p for p in corpus.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))
+		return [(p.name, p.read_bytes()) for p in files]
+	rng = random.Random(seed)
+	return [(f"generated-{i:03d}", make_thumbnail(rng)) for i in range(count)]
+
+
+@click.command()
+@click.option("--corpus", type=click.Path(exists=True, file_okay=False, path_type=Path), default=None, help="Folder of thumbnails, instead of generated ones.")
+@click.option("--count", type=int, default=200, help="How many thumbnails to generate.")
+@click.option("--seed", type=int, default=0)
+@click.option("--min-agreement", type=click.FloatRange(0, 1), default=0.98, help="Fail if fewer decisions agree.")
+def main(corpus: Path | None, count: int, seed: int, min_agreement: float):
+	thumbnails = load_corpus(corpus, count, seed)
+	old_time, new_time, cached_time = 0.0, 0.0, 0.0
+	disagree, fill_differs, crops = [], 0, 0
+	for name, image_bytes in thumbnails:
+		t0 = time.perf_counter()
+		old = determine_image_crop_reference(image_bytes)
+		t1 = time.perf_counter()
+		# get_1x1_cover decodes the thumbnail anyway to crop/pad it, the reference decoded it a second time
+		pil_img = Image.open(BytesIO(image_bytes))
+		pil_img.load()
+		t2 = time.perf_counter()
+		new = determine_image_crop(image_bytes, pil_img)
+		t3 = time.perf_counter()
+		determine_image_crop(image_bytes, pil_img)
+		cached_time += time.perf_counter() - t3
+		old_time += t1 - t0
+		new_time += t3 - t2
+		crops += old[0] == "crop"
+		if old[0] != new[0]:
+			disagree.append((name, old[0], new[0], old[2]))
+		elif (old[1] is None) != (new[1] is None):
+			fill_differs += 1
+	squaring.crop_decisions.clear()
+
+	n = len(thumbnails)
+	print(f"{n} thumbnails, {crops} decided 'crop' by the reference")
+	print(f"reference   {old_time / n * 1000:8.2f}ms per thumbnail")
+	print(f"reduced     {new_time / n * 1000:8.2f}ms per thumbnail ({old_time / new_time:.1f}x)")
+	print(f"cached      {cached_time / n * 1000:8.3f}ms per thumbnail")
+	print(f"agreement   {(n - len(disagree)) / n * 100:.1f}% ({len(disagree)} differ, fill color found by only one: {fill_differs})")
+	for name, old, new, avg_dev in disagree:
+		print(f"  {name}: reference {old}, reduced {new} (reference deviation {avg_dev:.1f}, threshold {AVG_THRESHOLD})")
+	if (n - len(disagree)) / n < min_agreement:
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	main()
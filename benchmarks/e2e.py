@@ -0,0 +1,191 @@
+"""
+end to end throughput of `shiradl --no-download` and `mbtag` against local stand-ins (see standin.py) instead of YouTube Music,
+MusicBrainz and the cover hosts: synthetic playlists / libraries of every size are run cold (empty caches), each in its own process,
+and tracks per second, requests per host (and how many were rate limited) and the peak RSS of the process are reported.
+
+yt-dlp can't be pointed at another host, so playlists are fetched from the stand-in as already extracted info (see install_stand_ins).
+everything else, ytmusicapi included, makes its requests as usual, they're only sent to the stand-in.
+pass --output to keep the results as JSON, e.g. one file per commit.
+
+uv run python -m benchmarks.e2e [--sizes 10,1000,10000] [--tool shiradl --tool mbtag] [--latency 20] [--output e2e.json]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, redirect_stdout
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+from tests.flac_harness import write_flac
+
+from .standin import Catalog, StandInAdapter, StandInRateLimitedAdapter, StandInServer
+
+try:
+	import resource
+except ImportError: # windows
+	resource = None
+
+ROOT = Path(__file__).parent.parent
+TOOLS = ("shiradl", "mbtag")
+
+
+def get_peak_rss():
+	""":returns the peak resident set size of this process in MiB, None where it can't be read"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return round(peak / (1024 ** 2 if sys.platform == "darwin" else 1024), 1) # bytes on macos, KiB elsewhere
+
+
+def install_stand_ins(stack: ExitStack, base: str, mb_rate: float, state_dir: Path):
+	"""sends the requests of this process to the stand-in server at base"""
+	import requests
+
+	from shiradl import dl, musicbrainz
+	from shiradl.session import POOL_MAXSIZE, session
+
+	adapter = StandInAdapter(base, pool_maxsize=POOL_MAXSIZE)
+	session.mount("https://", adapter)
+	client = musicbrainz.MBClient(rate=mb_rate, state_path=state_dir / "musicbrainz.ratelimit")
+	session.mount("https://musicbrainz.org/", StandInRateLimitedAdapter(base, limiter=client.limiter, pool_maxsize=POOL_MAXSIZE))
+	stack.enter_context(mock.patch.object(musicbrainz, "_mb_client", client))
+
+	real_ytmusic = dl.YTMusic
+	def stand_in_ytmusic(*args, **kwargs):
+		ytmusic = real_ytmusic(*args, **kwargs)
+		ytmusic._session.mount("https://", StandInAdapter(base, pool_maxsize=POOL_MAXSIZE))
+		return ytmusic
+	stack.enter_context(mock.patch.object(dl, "YTMusic", stand_in_ytmusic))
+
+	playlists = requests.Session()
+	playlists.mount("https://", StandInAdapter(base))
+	def extract_playlist(self, url):
+		list_id = parse_qs(urlparse(url).query)["list"][0]
+		res = playlists.get("https://www.youtube.com/playlist", params={ "list": list_id })
+		res.raise_for_status()
+		return res.json()
+	stack.enter_context(mock.patch.object(dl.Dl, "get_ydl_extract_info", extract_playlist))
+
+
+def run_worker(params: dict):
+	"""one measurement, in its own process. writes { "seconds", "peak_rss_mib", "errors" } to params["result"]"""
+	work = Path(params["work"])
+	errors = None
+	with ExitStack() as stack, open(os.devnull, "w") as devnull:
+		install_stand_ins(stack, params["base"], params["mb_rate"], work)
+		if params["tool"] == "shiradl":
+			from shiradl.cli import cli
+			args = [
+				f"https://music.youtube.com/playlist?list=PLe2e{params['size']}", "--no-download", "--no-config-file", "--no-archive",
+				"-f", str(work / "out"), "-t", str(work / "temp"), "--ffmpeg-location", params["ffmpeg"],
+				"--jobs", str(params["jobs"]), "--log-level", "ERROR", "--report", str(work / "report.json"),
+			]
+			start = time.perf_counter()
+			cli.main(args, "shiradl", standalone_mode=False)
+			seconds = time.perf_counter() - start
+			errors = json.loads((work / "report.json").read_text(encoding="utf8"))["errors"]
+		else:
+			from shiradl.mbtag import mbtag_cli
+			start = time.perf_counter()
+			with redirect_stdout(devnull): # a line or two per song
+				mbtag_cli.main([str(work / "library"), "--jobs", str(params["jobs"])], "mbtag", standalone_mode=False)
+			seconds = time.perf_counter() - start
+	result = { "seconds": round(seconds, 3), "peak_rss_mib": get_peak_rss(), "errors": errors }
+	Path(params["result"]).write_text(json.dumps(result), encoding="utf8")
+
+
+def create_library(library: Path, catalog: Catalog, size: int):
+	"""flacs with the title, artist, album and track number of the first size tracks, a folder per album"""
+	for i in range(size):
+		track = catalog.track(i)
+		folder = library / track["artist"] / track["album"]
+		write_flac(folder / f"{track['position']:02d} {track['title']}.flac", title=track["title"], artist=track["artist"], album=track["album"], track=track["position"])
+
+
+def count_done(tool: str, work: Path):
+	""":returns how many tracks came out: files shiradl wrote, files mbtag wrote MusicBrainz ids to"""
+	if tool == "shiradl":
+		return sum(1 for _ in (work / "out").rglob("*.m4a"))
+	from mediafile import MediaFile
+	return sum(1 for path in (work / "library").rglob("*.flac") if MediaFile(path).mb_releasetrackid)
+
+
+def measure(server: StandInServer, tool: str, size: int, jobs: int, mb_rate: float, ffmpeg: str):
+	with tempfile.TemporaryDirectory(prefix="shiradl-e2e-") as tmp:
+		work = Path(tmp)
+		if tool == "mbtag":
+			create_library(work / "library", server.catalog, size)
+		params = { "tool": tool, "size": size, "jobs": jobs, "mb_rate": mb_rate, "ffmpeg": ffmpeg, "base": server.base, "work": tmp, "result": str(work / "result.json") }
+		server.reset()
+		env = { **os.environ, "XDG_CACHE_HOME": str(work / "cache") } # http cache, match cache, cover store etc. start empty
+		subprocess.run([sys.executable, "-m", "benchmarks.e2e", "--worker", json.dumps(params)], cwd=ROOT, env=env, check=True)
+		result = json.loads((work / "result.json").read_text(encoding="utf8"))
+		counts = server.counts()
+		done = count_done(tool, work)
+	return {
+		"tool": tool,
+		"tracks": size,
+		"done": done,
+		**result,
+		"tracks_per_second": round(size / result["seconds"], 2) if result["seconds"] > 0 else None,
+		"requests": sum(counts["requests"].values()),
+		"requests_per_host": counts["requests"],
+		"throttled": counts["throttled"],
+	}
+
+
+def get_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+@click.command()
+@click.option("--sizes", type=str, default="10,1000,10000", help="Tracks per run, separated by commas.")
+@click.option("--tool", "tools", type=click.Choice(TOOLS), multiple=True, default=TOOLS, help="What to run, shiradl --no-download and/or mbtag.")
+@click.option("--jobs", "-j", type=click.IntRange(1, 64), default=4, help="--jobs of both tools.")
+@click.option("--album-size", type=click.IntRange(1), default=10, help="Tracks per album of the synthetic catalog.")
+@click.option("--latency", type=float, default=20, help="Milliseconds every stand-in response is delayed by.")
+@click.option("--mb-limit", type=float, default=50, help="Requests per second the MusicBrainz stand-in answers before it sends 503s, 0 for no limit.")
+@click.option("--mb-rate", type=float, default=40, help="Requests per second the MusicBrainz client is limited to (1 against the real one).")
+@click.option("--ffmpeg-location", type=str, default="ffmpeg", help="FFmpeg shiradl writes its stub files with.")
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path), default=None, help="Also write the results to this JSON file.")
+@click.option("--worker", type=str, default=None, hidden=True)
+def main(sizes: str, tools: tuple[str, ...], jobs: int, album_size: int, latency: float, mb_limit: float, mb_rate: float, ffmpeg_location: str, output: Path | None, worker: str | None):
+	if worker is not None:
+		run_worker(json.loads(worker))
+		return
+	try:
+		size_list = [int(size) for size in sizes.split(",")]
+	except ValueError:
+		raise click.BadParameter(f"'{sizes}', expected numbers separated by commas", param_hint="--sizes") from None
+	server = StandInServer(Catalog(album_size), latency / 1000, { "musicbrainz.org": mb_limit }).start()
+	results = []
+	try:
+		for tool in tools:
+			for size in size_list:
+				result = measure(server, tool, size, jobs, mb_rate, ffmpeg_location)
+				results.append(result)
+				hosts = ", ".join(f"{host} {count}" for host, count in result["requests_per_host"].items())
+				throttled = sum(result["throttled"].values())
+				print(
+					f"{tool:8} {size:6} tracks {result['seconds']:9.2f}s {result['tracks_per_second']:8.1f} tracks/s"
+					f" {result['peak_rss_mib'] or 0:7.1f} MiB peak, {result['done']} done, {result['requests']} requests ({hosts}), {throttled} rate limited"
+				)
+	finally:
+		server.shutdown()
+		server.server_close()
+	if output is not None:
+		settings = { "jobs": jobs, "album_size": album_size, "latency_ms": latency, "mb_limit": mb_limit, "mb_rate": mb_rate }
+		output.write_text(json.dumps({ "commit": get_commit(), "settings": settings, "results": results }, indent=2), encoding="utf8")
+
+
+if __name__ == "__main__":
+	main()
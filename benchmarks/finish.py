@@ -0,0 +1,99 @@
+"""
+bytes written per track by the finishing path (remux -> tag -> final location), classic vs single-write.
+generates a youtube-like fragmented m4a and a soundcloud-like mp3 with ffmpeg, so it needs no network.
+measures write() syscall bytes from /proc/self/io (wchar), which includes reaped ffmpeg child processes.
+
+usage: uv run python -m benchmarks.finish [--ffmpeg-location ffmpeg] [--duration 240] [--final-path /other/mount]
+"""
+import shutil
+import subprocess
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import click
+from PIL import Image
+
+from shiradl.dl import Dl
+from shiradl.tagging import cover_store, metadata_applier
+
+PROC_IO = Path("/proc/self/io")
+
+
+def written_bytes():
+	for line in PROC_IO.read_text().splitlines():
+		if line.startswith("wchar:"):
+			return int(line.split()[1])
+	raise Exception("wchar missing from /proc/self/io")
+
+
+def make_inputs(ffmpeg: str, workdir: Path, duration: int):
+	"""youtube serves fragmented (DASH) m4a, soundcloud plain mp3"""
+	m4a, mp3 = workdir / "input.m4a", workdir / "input.mp3"
+	source = ["-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}"]
+	subprocess.run([ffmpeg, "-v", "error", "-y", *source, "-c:a", "aac", "-b:a", "128k",
+		"-movflags", "frag_keyframe+empty_moov+default_base_moof", str(m4a)], check=True)
+	subprocess.run([ffmpeg, "-v", "error", "-y", *source, "-c:a", "libmp3lame", "-b:a", "128k", str(mp3)], check=True)
+	return [(m4a, "aac"), (mp3, "mp3")]
+
+
+def make_tags():
+	cover = BytesIO()
+	Image.effect_noise((1200, 1200), 64).convert("RGB").save(cover, "JPEG", quality=94) # noisy, so it's realistically sized
+	return {
+		"title": "Benchmark", "album": "Benchmark", "artist": "shira", "albumartist": "shira",
+		"track": 1, "tracktotal": 1, "year": "2024", "date": "2024-01-01T00:00:00Z",
+		"cover_url": "", "cover_hash": cover_store.put(cover.getvalue()), "lyrics": "la " * 300,
+	}
+
+
+def finish(dl: Dl, mode: str, source: Path, codec: str, scratch: Path, final_location: Path, tags):
+	"""the remux, tag and move stages of cli.py, for a single file"""
+	temp_location = scratch / f"temp{source.suffix}"
+	shutil.copy(source, temp_location) # stands in for the download, not measured
+	start = written_bytes()
+	fixed_location = dl.fixup(temp_location, scratch / f"fixed{source.suffix}", codec, faststart=mode == "classic")
+	tagged = metadata_applier(tags, fixed_location, [], in_memory=mode == "single-write")
+	if tagged is not None:
+		dl.write_final_location(tagged, final_location)
+	else:
+		dl.move_to_final_location(fixed_location, final_location)
+	return written_bytes() - start
+
+
+@click.command()
+@click.option("--ffmpeg-location", type=str, default="ffmpeg")
+@click.option("--duration", type=int, default=240, help="Length of the generated tracks in seconds.")
+@click.option("--runs", type=int, default=3)
+@click.option("--final-path", type=Path, default=None, help="Put final files here, e.g. on another filesystem than the temp dir.")
+@click.option("--same-fs-staging/--no-same-fs-staging", default=True, help="Stage scratch files on the filesystem of --final-path, like the cli does.")
+def main(ffmpeg_location: str, duration: int, runs: int, final_path: Path | None, same_fs_staging: bool):
+	if not PROC_IO.exists():
+		raise click.ClickException("needs /proc/self/io (linux)")
+	with tempfile.TemporaryDirectory(prefix="shira-bench-") as tmp:
+		workdir = Path(tmp)
+		final_root = final_path or workdir / "final"
+		dl = Dl(final_root, workdir / "temp", None, Path(ffmpeg_location), "140", 1200, "jpg", 94, "{albumartist}/{album}", "{track:02d} {title}", None, 60, same_fs_staging=same_fs_staging) # type: ignore
+		tags = make_tags()
+		print(f"{'input':<8} {'mode':<13} {'file size':>11} {'bytes written':>14} {'x file size':>12} {'time':>8}")
+		print(f"scratch files in {dl.get_staging_path(final_root)}")
+		for source, codec in make_inputs(ffmpeg_location, workdir, duration):
+			for mode in ("classic", "single-write"):
+				written, elapsed, size = [], [], 0
+				for i in range(runs):
+					scratch = dl.create_scratch_path(mode, final_root)
+					final_location = final_root / f"{mode}-{i}{source.suffix}"
+					t0 = time.perf_counter()
+					written.append(finish(dl, mode, source, codec, scratch, final_location, dict(tags)))
+					elapsed.append(time.perf_counter() - t0)
+					size = final_location.stat().st_size
+					final_location.unlink()
+					dl.cleanup(scratch)
+				avg_written = sum(written) / runs
+				print(f"{source.suffix[1:]:<8} {mode:<13} {size:>11,} {avg_written:>14,.0f} {avg_written / size:>12.2f} {sum(elapsed) / runs * 1000:>6.0f}ms")
+		dl.cleanup()
+
+
+if __name__ == "__main__":
+	main()
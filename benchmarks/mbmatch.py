@@ -0,0 +1,104 @@
+"""
+times MBSong.save_song_dict (matching a track against a MusicBrainz recording search result page)
+with the memoized single-pass musicbrainz.normalize and with the previous per-call re.sub implementation,
+and checks both pick the same recording, release and artist. no requests are made.
+
+payloads come from fixtures/mb_recording_search.json (pages shaped like ws/2 recording search responses),
+or, with --from-cache, from the recording searches in the http cache database of earlier shiradl/mbtag runs.
+
+uv run python -m benchmarks.mbmatch [--from-cache] [--rounds 20]
+"""
+import json
+import re
+import time
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+from shiradl import musicbrainz
+from shiradl.musicbrainz import MBSong, hyphens_re, yeet_regexes
+
+FIXTURE = Path(__file__).parent / "fixtures" / "mb_recording_search.json"
+QUERY_RE = re.compile(r'^(?P<title>.*) AND artist:"(?P<artist>.*)" AND release:"(?P<album>.*)"$') # see MBSong.fetch_song
+
+
+def normalize_reference(text: str):
+	"""musicbrainz.normalize before it was compiled into one pass and memoized, kept as the reference"""
+	text = text.lower().strip()
+	for yeet_re in yeet_regexes:
+		text = re.sub(yeet_re, "", text)
+	text = text.replace("／", "/")
+	text = re.sub(hyphens_re, "-", text)
+	return text.strip()
+
+
+def load_fixture(path: Path):
+	return [(p["query"], p["response"]["recordings"]) for p in json.loads(path.read_text(encoding="utf8"))]
+
+
+def load_from_cache():
+	"""recording searches saved by the http cache, with the title/artist/album they were searched for"""
+	from shiradl.session import session
+	payloads = []
+	for response in session.cache.responses.values():
+		url = urlparse(response.url)
+		if url.netloc != "musicbrainz.org" or not url.path.endswith("/recording") or response.status_code != 200:
+			continue
+		query = QUERY_RE.match(parse_qs(url.query).get("query", [""])[0])
+		if query is None:
+			continue
+		payloads.append((query.groupdict(), json.loads(response.text)["recordings"]))
+	return payloads
+
+
+def match(query: dict, recordings: list):
+	mb = MBSong(query["title"], query["artist"], query["album"], skip_clean_title=True)
+	mb.save_song_dict(recordings)
+	return mb.get_match()
+
+
+def run(payloads: list, rounds: int, clear_each: bool):
+	""":returns (seconds per payload, matches)"""
+	matches = []
+	start = time.perf_counter()
+	for _ in range(rounds):
+		matches = []
+		for query, recordings in payloads:
+			if clear_each: # nothing memoized from other result pages, the cost of a fresh lookup
+				musicbrainz.normalize.cache_clear()
+			matches.append(match(query, recordings))
+	return (time.perf_counter() - start) / (rounds * len(payloads)), matches
+
+
+@click.command()
+@click.option("--fixture", type=click.Path(exists=True, dir_okay=False, path_type=Path), default=FIXTURE, help="JSON list of { query, response } search result pages.")
+@click.option("--from-cache", is_flag=True, help="Use the recording searches in the http cache instead of --fixture.")
+@click.option("--rounds", type=int, default=20, help="Times every payload is matched.")
+def main(fixture: Path, from_cache: bool, rounds: int):
+	payloads = load_from_cache() if from_cache else load_fixture(fixture)
+	if len(payloads) == 0:
+		raise click.ClickException("no recording searches found")
+	comparisons = sum(len(r.get("releases", [])) for _, recordings in payloads for r in recordings)
+	# matching only: no client needed, and fetch_artist (the request made when nothing matched) is skipped
+	with mock.patch.object(musicbrainz, "get_mb_client", lambda: None), mock.patch.object(MBSong, "fetch_artist", lambda self: None):
+		with mock.patch.object(musicbrainz, "normalize", normalize_reference):
+			ref_time, ref_matches = run(payloads, rounds, False)
+		cold_time, cold_matches = run(payloads, rounds, True)
+		warm_time, warm_matches = run(payloads, rounds, False)
+	musicbrainz.normalize.cache_clear()
+
+	print(f"{len(payloads)} search result pages, {comparisons} recording x release pairs, {sum(m['mb_releasetrackid'] is not None for m in ref_matches)} matched")
+	print(f"reference   {ref_time * 1000:8.3f}ms per page")
+	print(f"memoized    {cold_time * 1000:8.3f}ms per page ({ref_time / cold_time:.1f}x), normalize cache cleared before every page")
+	print(f"warm        {warm_time * 1000:8.3f}ms per page ({ref_time / warm_time:.1f}x), same pages again")
+	differ = [query for query, a, b, c in zip([p[0] for p in payloads], ref_matches, cold_matches, warm_matches, strict=True) if not a == b == c]
+	for query in differ:
+		print(f"  different match for {query}")
+	if differ:
+		raise SystemExit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,396 @@
+"""
+local stand-ins for the hosts a run talks to: the YouTube Music api (music.youtube.com/youtubei/v1), MusicBrainz (musicbrainz.org/ws/2)
+and the thumbnail / cover hosts, all answered by one http server with a configurable latency and per host rate limits.
+
+the original host is the first part of the path (http://127.0.0.1:port/musicbrainz.org/ws/2/recording?query=...), StandInAdapter rewrites
+requests to that, so the sessions, caches and rate limiters of shiradl are used as they are.
+everything served comes from a synthetic Catalog: youtube music responses are shaped like the innertube responses ytmusicapi parses,
+MusicBrainz search results are padded with the recorded pages in fixtures/mb_recording_search.json.
+"""
+import io
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from shiradl.musicbrainz import RateLimitedAdapter
+
+MB_FIXTURE = Path(__file__).parent / "fixtures" / "mb_recording_search.json"
+RECORDING_QUERY_RE = re.compile(r'^(?P<title>.*) AND artist:"(?P<artist>.*)" AND release:"(?P<album>.*)"$') # see MBSong.fetch_song
+RELEASE_QUERY_RE = re.compile(r'^release:"(?P<album>.*)" AND artist:"(?P<artist>.*)"$') # see MBAlbum.fetch_release
+NUMBER_RE = re.compile(r"(\d+)$")
+DECOYS = 3 # recorded recordings served before the one that matches
+DOT = { "text": " • " }
+
+
+class Catalog:
+	"""
+	the synthetic library every stand-in serves, generated from indexes, so any number of tracks costs nothing up front.
+	track i is on album i // album_size, playlist PLe2e<n> holds the first n tracks
+	"""
+	def __init__(self, album_size = 10):
+		self.album_size = album_size
+
+	@staticmethod
+	def video_id(i: int):
+		return f"e2e{i:08d}"
+
+	@staticmethod
+	def mbid(kind: int, i: int):
+		""":param kind: 1 recording, 2 release, 3 release group, 4 artist"""
+		return f"{kind:08d}-0000-4000-8000-{i:012d}"
+
+	@staticmethod
+	def get_number(text: str):
+		""":returns the number at the end of a title / id, None if there's none"""
+		match = NUMBER_RE.search(text)
+		return int(match.group(1)) if match else None
+
+	def track(self, i: int):
+		album = i // self.album_size
+		return {
+			"index": i,
+			"video_id": self.video_id(i),
+			"title": f"Song {i}",
+			"position": i % self.album_size + 1,
+			**self.album(album),
+		}
+
+	def album(self, k: int):
+		return {
+			"album_index": k,
+			"album": f"Album {k}",
+			"artist": f"Artist {k % 50}",
+			"artist_index": k % 50,
+			"year": str(2000 + k % 25),
+			"browse_id": f"MPREb_e2e{k:08d}",
+			"playlist_id": f"OLAK5uy_e2e{k:08d}",
+		}
+
+	def album_tracks(self, k: int):
+		return [self.track(i) for i in range(k * self.album_size, (k + 1) * self.album_size)]
+
+
+def runs(*items: str | dict):
+	return { "runs": [{ "text": item } if isinstance(item, str) else item for item in items] }
+
+
+def browse_run(text: str, browse_id: str, page_type: str):
+	return { "text": text, "navigationEndpoint": { "browseEndpoint": {
+		"browseId": browse_id,
+		"browseEndpointContextSupportedConfigs": { "browseEndpointContextMusicConfig": { "pageType": page_type } },
+	}}}
+
+
+def artist_run(track: dict):
+	return browse_run(track["artist"], f"UCe2e{track['artist_index']:08d}", "MUSIC_PAGE_TYPE_ARTIST")
+
+
+def thumbnails(track: dict, size: int):
+	return [{ "url": f"https://lh3.googleusercontent.com/e2e-cover-{track['album_index']}=w{size}-h{size}-l90-rj", "width": size, "height": size }]
+
+
+def watch_endpoint(video_id: str):
+	return { "watchEndpoint": {
+		"videoId": video_id,
+		"playlistId": f"RDAMVM{video_id}",
+		"watchEndpointMusicSupportedConfigs": { "watchEndpointMusicConfig": { "musicVideoType": "MUSIC_VIDEO_TYPE_ATV" } },
+	}}
+
+
+def get_watch_response(track: dict):
+	"""/youtubei/v1/next, what YTMusic.get_watch_playlist parses"""
+	video = {
+		"videoId": track["video_id"],
+		"title": runs(track["title"]),
+		"lengthText": runs("3:21"),
+		"thumbnail": { "thumbnails": thumbnails(track, 60) },
+		"longBylineText": runs(artist_run(track), DOT, browse_run(track["album"], track["browse_id"], "MUSIC_PAGE_TYPE_ALBUM"), DOT, track["year"]),
+		"menu": { "menuRenderer": { "items": [] } },
+		"navigationEndpoint": watch_endpoint(track["video_id"]),
+	}
+	tabs = [
+		{ "tabRenderer": { "title": "Up next", "content": { "musicQueueRenderer": { "content": { "playlistPanelRenderer": { "contents": [{ "playlistPanelVideoRenderer": video }] } } } } } },
+		{ "tabRenderer": { "title": "Lyrics", "endpoint": { "browseEndpoint": {
+			"browseId": f"MPLYt_{track['video_id']}",
+			"browseEndpointContextSupportedConfigs": { "browseEndpointContextMusicConfig": { "pageType": "MUSIC_PAGE_TYPE_TRACK_LYRICS" } },
+		}}}},
+	]
+	return { "contents": { "singleColumnMusicWatchNextResultsRenderer": { "tabbedRenderer": { "watchNextTabbedResultsRenderer": { "tabs": tabs } } } } }
+
+
+def get_album_response(catalog: Catalog, k: int):
+	"""/youtubei/v1/browse of an album (MPREb_...), what YTMusic.get_album parses"""
+	tracks = catalog.album_tracks(k)
+	album = tracks[0]
+	header = {
+		"title": runs(album["album"]),
+		"subtitle": runs("Album", DOT, album["year"]),
+		"thumbnail": { "musicThumbnailRenderer": { "thumbnail": { "thumbnails": thumbnails(album, 544) } } },
+		"straplineTextOne": runs(artist_run(album)),
+		"secondSubtitle": runs(f"{len(tracks)} songs", DOT, f"{len(tracks) * 3} minutes"),
+		"buttons": [{ "musicPlayButtonRenderer": { "playNavigationEndpoint": { "watchPlaylistEndpoint": { "playlistId": album["playlist_id"] } } } }],
+	}
+	items = [{ "musicResponsiveListItemRenderer": {
+		"flexColumns": [
+			{ "musicResponsiveListItemFlexColumnRenderer": { "text": runs({ "text": t["title"], "navigationEndpoint": watch_endpoint(t["video_id"]) }) } },
+			{ "musicResponsiveListItemFlexColumnRenderer": { "text": runs(artist_run(t)) } },
+		],
+		"fixedColumns": [{ "musicResponsiveListItemFixedColumnRenderer": { "text": runs("3:21") } }],
+		"index": runs(str(t["position"])),
+		"overlay": { "musicItemThumbnailOverlayRenderer": { "content": { "musicPlayButtonRenderer": { "playNavigationEndpoint": watch_endpoint(t["video_id"]) } } } },
+	}} for t in tracks]
+	return { "contents": { "twoColumnBrowseResultsRenderer": {
+		"tabs": [{ "tabRenderer": { "content": { "sectionListRenderer": { "contents": [{ "musicResponsiveHeaderRenderer": header }] } } } }],
+		"secondaryContents": { "sectionListRenderer": { "contents": [{ "musicShelfRenderer": { "contents": items } }] } },
+	}}}
+
+
+def get_lyrics_response(track: dict):
+	"""/youtubei/v1/browse of lyrics (MPLYt_...), what YTMusic.get_lyrics parses"""
+	lyrics = "\n".join(f"{track['title']}, line {n}" for n in range(1, 41))
+	return { "contents": { "sectionListRenderer": { "contents": [{ "musicDescriptionShelfRenderer": { "description": runs(lyrics), "footer": runs("Source: e2e") } }] } } }
+
+
+def get_playlist_info(catalog: Catalog, list_id: str):
+	"""what yt-dlp's flat extraction of a playlist returns, the harness fetches it from the stand-in instead"""
+	if list_id.startswith("OLAK5uy_"):
+		tracks = catalog.album_tracks(catalog.get_number(list_id) or 0)
+	else:
+		tracks = [catalog.track(i) for i in range(catalog.get_number(list_id) or 0)]
+	return {
+		"id": list_id,
+		"title": f"Playlist {list_id}",
+		"webpage_url": f"https://www.youtube.com/playlist?list={list_id}",
+		"webpage_url_basename": "playlist",
+		"entries": [
+			{ "id": t["video_id"], "title": t["title"], "url": f"https://music.youtube.com/watch?v={t['video_id']}", "ie_key": "Youtube" }
+			for t in tracks
+		],
+	}
+
+
+def mb_artist_credit(track: dict):
+	return [{ "name": track["artist"], "joinphrase": "", "artist": { "id": Catalog.mbid(4, track["artist_index"]), "name": track["artist"], "sort-name": track["artist"] } }]
+
+
+def mb_release(track: dict, album_size: int):
+	k = track["album_index"]
+	return {
+		"id": Catalog.mbid(2, k),
+		"title": track["album"],
+		"status": "Official",
+		"date": f"{track['year']}-01-01",
+		"country": "XW",
+		"track-count": album_size,
+		"artist-credit": mb_artist_credit(track),
+		"release-group": { "id": Catalog.mbid(3, k), "title": track["album"], "primary-type": "Album" },
+	}
+
+
+def mb_recording(track: dict, album_size: int):
+	return {
+		"id": Catalog.mbid(1, track["index"]),
+		"score": 100,
+		"title": track["title"],
+		"length": 201000,
+		"artist-credit": mb_artist_credit(track),
+		"first-release-date": f"{track['year']}-01-01",
+		"releases": [mb_release(track, album_size)],
+	}
+
+
+class MBResponder:
+	"""answers /ws/2 searches and release lookups from the catalog"""
+	def __init__(self, catalog: Catalog, fixture = MB_FIXTURE):
+		self.catalog = catalog
+		pages = json.loads(fixture.read_text(encoding="utf8"))
+		self.decoys = [page["response"]["recordings"][:DECOYS] for page in pages]
+
+	def page(self, key: str, items: list):
+		return { "created": "2026-01-01T00:00:00.000Z", "count": len(items), "offset": 0, key: items }
+
+	def respond(self, path: str, params: dict[str, str]):
+		""":returns (status, body)"""
+		query = params.get("query", "")
+		if path == "recording":
+			match = RECORDING_QUERY_RE.match(query)
+			i = self.catalog.get_number(match.group("title")) if match else None
+			decoys = self.decoys[(i or 0) % len(self.decoys)]
+			found = [mb_recording(self.catalog.track(i), self.catalog.album_size)] if i is not None else []
+			return 200, self.page("recordings", [*decoys, *found])
+		if path == "artist":
+			i = self.catalog.get_number(query)
+			artists = [{ "id": Catalog.mbid(4, i), "score": 100, "name": f"Artist {i}", "sort-name": f"Artist {i}" }] if i is not None else []
+			return 200, self.page("artists", artists)
+		if path == "release":
+			match = RELEASE_QUERY_RE.match(query)
+			k = self.catalog.get_number(match.group("album")) if match else None
+			releases = [mb_release(self.catalog.track(k * self.catalog.album_size), self.catalog.album_size)] if k is not None else []
+			return 200, self.page("releases", releases)
+		if path.startswith("release/"):
+			k = self.catalog.get_number(path)
+			if k is None:
+				return 404, { "error": "Not Found" }
+			tracks = self.catalog.album_tracks(k)
+			media_tracks = [{ "id": Catalog.mbid(5, t["index"]), "position": t["position"], "title": t["title"], "recording": mb_recording(t, len(tracks)) } for t in tracks]
+			return 200, { **mb_release(tracks[0], len(tracks)), "media": [{ "position": 1, "track-count": len(tracks), "tracks": media_tracks }] }
+		return 404, { "error": "Not Found" }
+
+
+@lru_cache(maxsize=256)
+def get_cover(k: int):
+	"""a 544x544 jpeg, different for every album"""
+	image = Image.new("RGB", (544, 544), ((k * 37) % 256, (k * 91) % 256, (k * 173) % 256))
+	image.paste((255 - (k * 37) % 256, 128, 64), (136, 136, 408, 408))
+	out = io.BytesIO()
+	image.save(out, "JPEG", quality=90)
+	return out.getvalue()
+
+
+class StandInServer(ThreadingHTTPServer):
+	"""
+	:param latency: seconds every response is delayed by
+	:param limits: requests per second answered per host, more than that in a second get a 503 with Retry-After (like MusicBrainz does)
+	"""
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, catalog: Catalog, latency = 0.0, limits: dict[str, float] | None = None, address = ("127.0.0.1", 0)):
+		super().__init__(address, StandInHandler)
+		self.catalog = catalog
+		self.mb = MBResponder(catalog)
+		self.latency = latency
+		self.limits = limits or {}
+		self._lock = threading.Lock()
+		self._windows: dict[str, tuple[int, int]] = {} # host => (second, requests answered in it)
+		self.reset()
+
+	@property
+	def base(self):
+		return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+	def reset(self):
+		with self._lock:
+			self.requests: Counter[str] = Counter()
+			self.throttled: Counter[str] = Counter()
+
+	def counts(self):
+		""":returns { "requests": { host: count }, "throttled": { host: count } }"""
+		with self._lock:
+			return { "requests": dict(sorted(self.requests.items())), "throttled": dict(sorted(self.throttled.items())) }
+
+	def admit(self, host: str):
+		"""counts the request, :returns False if it's over the limit of host"""
+		with self._lock:
+			self.requests[host] += 1
+			limit = self.limits.get(host, 0)
+			if limit <= 0:
+				return True
+			second = int(time.monotonic())
+			window_second, count = self._windows.get(host, (second, 0))
+			count = count + 1 if window_second == second else 1
+			self._windows[host] = (second, count)
+			if count > limit:
+				self.throttled[host] += 1
+				return False
+			return True
+
+	def handle_error(self, request, client_address):
+		if not isinstance(sys.exc_info()[1], ConnectionError): # clients hanging up on a keep-alive connection, e.g. when they exit
+			super().handle_error(request, client_address)
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def respond(self, method: str, host: str, path: str, params: dict[str, str], body: dict):
+		""":returns (status, content type, body bytes)"""
+		if host == "music.youtube.com":
+			if method == "GET": # YTMusic looks for a visitor id in the page once
+				return 200, "text/html", b'<script>ytcfg.set({"VISITOR_DATA": "e2e"});</script>'
+			browse_id = body.get("browseId", "")
+			if path == "youtubei/v1/next":
+				response = get_watch_response(self.catalog.track(self.catalog.get_number(body.get("videoId", "")) or 0))
+			elif browse_id.startswith("MPREb_"):
+				response = get_album_response(self.catalog, self.catalog.get_number(browse_id) or 0)
+			elif browse_id.startswith("MPLYt_"):
+				response = get_lyrics_response(self.catalog.track(self.catalog.get_number(browse_id) or 0))
+			else:
+				return 404, "application/json", b'{"error": {"message": "Not Found"}}'
+			return 200, "application/json", json.dumps(response).encode("utf8")
+		if host == "www.youtube.com" and path == "playlist":
+			return 200, "application/json", json.dumps(get_playlist_info(self.catalog, params.get("list", ""))).encode("utf8")
+		if host == "musicbrainz.org" and path.startswith("ws/2/"):
+			status, response = self.mb.respond(path.removeprefix("ws/2/"), params)
+			return status, "application/json", json.dumps(response).encode("utf8")
+		if host in ("lh3.googleusercontent.com", "i.ytimg.com"):
+			return 200, "image/jpeg", get_cover(self.catalog.get_number(path.split("=")[0]) or 0)
+		return 404, "text/plain", b"Not Found"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1" # keep-alive, like the real hosts
+	server: StandInServer
+
+	def log_message(self, format, *args):
+		pass
+
+	def handle_request(self, method: str):
+		url = urlparse(self.path)
+		host, _, path = url.path.lstrip("/").partition("/")
+		params = { k: v[0] for k, v in parse_qs(url.query).items() }
+		length = int(self.headers.get("Content-Length") or 0)
+		raw = self.rfile.read(length) if length > 0 else b""
+		time.sleep(self.server.latency)
+		if not self.server.admit(host):
+			status, content_type, body = 503, "application/json", b'{"error": "rate limited"}'
+			headers = { "Retry-After": "1" }
+		else:
+			status, content_type, body = self.server.respond(method, host, path, params, json.loads(raw) if raw else {})
+			headers = {}
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		for k, v in headers.items():
+			self.send_header(k, v)
+		self.end_headers()
+		if method != "HEAD":
+			self.wfile.write(body)
+
+	def do_GET(self):
+		self.handle_request("GET")
+
+	def do_HEAD(self):
+		self.handle_request("HEAD")
+
+	def do_POST(self):
+		self.handle_request("POST")
+
+
+class StandInAdapter(HTTPAdapter):
+	"""sends every request to the stand-in server at base instead. responses keep the original url, caches and reports see the real host"""
+	def __init__(self, base: str, **kwargs):
+		super().__init__(**kwargs)
+		self.base = base
+
+	def send(self, request, **kwargs): # type: ignore
+		local = request.copy()
+		local.url = f"{self.base}/{request.url.split('://', 1)[1]}"
+		res = super().send(local, **kwargs)
+		res.url = request.url
+		res.request = request
+		return res
+
+
+class StandInRateLimitedAdapter(StandInAdapter, RateLimitedAdapter):
+	"""the MusicBrainz adapter of MBClient (token bucket, 503 retries) in front of the stand-in"""
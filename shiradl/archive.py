@@ -0,0 +1,63 @@
+"""
+persistent archive of downloaded tracks: source id (youtube videoId / soundcloud url) => final path.
+checked right after the download queue is built, so tracks that were already downloaded
+are skipped before any metadata lookups happen.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import TypedDict
+
+from .tagging import Tags
+
+
+class ArchiveEntry(TypedDict):
+	source_id: str
+	final_path: str
+	tag_hash: str
+	timestamp: float
+
+
+def hash_tags(tags: Tags):
+	"""stable hash of the written tags"""
+	return hashlib.sha1(json.dumps(tags, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class DownloadArchive:
+	def __init__(self, db_path: Path):
+		db_path.parent.mkdir(parents=True, exist_ok=True)
+		self.db_path = db_path
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(db_path, check_same_thread=False)
+		with self._lock, self._conn:
+			self._conn.execute(
+				"CREATE TABLE IF NOT EXISTS archive (source_id TEXT PRIMARY KEY, final_path TEXT NOT NULL, tag_hash TEXT, timestamp REAL)"
+			)
+
+	def get(self, source_id: str) -> ArchiveEntry | None:
+		with self._lock:
+			row = self._conn.execute("SELECT source_id, final_path, tag_hash, timestamp FROM archive WHERE source_id = ?", (source_id,)).fetchone()
+		if row is None:
+			return None
+		return { "source_id": row[0], "final_path": row[1], "tag_hash": row[2], "timestamp": row[3] }
+
+	def find_existing(self, source_id: str):
+		"""final path of an archived track, if the file is still there"""
+		entry = self.get(source_id)
+		if entry is None or not Path(entry["final_path"]).exists():
+			return None
+		return Path(entry["final_path"])
+
+	def add(self, source_id: str, final_path: Path, tags: Tags):
+		with self._lock, self._conn:
+			self._conn.execute(
+				"INSERT OR REPLACE INTO archive (source_id, final_path, tag_hash, timestamp) VALUES (?, ?, ?, ?)",
+				(source_id, str(final_path.absolute()), hash_tags(tags), time.time())
+			)
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
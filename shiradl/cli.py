@@ -1,15 +1,23 @@
 import json
 import logging
 import shutil
+import sys
 from http.cookiejar import LoadError as CookieLoadError
 from pathlib import Path
 
 import click
 
-from .dl import Dl
+from .archive import DownloadArchive
+from .dl import Dl, DownloadQueue, TrackJob, get_codec_name
+from .fileops import FSYNC_POLICIES
+from .lyrics import LyricsCache, LyricsFetcher
+from .mbdump import MBDumpIndex
 from .metadata import TIGER_SINGLE, smart_metadata
-from .musicbrainz import musicbrainz_enrich_tags
-from .tagging import get_cover_local, metadata_applier
+from .musicbrainz import MISS_TTL, get_match_cache, musicbrainz_enrich_tags
+from .pipeline import Pipeline, Stage
+from .report import recorder
+from .session import ENDPOINTS, session
+from .tagging import CoverProcessor, cover_store, get_cover_local, metadata_applier
 
 logging.basicConfig(
 	format="[%(levelname)-8s %(asctime)s] %(message)s",
@@ -17,6 +25,10 @@ logging.basicConfig(
 )
 
 EXCLUDED_PARAMS = ("urls", "config_location", "url_txt", "no_config_file", "version", "help")
+DEFAULT_ARCHIVE_LOCATION = Path.home() / ".shiradl" / "archive.sqlite"
+STAGE_NAMES = ("resolve", "download", "remux", "tag", "move")
+WORKER_NAMES = (*STAGE_NAMES, "lyrics") # lyrics run on their own pool next to the pipeline
+SIZE_UNITS = { "": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3 }
 
 
 def write_default_config_file(ctx: click.Context):
@@ -26,6 +38,55 @@ def write_default_config_file(ctx: click.Context):
 		f.write(json.dumps(config_file, indent=4))
 
 
+def parse_stage_jobs(stage_jobs: str | None):
+	"""parses 'resolve=4,download=2' into { "resolve": 4, "download": 2 }"""
+	if stage_jobs is None or stage_jobs.strip() == "":
+		return {}
+	parsed: dict[str, int] = {}
+	for pair in stage_jobs.split(","):
+		name, _, count = pair.partition("=")
+		name = name.strip().lower()
+		if name not in WORKER_NAMES or not count.strip().isdigit() or int(count) < 1:
+			raise click.BadParameter(f"'{pair}', expected <stage>=<workers> with stage one of {', '.join(WORKER_NAMES)}", param_hint="--stage-jobs")
+		parsed[name] = int(count)
+	return parsed
+
+
+def parse_cache_ttl(cache_ttl: str | None):
+	"""parses 'musicbrainz=600,covers=-1' into { "musicbrainz": 600, "covers": -1 }"""
+	if cache_ttl is None or cache_ttl.strip() == "":
+		return {}
+	parsed: dict[str, int] = {}
+	for pair in cache_ttl.split(","):
+		name, _, seconds = pair.partition("=")
+		name = name.strip().lower()
+		try:
+			ttl = int(seconds)
+		except ValueError:
+			ttl = None
+		if name not in ENDPOINTS or ttl is None or ttl < -1:
+			raise click.BadParameter(f"'{pair}', expected <endpoint>=<seconds> with endpoint one of {', '.join(ENDPOINTS)}", param_hint="--cache-ttl")
+		parsed[name] = ttl
+	return parsed
+
+
+def parse_size(size: str, param_hint = "--cache-max-size"):
+	"""parses '512M' into bytes, units are K, M and G (powers of 1024)"""
+	value = size.strip().upper().removesuffix("B")
+	unit = value[-1:] if value[-1:] in SIZE_UNITS else ""
+	number = value.removesuffix(unit).strip()
+	if not number.isdigit():
+		raise click.BadParameter(f"'{size}', expected bytes or a size like 512M or 2G", param_hint=param_hint)
+	return int(number) * SIZE_UNITS[unit]
+
+
+def format_size(size: int):
+	for unit in ("G", "M", "K"):
+		if size >= SIZE_UNITS[unit]:
+			return f"{size / SIZE_UNITS[unit]:.1f}{unit}"
+	return f"{size}B"
+
+
 def no_config_callback(ctx: click.Context, param: click.Parameter, no_config_file: bool):
 	if no_config_file:
 		return ctx
@@ -39,7 +100,48 @@ def no_config_callback(ctx: click.Context, param: click.Parameter, no_config_fil
 	return ctx
 
 
-@click.command()
+@click.group()
+@click.help_option("-h", "--help")
+def cache():
+	"""Inspect or shrink the HTTP cache and the cover store."""
+
+
+@cache.command()
+def stats():
+	"""Print the size of the HTTP cache (per endpoint) and of the cover store."""
+	http = session.stats()
+	click.echo(f"HTTP cache \"{http['path']}\": {format_size(http['file_size'])} on disk")
+	for group, counts in http["groups"].items():
+		click.echo(f"  {group:<12} {counts['responses']:>6} responses ({counts['expired']} expired), {format_size(counts['bytes'])}")
+	covers = cover_store.stats()
+	click.echo(f"Cover store \"{covers['path']}\": {covers['covers']} covers, {format_size(covers['bytes'])}, {covers['urls']} urls remembered")
+	matches = get_match_cache().stats()
+	click.echo(f"MusicBrainz matches \"{matches['path']}\": {matches['matches']} matched, {matches['misses']} not matched, {matches['expired']} expired")
+
+
+@cache.command()
+@click.option("--max-size", type=str, default="512M", help="Size to shrink the HTTP cache and the cover store to (each), 0 to only delete expired responses.")
+def prune(max_size: str):
+	"""Delete expired responses, then the least recently used responses and covers until both are under --max-size."""
+	max_bytes = parse_size(max_size, "--max-size")
+	count, freed = session.prune(max_bytes, vacuum=True)
+	click.echo(f"HTTP cache: deleted {count} responses, {format_size(freed)}")
+	click.echo(f"MusicBrainz matches: deleted {get_match_cache().prune()} expired")
+	if max_bytes > 0:
+		count, freed = cover_store.prune(max_bytes)
+		click.echo(f"Cover store: deleted {count} covers, {format_size(freed)}")
+
+
+class ShiraCommand(click.Command):
+	"""the download command, with 'shiradl cache ...' handed to the cache group"""
+	def main(self, args=None, prog_name=None, *rest, **kwargs):
+		args = list(sys.argv[1:] if args is None else args)
+		if args[:1] == ["cache"]:
+			return cache.main(args[1:], f"{prog_name or 'shiradl'} cache", *rest, **kwargs)
+		return super().main(args, prog_name, *rest, **kwargs)
+
+
+@click.command(cls=ShiraCommand, epilog="Run 'shiradl cache --help' to inspect or prune the HTTP cache.")
 @click.argument("urls", nargs=-1, type=str, required=True)
 @click.option("--final-path", "-f", type=Path, default="./YouTube Music", help="Path where the downloaded files will be saved.")
 @click.option("--temp-path", "-t", type=Path, default="./temp", help="Path where the temporary files will be saved.")
@@ -52,6 +154,7 @@ def no_config_callback(ctx: click.Context, param: click.Parameter, no_config_fil
 @click.option("--cover-quality", type=click.IntRange(1, 100), default=94, help="JPEG quality of the cover.")
 @click.option("--cover-img", type=Path, default=None, help="Path to image or folder of images named video/song id")
 @click.option("--cover-crop", type=click.Choice(["auto", "crop", "pad"]), default="auto", help="'crop' takes a 1:1 square from the center, pad always pads top & bottom")
+@click.option("--cover-processes", type=click.IntRange(0, 256), default=0, help="Processes squaring thumbnails into covers (Tigerv2 fallback), 0 for one per CPU core.")
 @click.option("--template-folder", type=str, default="{albumartist}/{album}", help="Template of the album folders as a format string.")
 @click.option("--template-file", type=str, default="{track:02d} {title}", help="Template of the song files as a format string.")
 @click.option("--exclude-tags", "-e", type=str, default=None, help="List of tags to exclude from file tagging separated by commas without spaces.")
@@ -65,6 +168,20 @@ def no_config_callback(ctx: click.Context, param: click.Parameter, no_config_fil
 @click.option("--single-folder", "-w", is_flag=True, help="Wrap singles in their own folder instead of placing them directly into artist's folder.")
 @click.option("--use-playlist-name", type=bool, is_flag=True, help="Uses the playlist name in the final location when downloading a playlist.")
 @click.option("--no-download", is_flag=True, help="Skip actual download; write a silent stub file for metadata-only testing.")
+@click.option("--finish-mode", type=click.Choice(["single-write", "classic"]), default="single-write", help="'single-write' tags in memory and writes each file once, 'classic' remuxes with faststart, tags and moves the file.")
+@click.option("--same-fs-staging/--no-same-fs-staging", default=True, help="Keep temporary files on the filesystem of the final path (instead of --temp-path) when they differ, so files are renamed instead of copied.")
+@click.option("--fsync", type=click.Choice(FSYNC_POLICIES), default="none", help="'file' fsyncs every file before it's renamed into the final folder, 'full' also fsyncs the folder.")
+@click.option("--link-covers", is_flag=True, help="Hardlink identical covers saved with --save-cover instead of writing a copy into every folder.")
+@click.option("--cache-ttl", type=str, default=None, help=f"Cache lifetime in seconds per endpoint ({', '.join(ENDPOINTS)}), e.g. 'musicbrainz=86400,covers=-1'. -1 never expires, 0 doesn't cache.")
+@click.option("--cache-max-size", type=str, default="512M", help="Shrink the HTTP cache and the cover store to this size (each) after the run if they're over it, least recently used first. 0 for no limit.")
+@click.option("--cache-images-in-sqlite", is_flag=True, help="Also keep image bodies in the HTTP cache database. By default covers are only kept in the cover store.")
+@click.option("--mb-miss-ttl", type=int, default=MISS_TTL, help="Seconds a track MusicBrainz had no match for isn't searched again. Matches are kept for 30 days.")
+@click.option("--mb-dump-index", type=Path, default=None, help="Look tracks up in this local MusicBrainz dump index (see 'mbdump import') instead of the MusicBrainz API.")
+@click.option("--archive-location", type=Path, default=str(DEFAULT_ARCHIVE_LOCATION), help="Location of the archive of downloaded tracks.")
+@click.option("--no-archive", is_flag=True, help="Don't skip tracks found in the download archive and don't add to it.")
+@click.option("--jobs", "-j", "jobs_count", type=click.IntRange(1, 64), default=1, help="Number of tracks each stage (resolve, download, remux, tag, move) processes at once.")
+@click.option("--stage-jobs", type=str, default=None, help="Override --jobs per stage, e.g. 'resolve=4,download=2'.")
+@click.option("--report", "report_location", type=Path, default=None, help="Write a JSON report of the run: time per stage (p50/p95/max), HTTP requests and cache hits per host, bytes downloaded, subprocess time.")
 @click.version_option(package_name="shiradl")
 @click.help_option("-h", "--help")
 def cli(
@@ -80,6 +197,7 @@ def cli(
 	cover_quality: int,
 	cover_img: Path,
 	cover_crop: str,
+	cover_processes: int,
 	template_folder: str,
 	template_file: str,
 	exclude_tags: str,
@@ -93,7 +211,22 @@ def cli(
 	single_folder: bool,
 	use_playlist_name: bool,
 	no_download: bool,
+	finish_mode: str,
+	same_fs_staging: bool,
+	fsync: str,
+	link_covers: bool,
+	cache_ttl: str,
+	cache_max_size: str,
+	cache_images_in_sqlite: bool,
+	mb_miss_ttl: int,
+	mb_dump_index: Path,
+	archive_location: Path,
+	no_archive: bool,
+	jobs_count: int,
+	stage_jobs: str,
+	report_location: Path,
 ):
+	recorder.reset()
 	logger = logging.getLogger(__name__)
 	logger.setLevel(log_level)
 	if not shutil.which(str(ffmpeg_location)):
@@ -109,6 +242,12 @@ def cli(
 			with open(url, "r") as f:
 				_urls.extend(f.read().splitlines())
 		urls = tuple(_urls)
+	session.configure(parse_cache_ttl(cache_ttl), cache_images_in_sqlite)
+	cache_max_bytes = parse_size(cache_max_size)
+	dump_index = MBDumpIndex(mb_dump_index, use_cache_dir=False) if mb_dump_index is not None else None
+	match_cache = get_match_cache() if dump_index is None else None # see mbtag_cli
+	if match_cache is not None:
+		match_cache.miss_ttl = mb_miss_ttl
 	logger.debug("Starting downloader")
 
 	dl = Dl(
@@ -124,9 +263,12 @@ def cli(
 		exclude_tags, 
 		truncate, 
 		dump_json=log_level == "DEBUG",
-		use_playlist_name=use_playlist_name
+		use_playlist_name=use_playlist_name,
+		same_fs_staging=same_fs_staging,
+		fsync=fsync,
+		link_covers=link_covers,
 	)
-	download_queue = []
+	download_queue: list[DownloadQueue] = []
 	for i, url in enumerate(urls):
 		try:
 			logger.debug(f'Checking "{url}" (URL {i + 1}/{len(urls)})')
@@ -136,82 +278,194 @@ def cli(
 		except Exception:
 			logger.error(f"Failed to check URL {i + 1}/{len(urls)}", exc_info=print_exceptions)
 			logging.exception("")
-	error_count = 0
-	for i, url in enumerate(download_queue):
-		for j, track in enumerate(url):
-			logger.info(f'Downloading "{track["title"]}" (track {j + 1}/{len(url)} from URL {i + 1}/{len(download_queue)})')
-			try:
-				logger.debug("Getting tags")
-				ytmusic_watch_playlist = dl.get_ytmusic_watch_playlist(track["id"])
-
-				dl.tags = None
-				tags = None
-				is_single = False
-				if ytmusic_watch_playlist is None:
-					logger.info("No results on YTMusic API, using Tigerv2 to extract metadata")
-					tag_track = track
-					if "webpage_url_domain" not in track:
-						tag_track = dl.get_ydl_extract_info(track["url"])
-					logger.debug("Starting Tigerv2")
-					tags = smart_metadata(tag_track, temp_path, "JPEG" if dl.cover_format == "jpg" else "PNG", cover_crop)
-					is_single = tags.get("comments") == TIGER_SINGLE
-					if is_single:
-						tags["comments"] = str(track.get("webpage_url") or track.get("original_url") or track.get("url") or url)
-				else:
-					tags = dl.get_tags(ytmusic_watch_playlist, track)
-					is_single = tags["tracktotal"] == 1
-				logger.debug("Tags applied, fetching MusicBrainz Database")
-				tags = musicbrainz_enrich_tags(tags, dl.soundcloud, dl.exclude_tags)
-				# pprint(tags)
-				logger.debug("Applied MusicBrainz Tags")
-				if cover_img:
-					local_img_bytes = get_cover_local(cover_img, track["url"] if dl.soundcloud else track["id"], dl.soundcloud)
-					if local_img_bytes is not None:
-						tags["cover_bytes"] = local_img_bytes
-				logger.debug("Applied cover Image")
-				final_location = dl.get_final_location(tags, ".mp3" if dl.soundcloud is True else ".m4a", is_single, single_folder)
-				logger.debug(f'Final location is "{final_location}"')
-				temp_location = dl.get_temp_location(track["id"])	
-				if not final_location.exists() or overwrite:
-					logger.debug(f'Downloading to "{temp_location}"')
-					if no_download:
-						dl.stub_download(temp_location)
-					elif dl.soundcloud is False:
-						dl.download(track["id"], temp_location)
-					else:
-						dl.download_souncloud(track.get("original_url") or track["webpage_url"], temp_location)
-					
-					fixed_location = dl.get_fixed_location(track["id"])
-					logger.debug(f'Remuxing to "{fixed_location}"')
-					dl.fixup(temp_location, fixed_location)
-					logger.debug("Applying tags")
-					metadata_applier(tags, fixed_location, dl.exclude_tags)
-					# if dl.soundcloud is False:
-					# 	tagger_m4a(tags, fixed_location, dl.exclude_tags, dl.cover_format)
-					# else:
-					# 	tagger_mp3(tags, fixed_location, dl.exclude_tags, dl.cover_format)
-					logger.debug("Moving to final location")
-					dl.move_to_final_location(fixed_location, final_location)
-					logger.info(f'Saved to "{final_location}"')
-				else:
-					logger.warning("File already exists at final location, skipping")
-				if save_cover:
-					cover_location = dl.get_cover_location(final_location)
-					if not cover_location.exists() or overwrite:
-						logger.debug(f'Saving cover to "{cover_location}"')
-						dl.save_cover(tags, cover_location)
-					else:
-						logger.debug(f'File already exists at "{cover_location}", skipping')
-			except Exception:
-				error_count += 1
-				logger.error(
-					f'Failed to download "{track["title"]}" (track {j + 1}/{len(url)} from URL ' + f"{i + 1}/{len(download_queue)})",
-					exc_info=print_exceptions,
-				)
-				logging.exception("")
-			finally:
-				if temp_path.exists():
-					logger.debug(f'Cleaning up "{temp_path}"')
-					dl.cleanup()
-	logger.info(f"Done ({error_count} error(s))")
 
+	archive = DownloadArchive(archive_location) if not no_archive else None
+	jobs: list[TrackJob] = []
+	for i, queue in enumerate(download_queue):
+		for j, track in enumerate(queue["tracks"]):
+			job = TrackJob(track, queue, f'"{track["title"]}" (track {j + 1}/{len(queue["tracks"])} from URL {i + 1}/{len(download_queue)})')
+			if archive is not None and not overwrite:
+				archived_location = archive.find_existing(job.source_id)
+				if archived_location is not None and (not save_cover or dl.get_cover_location(archived_location).exists()):
+					logger.info(f'Skipping {job.label}, already downloaded to "{archived_location}"')
+					continue
+			jobs.append(job)
+
+	def resolve_stage(job: TrackJob):
+		"""collects tags and the final location. returns None if the track doesn't need downloading"""
+		track = job.track
+		logger.info(f"Resolving {job.label}")
+		job.scratch_path = dl.create_scratch_path(track["id"], job.final_path)
+		logger.debug("Getting tags")
+		tags = dl.get_album_tags(job.album, track) if job.album is not None else None
+		ytmusic_watch_playlist = None
+		tiger_cover = False
+		if tags is not None:
+			logger.debug("Tags taken from the album")
+		else:
+			with recorder.span("resolve.ytmusic", job.source_id):
+				ytmusic_watch_playlist = dl.get_ytmusic_watch_playlist(track["id"], job.soundcloud)
+
+		is_single = False
+		if tags is not None:
+			is_single = tags["tracktotal"] == 1
+		elif ytmusic_watch_playlist is None:
+			logger.info("No results on YTMusic API, using Tigerv2 to extract metadata")
+			tag_track = track
+			if "webpage_url_domain" not in track:
+				with recorder.span("resolve.extract_info", job.source_id):
+					tag_track = dl.get_ydl_extract_info(track["url"])
+				job.info = tag_track
+			logger.debug("Starting Tigerv2")
+			with recorder.span("resolve.tigerv2", job.source_id):
+				tags = smart_metadata(tag_track, job.scratch_path, pil_cover_format, cover_crop, with_cover=False)
+			tiger_cover = True
+			is_single = tags.get("comments") == TIGER_SINGLE
+			if is_single:
+				tags["comments"] = str(track.get("webpage_url") or track.get("original_url") or track.get("url") or job.url)
+		else:
+			tags = dl.get_tags(ytmusic_watch_playlist, track)
+			is_single = tags["tracktotal"] == 1
+		logger.debug("Tags applied, fetching MusicBrainz Database")
+		with recorder.span("resolve.musicbrainz", job.source_id):
+			tags = musicbrainz_enrich_tags(tags, job.soundcloud, dl.exclude_tags, match_cache=match_cache, dump_index=dump_index)
+		# pprint(tags)
+		logger.debug("Applied MusicBrainz Tags")
+		if cover_img:
+			local_img_bytes = get_cover_local(cover_img, track["url"] if job.soundcloud else track["id"], job.soundcloud)
+			if local_img_bytes is not None:
+				tags["cover_hash"] = cover_store.put(local_img_bytes)
+		if tiger_cover and "cover_hash" not in tags:
+			job.cover = cover_processor.submit_url(tags["cover_url"], pil_cover_format, cover_crop)
+		logger.debug("Applied cover Image")
+		job.tags, job.is_single = tags, is_single
+		job.final_location = dl.get_final_location(tags, job.extension, is_single, single_folder, job.final_path)
+		logger.debug(f'Final location is "{job.final_location}"')
+		if job.final_location.exists() and not overwrite:
+			logger.warning(f"File already exists at final location, skipping {job.label}")
+			await_cover(job)
+			save_cover_stage(job)
+			archive_track(job)
+			return None
+		if lyrics_fetcher is not None and not job.soundcloud:
+			if ytmusic_watch_playlist is not None:
+				if ytmusic_watch_playlist["lyrics"]:
+					job.lyrics = lyrics_fetcher.submit(browse_id=ytmusic_watch_playlist["lyrics"])
+			elif job.album is not None:
+				job.lyrics = lyrics_fetcher.submit(video_id=track["id"])
+		return job
+
+	def download_stage(job: TrackJob):
+		job.temp_location = dl.get_temp_location(job)
+		logger.info(f'Downloading {job.label}')
+		logger.debug(f'Downloading to "{job.temp_location}"')
+		if no_download:
+			job.codec = dl.stub_download(job.temp_location, job.soundcloud)
+		else:
+			if job.soundcloud is False:
+				info = dl.download(job.track["id"], job.temp_location, job.info)
+			else:
+				info = dl.download_souncloud(job.source_id, job.temp_location, job.info)
+			job.codec = get_codec_name(info.get("acodec"))
+			recorder.add_download(job.temp_location.stat().st_size)
+		job.info = None # formats etc. aren't needed anymore
+		return job
+
+	def remux_stage(job: TrackJob):
+		logger.debug(f'Remuxing to "{dl.get_fixed_location(job)}"')
+		job.fixed_location = dl.fixup(job.temp_location, dl.get_fixed_location(job), job.codec, faststart=finish_mode == "classic")
+		return job
+
+	def await_cover(job: TrackJob):
+		if job.cover is not None:
+			with recorder.span("tag.wait_cover", job.source_id):
+				job.tags["cover_hash"] = job.cover.result() # type: ignore
+			job.cover = None
+
+	def tag_stage(job: TrackJob):
+		await_cover(job)
+		if job.lyrics is not None:
+			with recorder.span("tag.wait_lyrics", job.source_id):
+				lyrics = job.lyrics.result()
+			if lyrics is not None:
+				job.tags["lyrics"] = lyrics # type: ignore
+		logger.debug(f"Applying tags to {job.label}")
+		job.tagged = metadata_applier(job.tags, job.fixed_location, dl.exclude_tags, in_memory=finish_mode == "single-write") # type: ignore
+		return job
+
+	def move_stage(job: TrackJob):
+		if job.tagged is not None:
+			logger.debug("Writing to final location")
+			dl.write_final_location(job.tagged, job.final_location) # type: ignore
+			job.tagged = None
+		else:
+			logger.debug("Moving to final location")
+			dl.move_to_final_location(job.fixed_location, job.final_location)
+		logger.info(f'Saved to "{job.final_location}"')
+		save_cover_stage(job)
+		archive_track(job)
+		return job
+
+	def archive_track(job: TrackJob):
+		if archive is not None and not no_download:
+			archive.add(job.source_id, job.final_location, job.tags) # type: ignore
+
+	def save_cover_stage(job: TrackJob):
+		if not save_cover:
+			return
+		cover_location = dl.get_cover_location(job.final_location)
+		if not cover_location.exists() or overwrite:
+			logger.debug(f'Saving cover to "{cover_location}"')
+			dl.save_cover(job.tags, cover_location)
+		else:
+			logger.debug(f'File already exists at "{cover_location}", skipping')
+
+	def on_error(job: TrackJob, stage: Stage, _e: Exception):
+		logger.error(f"Failed to download {job.label} ({stage.name} stage)", exc_info=print_exceptions)
+		logging.exception("")
+
+	def on_done(job: TrackJob, _failed: bool):
+		if job.scratch_path is not None:
+			logger.debug(f'Cleaning up "{job.scratch_path}"')
+			dl.cleanup(job.scratch_path)
+
+	stage_workers = { name: jobs_count for name in WORKER_NAMES }
+	stage_workers.update(parse_stage_jobs(stage_jobs))
+	lyrics_fetcher = None
+	if "lyrics" not in dl.exclude_tags:
+		lyrics_fetcher = LyricsFetcher(dl.ytmusic, LyricsCache(), stage_workers["lyrics"])
+	cover_processor = CoverProcessor(cover_processes)
+	pil_cover_format = "JPEG" if cover_format == "jpg" else "PNG"
+	stage_funcs = [resolve_stage, download_stage, remux_stage, tag_stage, move_stage]
+	pipeline = Pipeline(
+		[Stage(name, recorder.timed(name, func, lambda job: job.source_id), stage_workers[name]) for name, func in zip(STAGE_NAMES, stage_funcs, strict=True)],
+		on_error=on_error,
+		on_done=on_done,
+	)
+	logger.debug(f"Stage workers: {stage_workers}, at most {pipeline.max_in_flight(1)} temp files at once")
+	error_count = len(pipeline.run(jobs))
+	dl.close()
+	cover_processor.shutdown()
+	if lyrics_fetcher is not None:
+		lyrics_fetcher.shutdown()
+	if archive is not None:
+		archive.close()
+	dl.cleanup()
+	# both prunes read every response / cover, only worth it once the cheap size estimates are over the limit.
+	# expired responses and matches are left to 'shiradl cache prune'
+	if cache_max_bytes > 0 and session.get_used_size() > cache_max_bytes:
+		count, freed = session.prune(cache_max_bytes)
+		logger.debug(f"Pruned {count} responses ({format_size(freed)}) from the HTTP cache")
+	else:
+		session.flush_access()
+	cover_store_size = cover_store.get_size()
+	if cache_max_bytes > 0 and (cover_store_size is None or cover_store_size > cache_max_bytes):
+		count, freed = cover_store.prune(cache_max_bytes)
+		logger.debug(f"Pruned {count} covers ({format_size(freed)}) from the cover store")
+	cover_store.close()
+	if dump_index is not None:
+		dump_index.close()
+	if report_location is not None:
+		recorder.write(report_location, tracks=len(jobs), errors=error_count, stage_workers=stage_workers)
+		logger.debug(f'Wrote the run report to "{report_location}"')
+	logger.info(f"Done ({error_count} error(s))")
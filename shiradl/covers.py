@@ -0,0 +1,253 @@
+"""
+content-addressed cover store.
+covers are kept on disk once per sha1 of their bytes, tags only carry that hash (Tags.cover_hash).
+a size-bounded in-memory lru sits in front, so long playlists don't keep every cover in memory.
+fetched urls are remembered across runs (for as long as the http cache would keep them), so covers don't have to
+sit in the http cache database as well. prune() keeps the store under a size, evicting the least recently used covers.
+the size it measured is kept in the url index, plus what was stored since (get_size()), so prune() only has to run once it's over.
+"""
+import errno
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path
+
+from requests import Session
+from requests_cache.backends.sqlite import get_cache_path
+
+from .fileops import copy_file, get_part_location, write_file
+
+COVER_STORE_NAME = "shira_covers"
+COVER_MEMORY_LIMIT = 32 * 1024 * 1024 # bytes of covers kept in memory
+URL_INDEX_NAME = "urls.sqlite"
+
+
+class CoverStore:
+	"""
+	:param store_path: folder the covers are saved in, inside the user cache dir if use_cache_dir
+	:param session: used to fetch covers by url
+	:param url_expire_after: seconds a fetched url is remembered across runs (-1 forever, 0 only for this run). only for this run if None
+	"""
+	def __init__(
+		self,
+		store_path: Path | str = COVER_STORE_NAME,
+		session: Session | None = None,
+		use_cache_dir = True,
+		memory_limit = COVER_MEMORY_LIMIT,
+		url_expire_after: Callable[[str], int] | None = None,
+	):
+		self.store_path = Path(get_cache_path(store_path, use_cache_dir=use_cache_dir))
+		self.session = session if session is not None else Session()
+		self.memory_limit = memory_limit
+		self._memory: OrderedDict[str, bytes] = OrderedDict()
+		self._memory_size = 0
+		self._urls: dict[str, str] = {} # cover url => hash, for this run
+		self._linked: dict[str, Path] = {} # hash => last cover file linked to it, for when the store is on another filesystem
+		self._lock = threading.Lock()
+		self._url_locks: dict[str, threading.Lock] = {}
+		self.url_expire_after = url_expire_after
+		self._index: sqlite3.Connection | None = None
+		self._added_size = 0 # bytes of covers written since the size in the index was measured or updated
+
+	def _get_index(self):
+		""":returns the connection to the url index, opened on first use. call with self._lock held"""
+		if self._index is None:
+			self.store_path.mkdir(parents=True, exist_ok=True)
+			self._index = sqlite3.connect(self.store_path / URL_INDEX_NAME, isolation_level=None, check_same_thread=False)
+			self._index.execute("PRAGMA journal_mode=WAL")
+			self._index.execute("PRAGMA busy_timeout=5000")
+			self._index.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT, fetched REAL)")
+			self._index.execute("CREATE TABLE IF NOT EXISTS size (bytes INTEGER)") # a single row, see get_size
+		return self._index
+
+	def _find_url(self, url: str):
+		""":returns the hash url was stored under by a previous run, if that's recent enough and still in the store"""
+		if self.url_expire_after is None:
+			return None
+		ttl = self.url_expire_after(url)
+		if ttl == 0:
+			return None
+		with self._lock:
+			row = self._get_index().execute("SELECT digest, fetched FROM urls WHERE url = ?", (url,)).fetchone()
+		if row is None or (ttl > 0 and row[1] + ttl <= time.time()) or not self.path(row[0]).exists():
+			return None
+		return row[0]
+
+	def _index_url(self, url: str, digest: str):
+		if self.url_expire_after is None or self.url_expire_after(url) == 0:
+			return
+		with self._lock:
+			self._get_index().execute("INSERT OR REPLACE INTO urls (url, digest, fetched) VALUES (?, ?, ?)", (url, digest, time.time()))
+
+	def path(self, digest: str):
+		return self.store_path / digest[:2] / digest
+
+	def _remember(self, digest: str, data: bytes):
+		with self._lock:
+			if digest in self._memory:
+				self._memory.move_to_end(digest)
+				return
+			if len(data) > self.memory_limit:
+				return
+			self._memory[digest] = data
+			self._memory_size += len(data)
+			while self._memory_size > self.memory_limit:
+				_, evicted = self._memory.popitem(last=False)
+				self._memory_size -= len(evicted)
+
+	def put(self, data: bytes):
+		""":returns the hash of data, which is saved to the store if it isn't there yet"""
+		digest = hashlib.sha1(data).hexdigest()
+		location = self.path(digest)
+		if location.exists():
+			self._touch(location)
+		else:
+			write_file(data, location)
+			with self._lock:
+				self._added_size += len(data)
+		self._remember(digest, data)
+		return digest
+
+	def _touch(self, location: Path):
+		"""the mtime of a stored cover is when it was last used, prune() evicts by it"""
+		try:
+			os.utime(location)
+		except OSError:
+			pass
+
+	def put_url(self, url: str):
+		"""fetches a cover (once per url and run) and stores it. :returns its hash"""
+		with self._lock:
+			digest = self._urls.get(url)
+			if digest is not None:
+				return digest
+			url_lock = self._url_locks.setdefault(url, threading.Lock())
+		with url_lock: # parallel tracks of one album wait for the first fetch
+			with self._lock:
+				digest = self._urls.get(url)
+			if digest is None:
+				digest = self._find_url(url)
+				if digest is not None:
+					self._touch(self.path(digest))
+				else:
+					res = self.session.get(url)
+					res.raise_for_status()
+					digest = self.put(res.content)
+					self._index_url(url, digest)
+				with self._lock:
+					self._urls[url] = digest
+		return digest
+
+	def get(self, digest: str):
+		with self._lock:
+			data = self._memory.get(digest)
+			if data is not None:
+				self._memory.move_to_end(digest)
+				return data
+		data = self.path(digest).read_bytes()
+		self._remember(digest, data)
+		return data
+
+	def _stored(self):
+		""":returns [(path, size, mtime)] of every stored cover"""
+		stored = []
+		if not self.store_path.exists():
+			return stored
+		for prefix in os.scandir(self.store_path):
+			if not prefix.is_dir():
+				continue
+			for entry in os.scandir(prefix.path):
+				if entry.is_file() and not entry.name.endswith(".part"):
+					st = entry.stat()
+					stored.append((Path(entry.path), st.st_size, st.st_mtime))
+		return stored
+
+	def get_size(self):
+		""":returns bytes the store takes up, as prune() last measured plus what was stored since. None if it was never measured"""
+		with self._lock:
+			row = self._get_index().execute("SELECT bytes FROM size").fetchone()
+			return row[0] + self._added_size if row is not None else None
+
+	def _save_size(self, measured: int | None = None):
+		"""writes the size prune() measured, or adds what was stored since to the saved one. call with self._lock held"""
+		index = self._get_index()
+		if measured is not None:
+			index.execute("DELETE FROM size")
+			index.execute("INSERT INTO size (bytes) VALUES (?)", (measured,))
+		elif self._added_size > 0:
+			index.execute("UPDATE size SET bytes = bytes + ?", (self._added_size,))
+		self._added_size = 0
+
+	def stats(self):
+		""":returns { "path", "covers", "bytes", "urls" }"""
+		stored = self._stored()
+		with self._lock:
+			urls = self._get_index().execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+		return { "path": str(self.store_path), "covers": len(stored), "bytes": sum(size for _, size, _ in stored), "urls": urls }
+
+	def prune(self, max_size: int):
+		"""
+		deletes the least recently used covers until the store takes up at most max_size bytes, and forgets urls pointing to them.
+		:returns (covers deleted, bytes freed)
+		"""
+		stored = sorted(self._stored(), key=lambda s: s[2])
+		size = sum(size for _, size, _ in stored)
+		deleted, freed = [], 0
+		for location, length, _ in stored:
+			if size <= max_size:
+				break
+			location.unlink(missing_ok=True)
+			deleted.append(location.name)
+			size -= length
+			freed += length
+		with self._lock:
+			for digest in deleted:
+				data = self._memory.pop(digest, None)
+				if data is not None:
+					self._memory_size -= len(data)
+			index = self._get_index()
+			index.executemany("DELETE FROM urls WHERE digest = ?", ((d,) for d in deleted))
+			self._save_size(size)
+			if self.url_expire_after is not None: # urls that expired won't be used again
+				expired = [url for url, fetched in index.execute("SELECT url, fetched FROM urls") if 0 <= self.url_expire_after(url) < time.time() - fetched]
+				index.executemany("DELETE FROM urls WHERE url = ?", ((u,) for u in expired))
+		return len(deleted), freed
+
+	def close(self):
+		with self._lock:
+			if self._added_size > 0:
+				self._save_size()
+			if self._index is not None:
+				self._index.close()
+				self._index = None
+
+	def link(self, digest: str, dest: Path):
+		"""
+		puts the cover at dest as a hardlink, so identical covers across album folders share one file.
+		links to the store if it's on the same filesystem, otherwise to the previous dest of this cover, otherwise copies
+		"""
+		dest.parent.mkdir(parents=True, exist_ok=True)
+		part_location = get_part_location(dest)
+		with self._lock:
+			sources = [self.path(digest), self._linked.get(digest)]
+		try:
+			for source in sources:
+				if source is None or not source.exists():
+					continue
+				try:
+					os.link(source, part_location)
+					break
+				except OSError as e:
+					if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+						raise
+			else:
+				copy_file(self.path(digest), part_location)
+			os.replace(part_location, dest)
+		finally:
+			part_location.unlink(missing_ok=True)
+		with self._lock:
+			self._linked[digest] = dest
@@ -1,14 +1,113 @@
 import json
 import re
 import shutil
-import subprocess
+import tempfile
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future
 from pathlib import Path
+from typing import TypedDict
 
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError, ReExtractInfo
 from ytmusicapi import YTMusic
 
-from .metadata import clean_title, get_year
-from .tagging import MV_SEPARATOR_VISUAL, Tags, get_cover
+from .fileops import get_staging_path, move_file, sweep_staging_path, write_file
+from .metadata import clean_title, get_year, shutdown_thumbnail_pool
+from .mp4 import is_faststart_mp4
+from .report import recorder
+from .tagging import MV_SEPARATOR_VISUAL, Tags, cover_store, get_cover_hash
+
+
+# yt-dlp acodec / ffprobe codec_name => codec name used by Dl.fixup
+CODEC_NAMES = { "mp4a": "aac", "aac": "aac", "opus": "opus", "mp3": "mp3" }
+
+
+def get_codec_name(acodec: str | None):
+	"""normalizes yt-dlp's acodec (e.g. mp4a.40.2) into aac, opus or mp3. None if unknown"""
+	if not acodec or acodec == "none":
+		return None
+	return CODEC_NAMES.get(acodec.split(".")[0].lower())
+
+
+class DownloadQueue(TypedDict):
+	url: str
+	tracks: list[dict]
+	soundcloud: bool
+	final_path: Path
+	album: "CachedAlbum | None" # set if the url is a ytmusic album, see Dl.get_album_tags
+
+
+class CachedAlbum(TypedDict):
+	album: dict
+	track_numbers: dict[str, int] # videoId => track number
+	tracks: dict[str, dict] # videoId => track from the get_album response
+
+
+class AlbumCache:
+	"""
+	thread-safe cache of ytmusic albums, keyed by both browseId and audioPlaylistId.
+	every album is only loaded once, even if several tracks of it are resolved at the same time
+	"""
+	def __init__(self):
+		self._albums: dict[str, CachedAlbum] = {}
+		self._key_locks: dict[str, threading.Lock] = {}
+		self._lock = threading.Lock()
+
+	def get(self, key: str) -> CachedAlbum | None:
+		with self._lock:
+			return self._albums.get(key)
+
+	def put(self, browse_id: str, entry: CachedAlbum):
+		with self._lock:
+			self._albums[browse_id] = entry
+			if entry["album"].get("audioPlaylistId"):
+				self._albums[str(entry["album"]["audioPlaylistId"])] = entry
+
+	def get_or_load(self, browse_id: str, loader: Callable[[str], CachedAlbum]) -> CachedAlbum:
+		with self._lock:
+			if browse_id in self._albums:
+				return self._albums[browse_id]
+			key_lock = self._key_locks.setdefault(browse_id, threading.Lock())
+		with key_lock: # other tracks of the same album wait here instead of fetching it again
+			entry = self.get(browse_id)
+			if entry is None:
+				entry = loader(browse_id)
+				self.put(browse_id, entry)
+			return entry
+
+
+class TrackJob:
+	"""state of a single track, kept off of Dl so several tracks can be processed at once"""
+	def __init__(self, track: dict, queue: DownloadQueue, label: str):
+		self.track = track
+		self.url = queue["url"]
+		self.soundcloud = queue["soundcloud"]
+		self.final_path = queue["final_path"]
+		self.album = queue["album"]
+		self.label = label
+		self.scratch_path: Path | None = None # isolated temp folder, see Dl.create_scratch_path
+		self.tags: Tags | None = None
+		self.is_single = False
+		self.lyrics: Future | None = None # see LyricsFetcher, awaited right before tagging
+		self.cover: Future | None = None # hash of the squared cover, see CoverProcessor. awaited right before tagging
+		self.info: dict | None = track if track.get("formats") else None # full yt-dlp info, reused for the download
+		self.codec: str | None = None # audio codec of the downloaded file, see get_codec_name
+		self.tagged: bytes | None = None # tagged file, kept in memory until it's written to final_location
+		self.temp_location: Path | None = None
+		self.fixed_location: Path | None = None
+		self.final_location: Path | None = None
+
+	@property
+	def extension(self):
+		return ".mp3" if self.soundcloud else ".m4a"
+
+	@property
+	def source_id(self) -> str:
+		"""videoId for youtube, url for soundcloud (ids aren't part of flat soundcloud playlist entries)"""
+		if self.soundcloud:
+			return str(self.track.get("original_url") or self.track.get("webpage_url") or self.track["url"])
+		return str(self.track["id"])
 
 
 class Dl:
@@ -28,10 +127,14 @@ class Dl:
 		truncate: int,
 		dump_json: bool = False,
 		use_playlist_name: bool = False,
+		same_fs_staging: bool = True,
+		fsync: str = "none",
+		link_covers: bool = False,
 		**kwargs,
 	):
 
 		self.ytmusic = YTMusic()
+		self.ytmusic._session.hooks["response"].append(recorder.record_response) # ytmusicapi brings its own session, counted all the same
 		self.final_path = final_path
 		self.temp_path = temp_path
 		self.cookies_location = cookies_location
@@ -46,24 +149,46 @@ class Dl:
 		self.truncate = None if truncate is not None and truncate < 4 else truncate
 
 		self.dump_json = dump_json
-		self.tags: Tags | None = None 
-		self.soundcloud = False
 		self.default_ydl_opts = {"progress": True, "quiet": True, "no_warnings": True, "fixup": "never"}
 		self.use_playlist_name = use_playlist_name
+		self.same_fs_staging = same_fs_staging
+		self.fsync = fsync
+		self.link_covers = link_covers
+		self._staging_paths: dict[Path, Path] = {} # final path => folder the scratch folders are created in
+		self._staging_lock = threading.Lock()
+		self.album_cache = AlbumCache()
+		self._ydl_local = threading.local()
+		self._ydls: list[YoutubeDL] = []
+		self._ydl_lock = threading.Lock()
+
+	def _get_ydl(self, name: str, ydl_opts: dict) -> YoutubeDL:
+		"""
+		long-lived YoutubeDL instances, one per thread and purpose.
+		reusing them skips re-initialization, but a single instance is not safe to share between threads
+		"""
+		ydl = getattr(self._ydl_local, name, None)
+		if ydl is None:
+			if self.cookies_location is not None:
+				ydl_opts = {**ydl_opts, "cookiefile": str(self.cookies_location)}
+			ydl = YoutubeDL(ydl_opts)
+			setattr(self._ydl_local, name, ydl)
+			with self._ydl_lock:
+				self._ydls.append(ydl)
+		return ydl
 
 	def get_ydl_extract_info(self, url) -> dict:
-		ydl_opts: dict[str, str | bool] = {"quiet": True, "no_warnings": True, "extract_flat": True}
-		if self.cookies_location is not None:
-			ydl_opts["cookiefile"] = str(self.cookies_location)
-		with YoutubeDL(ydl_opts) as ydl:
-			info = ydl.extract_info(url, download=False)
-			if info is None:
-				raise Exception(f"Failed to extract info for {url}")
-			return info
-
-	def get_download_queue(self, url):
+		ydl = self._get_ydl("extract", {"quiet": True, "no_warnings": True, "extract_flat": True})
+		info = ydl.extract_info(url, download=False)
+		if info is None:
+			raise Exception(f"Failed to extract info for {url}")
+		return info
+
+	def get_download_queue(self, url) -> DownloadQueue:
 		url = url.split("&")[0]
 		download_queue = []
+		final_path = self.final_path
+		soundcloud = False
+		album_browse_id = None
 		ydl_extract_info: dict = self.get_ydl_extract_info(url)
 		
 		if self.dump_json:
@@ -80,27 +205,38 @@ class Dl:
 			# f.close()
 			
 			# raise Exception("Not a YouTube URL")
-			if str(self.final_path) == "./YouTube Music":
-				self.final_path = Path("./SoundCloud")
-			self.soundcloud = True
+			if str(final_path) == "./YouTube Music":
+				final_path = Path("./SoundCloud")
+			soundcloud = True
 		if "MPREb_" in ydl_extract_info["webpage_url_basename"]:
+			album_browse_id = str(ydl_extract_info["webpage_url_basename"])
 			ydl_extract_info = self.get_ydl_extract_info(ydl_extract_info["url"])
+		elif str(ydl_extract_info.get("id", "")).startswith("OLAK5uy_"):
+			album_browse_id = self.ytmusic.get_album_browse_id(str(ydl_extract_info["id"]))
 		if "playlist" in ydl_extract_info["webpage_url_basename"]:
 			if self.use_playlist_name:
 				playlist_name = ydl_extract_info.get("title", "Unknown Playlist")
-				self.final_path = self.final_path / self.get_sanizated_string(playlist_name, True)
+				final_path = final_path / self.get_sanizated_string(playlist_name, True)
 			download_queue.extend(ydl_extract_info["entries"])
-		if "watch" in ydl_extract_info["webpage_url_basename"] or self.soundcloud:
+		if "watch" in ydl_extract_info["webpage_url_basename"] or soundcloud:
 			download_queue.append(ydl_extract_info)
-		return download_queue
+
+		album = None
+		if album_browse_id is not None and "entries" in ydl_extract_info:
+			# the playlist we already extracted is the album's playlist, no need to extract it again per track
+			album = self.album_cache.get(album_browse_id)
+			if album is None:
+				album = self.__make_cached_album(self.ytmusic.get_album(album_browse_id), ydl_extract_info["entries"])
+				self.album_cache.put(album_browse_id, album)
+		return { "url": url, "tracks": download_queue, "soundcloud": soundcloud, "final_path": final_path, "album": album }
 
 	def get_artist(self, artist_list):
 		if len(artist_list) == 1:
 			return artist_list[0]["name"]
 		return ", ".join([i["name"] for i in artist_list][:-1]) + f' & {artist_list[-1]["name"]}'
 
-	def get_ytmusic_watch_playlist(self, video_id):
-		if self.soundcloud:
+	def get_ytmusic_watch_playlist(self, video_id, soundcloud = False):
+		if soundcloud:
 			return None
 		ytmusic_watch_playlist = self.ytmusic.get_watch_playlist(video_id)
 		if ytmusic_watch_playlist is None or isinstance(ytmusic_watch_playlist, str):
@@ -116,21 +252,56 @@ class Dl:
 		return self.ytmusic.search(title, "songs")[0]["videoId"]
 		
 	def get_ytmusic_album(self, browse_id):
-		return self.ytmusic.get_album(browse_id)
+		return self.get_cached_album(browse_id)["album"]
+
+	def get_cached_album(self, browse_id) -> CachedAlbum:
+		"""album & it's track number index, fetched once per album"""
+		return self.album_cache.get_or_load(browse_id, self.__load_album)
+
+	def __load_album(self, browse_id) -> CachedAlbum:
+		ytmusic_album: dict = self.ytmusic.get_album(browse_id)
+		entries = self.get_ydl_extract_info(f'https://www.youtube.com/playlist?list={str(ytmusic_album["audioPlaylistId"])}')["entries"]
+		return self.__make_cached_album(ytmusic_album, entries)
+
+	def __make_cached_album(self, ytmusic_album: dict, playlist_entries: list[dict]) -> CachedAlbum:
+		return {
+			"album": ytmusic_album,
+			"track_numbers": { video["id"]: i + 1 for i, video in reversed(list(enumerate(playlist_entries))) }, # first occurence wins
+			"tracks": { t["videoId"]: t for t in ytmusic_album.get("tracks", []) if t.get("videoId") }
+		}
+
+	def get_album_tags(self, cached_album: CachedAlbum, track: dict) -> Tags | None:
+		"""
+		builds tags for a track of an album url straight from the get_album response,
+		without the per-track get_watch_playlist call. returns None if the track isn't on the album
+		"""
+		album_track = cached_album["tracks"].get(str(track["id"]))
+		if album_track is None or album_track.get("isAvailable") is False:
+			return None
+		ytmusic_album = cached_album["album"]
+		_year, _date = get_year(track, ytmusic_album)
+		return {
+			"title": clean_title(album_track["title"]),
+			"album": ytmusic_album["title"],
+			"albumartist": self.get_artist(ytmusic_album["artists"]),
+			"artist": self.get_artist(album_track.get("artists") or ytmusic_album["artists"]),
+			"comments": f"https://music.youtube.com/watch?v={album_track['videoId']}",
+			"track": cached_album["track_numbers"].get(album_track["videoId"], 1),
+			"tracktotal": ytmusic_album["trackCount"],
+			"date": _date,
+			"year": _year,
+			"cover_url": f'{ytmusic_album["thumbnails"][-1]["url"].split("=")[0]}'
+			+ f'=w{self.cover_size}-l{self.cover_quality}-{"rj" if self.cover_format == "jpg" else "rp"}'
+		}
 
 	def get_tags(self, ytmusic_watch_playlist, track: dict[str, str | int]) -> Tags:
-		if self.tags is None:
-			return self.__collect_tags(ytmusic_watch_playlist, track)
-		else:
-			return self.tags
-		
-	def __collect_tags(self, ytmusic_watch_playlist, track: dict[str, str | int]):
-		"""collects tag information into self.tags"""
-		if self.tags is not None:
-			return self.tags
+		return self.__collect_tags(ytmusic_watch_playlist, track)
 		
+	def __collect_tags(self, ytmusic_watch_playlist, track: dict[str, str | int]) -> Tags:
+		"""collects tag information for a single track"""
 		video_id = ytmusic_watch_playlist["tracks"][0]["videoId"]
-		ytmusic_album: dict = self.ytmusic.get_album(ytmusic_watch_playlist["tracks"][0]["album"]["id"])
+		cached_album = self.get_cached_album(ytmusic_watch_playlist["tracks"][0]["album"]["id"])
+		ytmusic_album = cached_album["album"]
 		_year, _date = get_year(track, ytmusic_album)
 		tags: Tags = {
 			"title": clean_title(ytmusic_watch_playlist["tracks"][0]["title"]),
@@ -138,7 +309,7 @@ class Dl:
 			"albumartist": self.get_artist(ytmusic_album["artists"]),
 			"artist": self.get_artist(ytmusic_watch_playlist["tracks"][0]["artists"]),
 			"comments": f"https://music.youtube.com/watch?v={video_id}",
-			"track": 1,
+			"track": cached_album["track_numbers"].get(video_id, 1),
 			"tracktotal": ytmusic_album["trackCount"],
 			"date": _date,
 			"year": _year,
@@ -146,17 +317,7 @@ class Dl:
 			+ f'=w{self.cover_size}-l{self.cover_quality}-{"rj" if self.cover_format == "jpg" else "rp"}'
 		}
 
-		for i, video in enumerate(self.get_ydl_extract_info(f'https://www.youtube.com/playlist?list={str(ytmusic_album["audioPlaylistId"])}')["entries"]):
-			if video["id"] == video_id:
-				tags["track"] = i + 1
-				break
-			if ytmusic_watch_playlist["lyrics"]:   
-				lyrics_data = self.ytmusic.get_lyrics(ytmusic_watch_playlist["lyrics"])
-				if lyrics_data is not None and "lyrics" in lyrics_data:
-					tags["lyrics"] = lyrics_data["lyrics"]
-			
-		self.tags = tags
-		return self.tags
+		return tags
 
 	def get_sanizated_string(self, dirty_string, is_folder):
 		dirty_string = re.sub(r'[\\/:*?"<>|;]', "_", dirty_string)
@@ -169,17 +330,35 @@ class Dl:
 				dirty_string = dirty_string[: self.truncate - 4]
 		return dirty_string.strip()
 
-	def get_temp_location(self, song_id):
-		if self.soundcloud:
-			return self.temp_path / f"{song_id}.mp3"
-		return self.temp_path / f"{song_id}.m4a"
-
-	def get_fixed_location(self, song_id):
-		if self.soundcloud:
-			return self.temp_path / f"{song_id}_fixed.mp3"
-		return self.temp_path / f"{song_id}_fixed.m4a"
-
-	def get_final_location(self, tags, extension = ".m4a", is_single = False, single_folders = False):
+	def get_staging_path(self, final_path: Path | None = None):
+		"""
+		folder for scratch files of tracks ending up in final_path.
+		with same_fs_staging, that's a folder on the same filesystem, so finishing a track is a rename instead of a copy
+		"""
+		final_path = final_path if final_path is not None else self.final_path
+		if not self.same_fs_staging:
+			return self.temp_path
+		with self._staging_lock:
+			if final_path not in self._staging_paths:
+				staging_path = get_staging_path(self.temp_path, final_path)
+				if staging_path not in self._staging_paths.values(): # first use this run
+					sweep_staging_path(staging_path)
+				self._staging_paths[final_path] = staging_path
+			return self._staging_paths[final_path]
+
+	def create_scratch_path(self, song_id, final_path: Path | None = None) -> Path:
+		"""creates an isolated temp folder for one track, so parallel tracks never share files"""
+		staging_path = self.get_staging_path(final_path)
+		staging_path.mkdir(parents=True, exist_ok=True)
+		return Path(tempfile.mkdtemp(prefix=f"{self.get_sanizated_string(str(song_id), True)}-", dir=staging_path))
+
+	def get_temp_location(self, job: TrackJob):
+		return job.scratch_path / f"{job.track['id']}{job.extension}" # type: ignore
+
+	def get_fixed_location(self, job: TrackJob):
+		return job.scratch_path / f"{job.track['id']}_fixed{job.extension}" # type: ignore
+
+	def get_final_location(self, tags, extension = ".m4a", is_single = False, single_folders = False, final_path: Path | None = None):
 		final_location_folder = self.template_folder.split("/")
 		final_location_file = self.template_file.split("/")
 
@@ -205,16 +384,16 @@ class Dl:
 		final_location_file = [self.get_sanizated_string(i.format(**filename_safe_tags), True) for i in final_location_file[:-1]] + [
 			self.get_sanizated_string(final_location_file[-1].format(**filename_safe_tags), False) + extension
 		]
-		return self.final_path.joinpath(*final_location_folder).joinpath(*final_location_file)
+		return (final_path or self.final_path).joinpath(*final_location_folder).joinpath(*final_location_file)
 
 	def get_cover_location(self, final_location):
 		return final_location.parent / f"Cover.{self.cover_format}"
 
-	def stub_download(self, temp_location: Path):
-		"""Create a minimal silent audio stub for metadata-only testing."""
+	def stub_download(self, temp_location: Path, soundcloud = False):
+		"""Create a minimal silent audio stub for metadata-only testing. returns it's codec"""
 		temp_location.parent.mkdir(parents=True, exist_ok=True)
-		codec = "libmp3lame" if self.soundcloud else "aac"
-		subprocess.run(
+		codec = "libmp3lame" if soundcloud else "aac"
+		recorder.run_subprocess(
 			[
 				str(self.ffmpeg_location), "-loglevel", "error",
 				"-f", "lavfi", "-i", "anullsrc=r=44100:cl=mono",
@@ -222,44 +401,82 @@ class Dl:
 			],
 			check=True,
 		)
-
-	def download(self, video_id, temp_location):
-		ydl_opts = {**self.default_ydl_opts, "format": self.itag, "outtmpl": str(temp_location)}
-
-		if self.cookies_location is not None:
-			ydl_opts["cookiefile"] = str(self.cookies_location)
-		with YoutubeDL(ydl_opts) as ydl:
-			ydl.download("music.youtube.com/watch?v=" + video_id)
-
-	def download_souncloud(self, url, temp_location):
+		return "mp3" if soundcloud else "aac"
+
+	def _download_with(self, ydl: YoutubeDL, url: str, temp_location, info: dict | None = None) -> dict:
+		"""downloads into temp_location, reusing an already extracted info dict if possible. returns the processed info"""
+		ydl.params["outtmpl"]["default"] = str(temp_location)
+		if info is not None and info.get("formats"):
+			try:
+				return ydl.process_ie_result(info, download=True) # no second extraction, only format selection
+			except (DownloadError, ReExtractInfo): # e.g. format urls expired, extract again
+				pass
+		downloaded = ydl.extract_info(url, download=True)
+		if downloaded is None:
+			raise Exception(f"Failed to download {url}")
+		return downloaded
+
+	def download(self, video_id, temp_location, info: dict | None = None) -> dict:
+		ydl = self._get_ydl("download", {**self.default_ydl_opts, "format": self.itag})
+		return self._download_with(ydl, "music.youtube.com/watch?v=" + video_id, temp_location, info)
+
+	def download_souncloud(self, url, temp_location, info: dict | None = None) -> dict:
 		# opus is obviously a better format, however:
 		# it's debatable whether soundcloud's mp3 is better than their opus
 		# because they might just use lower quality audio for opus (there have been complaints)
 		# this can be possibly later changed, for now we'll stick to mp3
-		ydl_opts = {**self.default_ydl_opts, "format": "mp3", "outtmpl": str(temp_location)}
-
-		if self.cookies_location is not None:
-			ydl_opts["cookiefile"] = str(self.cookies_location)
-		with YoutubeDL(ydl_opts) as ydl:
-			ydl.download(url)
-
-	def fixup(self, temp_location, fixed_location):
+		ydl = self._get_ydl("download_soundcloud", {**self.default_ydl_opts, "format": "mp3"})
+		return self._download_with(ydl, url, temp_location, info)
+
+	def fixup(self, temp_location, fixed_location, codec: str | None = None, faststart = True):
+		"""
+		remuxes into a faststart mp4 (or a clean mp3). skips ffmpeg entirely if the file is already fine.
+		returns the location of the fixed file, which is temp_location if nothing had to be done.
+		:param codec: codec from the yt-dlp info (see get_codec_name), only probed with ffprobe if not known
+		:param faststart: False leaves moov at the end, saving ffmpeg's second pass over the file (see mp4.move_moov_to_front)
+		"""
+		if codec is None:
+			codec = get_codec_name(self.get_audio_codec(temp_location))
+		if codec == "mp3" or (codec == "aac" and is_faststart_mp4(temp_location)):
+			return temp_location
 		fixup = [self.ffmpeg_location, "-loglevel", "error", "-i", temp_location]
-		codec = self.get_audio_codec(temp_location)
 		if codec == "opus":
 			fixup.extend(["-f", "mp4"])
-		subprocess.run([*fixup, "-movflags", "+faststart", "-c", "copy", fixed_location], check=True)	
+		if faststart:
+			fixup.extend(["-movflags", "+faststart"])
+		recorder.run_subprocess([*fixup, "-c", "copy", fixed_location], check=True)
+		return fixed_location
+
+	def write_final_location(self, data: bytes, final_location: Path):
+		"""writes an in-memory file straight into the final folder, renamed into place once complete"""
+		write_file(data, final_location, self.fsync)
 
 	def move_to_final_location(self, fixed_location, final_location):
-		final_location.parent.mkdir(parents=True, exist_ok=True)
-		shutil.move(fixed_location, final_location)
+		move_file(Path(fixed_location), final_location, self.fsync)
 
 	def save_cover(self, tags, cover_location):
-		with open(cover_location, "wb") as f:
-			f.write(get_cover(tags["cover_url"]))
-
-	def cleanup(self):
-		shutil.rmtree(self.temp_path)
+		"""saves the same cover that gets embedded. with link_covers, identical covers are hardlinked to each other"""
+		digest = get_cover_hash(tags)
+		if self.link_covers:
+			cover_store.link(digest, cover_location)
+		else:
+			write_file(cover_store.get(digest), cover_location, self.fsync)
+
+	def close(self):
+		with self._ydl_lock:
+			for ydl in self._ydls:
+				ydl.close()
+			self._ydls.clear()
+		shutdown_thumbnail_pool()
+
+	def cleanup(self, scratch_path: Path | None = None):
+		"""removes a track's scratch folder, or the temp/staging folders once they're empty"""
+		if scratch_path is not None:
+			shutil.rmtree(scratch_path, ignore_errors=True)
+			return
+		for staging_path in {self.temp_path, *self._staging_paths.values()}:
+			if staging_path.exists() and not any(staging_path.iterdir()):
+				staging_path.rmdir()
 
 	def get_audio_codec(self, file_path):
 		"""Use ffprobe to extract the audio codec of the given file."""
@@ -273,7 +490,7 @@ class Dl:
 			str(file_path)
 		]
 		# Run ffprobe and parse output
-		result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+		result = recorder.run_subprocess(cmd, capture_output=True, text=True, check=True)
 		codec_info = json.loads(result.stdout)
 		# Extract and return codec name
-		return codec_info["streams"][0]["codec_name"]
\ No newline at end of file
+		return codec_info["streams"][0]["codec_name"]
\ No newline at end of file
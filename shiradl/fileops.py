@@ -0,0 +1,161 @@
+"""
+moving finished files into the final folder.
+scratch files are staged on the filesystem of the final folder whenever possible, so finishing a track is a rename.
+if a copy can't be avoided, the kernel copies the data (copy_file_range / sendfile) into a .part file,
+which is renamed into place once complete, so a half-copied file never shows up in the final folder.
+"""
+import errno
+import os
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+
+STAGING_FOLDER_NAME = ".shiradl-staging" # hidden, only holds scratch folders of tracks being downloaded
+STAGING_STALE_AFTER = 24 * 3600 # seconds, scratch folders older than this were left by a run that was killed
+# none: leave flushing to the os, file: fsync the file before renaming it into place, full: also fsync the folder after the rename
+FSYNC_POLICIES = ("none", "file", "full")
+# errors meaning 'this kind of kernel copy isn't supported here', not 'the copy failed'
+_NO_KERNEL_COPY_ERRNOS = { errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP }
+
+
+def get_device(path: Path):
+	"""st_dev of path, or of its closest existing parent if it doesn't exist yet"""
+	path = path.absolute()
+	while not path.exists() and path != path.parent:
+		path = path.parent
+	return path.stat().st_dev
+
+
+def same_filesystem(a: Path, b: Path):
+	return get_device(a) == get_device(b)
+
+
+def get_staging_path(temp_path: Path, final_path: Path):
+	"""temp_path if it's on the same filesystem as final_path, otherwise a hidden folder inside final_path"""
+	if same_filesystem(temp_path, final_path):
+		return temp_path
+	return final_path / STAGING_FOLDER_NAME
+
+
+def sweep_staging_path(staging_path: Path, stale_after = STAGING_STALE_AFTER):
+	"""
+	removes what runs that were killed before their cleanup left in a STAGING_FOLDER_NAME folder.
+	recent scratch folders are kept, they might belong to another run. :returns how many were removed
+	"""
+	if staging_path.name != STAGING_FOLDER_NAME or not staging_path.is_dir():
+		return 0 # never sweep a temp_path the user picked
+	removed = 0
+	for entry in os.scandir(staging_path):
+		try:
+			if time.time() - entry.stat(follow_symlinks=False).st_mtime < stale_after:
+				continue
+			if entry.is_dir(follow_symlinks=False):
+				shutil.rmtree(entry.path)
+			else:
+				os.unlink(entry.path)
+			removed += 1
+		except OSError:
+			pass
+	return removed
+
+
+def _kernel_copy(fsrc: int, fdst: int, size: int):
+	"""copies size bytes without passing them through userspace. raises OSError if neither syscall is available"""
+	copied = 0
+	if hasattr(os, "copy_file_range"): # linux 4.5+, lets btrfs/xfs/nfs reflink or copy server-side
+		try:
+			while copied < size:
+				n = os.copy_file_range(fsrc, fdst, size - copied)
+				if n == 0:
+					break
+				copied += n
+			return copied
+		except OSError as e:
+			if e.errno not in _NO_KERNEL_COPY_ERRNOS or copied > 0:
+				raise
+	if not (sys.platform.startswith("linux") and hasattr(os, "sendfile")): # elsewhere sendfile only writes to sockets, or doesn't exist (windows)
+		raise OSError(errno.ENOSYS, "no kernel copy on this platform")
+	while copied < size:
+		n = os.sendfile(fdst, fsrc, copied, size - copied)
+		if n == 0:
+			break
+		copied += n
+	return copied
+
+
+def copy_file(src: Path, dst: Path):
+	with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+		size = os.fstat(fsrc.fileno()).st_size
+		try:
+			copied = _kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+		except OSError as e:
+			if e.errno not in _NO_KERNEL_COPY_ERRNOS:
+				raise
+			copied = -1
+		if copied != size: # fall back to a plain read/write copy
+			fsrc.seek(0)
+			fdst.seek(0)
+			fdst.truncate()
+			shutil.copyfileobj(fsrc, fdst)
+
+
+def fsync_file(path: Path):
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def fsync_folder(path: Path):
+	if os.name == "nt":
+		return # folders can't be opened for fsync on windows
+	fsync_file(path)
+
+
+def get_part_location(final_location: Path):
+	"""where a file is written before it's renamed to final_location. per thread, so parallel writers of one file don't clash"""
+	return final_location.with_name(f".{final_location.name}.{threading.get_ident()}.part")
+
+
+def _replace(part_location: Path, final_location: Path, fsync: str):
+	if fsync != "none":
+		fsync_file(part_location)
+	os.replace(part_location, final_location)
+	if fsync == "full":
+		fsync_folder(final_location.parent)
+
+
+def move_file(src: Path, final_location: Path, fsync = "none"):
+	"""moves src to final_location. a rename if both are on the same filesystem, a kernel-side copy otherwise"""
+	final_location.parent.mkdir(parents=True, exist_ok=True)
+	if fsync != "none":
+		fsync_file(src)
+	try:
+		os.replace(src, final_location)
+		if fsync == "full":
+			fsync_folder(final_location.parent)
+		return
+	except OSError as e:
+		if e.errno != errno.EXDEV:
+			raise
+	part_location = get_part_location(final_location)
+	try:
+		copy_file(src, part_location)
+		_replace(part_location, final_location, fsync)
+	finally:
+		part_location.unlink(missing_ok=True)
+	src.unlink()
+
+
+def write_file(data: bytes, final_location: Path, fsync = "none"):
+	"""writes data into the final folder, renamed into place once complete"""
+	final_location.parent.mkdir(parents=True, exist_ok=True)
+	part_location = get_part_location(final_location)
+	try:
+		part_location.write_bytes(data)
+		_replace(part_location, final_location, fsync)
+	finally:
+		part_location.unlink(missing_ok=True)
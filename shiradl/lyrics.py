@@ -0,0 +1,124 @@
+"""
+lyrics fetching, separate from the rest of the tags.
+lyrics are looked up on their own thread pool while the audio downloads, and only awaited before tagging.
+every lyrics browseId is fetched at most once per run, and results (including 'no lyrics') are kept
+in a persistent cache, so re-runs and retags never hit the lyrics endpoint again.
+"""
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from requests_cache.backends.sqlite import get_cache_path
+from ytmusicapi import YTMusic
+
+LYRICS_CACHE_NAME = "shira_lyrics_cache.sqlite"
+
+
+class LyricsCache:
+	"""
+	persistent lyrics cache, keyed by lyrics browseId. None is cached as well (track has no lyrics).
+	also remembers videoId => lyrics browseId, so tracks tagged from get_album don't need get_watch_playlist again
+	"""
+	def __init__(self, db_path: Path | str = LYRICS_CACHE_NAME, use_cache_dir = True):
+		self.db_path = get_cache_path(db_path, use_cache_dir=use_cache_dir)
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+		with self._lock, self._conn:
+			self._conn.execute("CREATE TABLE IF NOT EXISTS lyrics (browse_id TEXT PRIMARY KEY, lyrics TEXT)")
+			self._conn.execute("CREATE TABLE IF NOT EXISTS video_lyrics (video_id TEXT PRIMARY KEY, browse_id TEXT)")
+
+	def _get(self, query: str, key: str) -> tuple[bool, str | None]:
+		with self._lock:
+			row = self._conn.execute(query, (key,)).fetchone()
+		return (False, None) if row is None else (True, row[0])
+
+	def get(self, browse_id: str):
+		""":returns (cache hit, lyrics or None)"""
+		return self._get("SELECT lyrics FROM lyrics WHERE browse_id = ?", browse_id)
+
+	def put(self, browse_id: str, lyrics: str | None):
+		with self._lock, self._conn:
+			self._conn.execute("INSERT OR REPLACE INTO lyrics (browse_id, lyrics) VALUES (?, ?)", (browse_id, lyrics))
+
+	def get_browse_id(self, video_id: str):
+		""":returns (cache hit, lyrics browseId or None)"""
+		return self._get("SELECT browse_id FROM video_lyrics WHERE video_id = ?", video_id)
+
+	def put_browse_id(self, video_id: str, browse_id: str | None):
+		with self._lock, self._conn:
+			self._conn.execute("INSERT OR REPLACE INTO video_lyrics (video_id, browse_id) VALUES (?, ?)", (video_id, browse_id))
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
+
+
+class LyricsFetcher:
+	"""
+	fetches lyrics in the background. submit() returns a Future right away,
+	concurrent requests for the same browseId share one fetch.
+	lyrics are optional, so failed lookups resolve to None instead of failing the track.
+	"""
+	def __init__(self, ytmusic: YTMusic, cache: LyricsCache | None = None, workers = 1):
+		self.ytmusic = ytmusic
+		self.cache = cache
+		self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="lyrics")
+		self._fetched: dict[str, Future] = {}
+		self._lock = threading.Lock()
+
+	def submit(self, browse_id: str | None = None, video_id: str | None = None) -> Future:
+		"""look up lyrics by their browseId, or by the videoId if the browseId isn't known yet"""
+		if browse_id is None and video_id is None:
+			raise Exception("submit: either browse_id or video_id is required")
+		if browse_id is not None:
+			return self._pool.submit(self._lyrics, browse_id)
+		return self._pool.submit(self._lyrics_for_video, video_id)
+
+	def _lyrics_for_video(self, video_id: str):
+		browse_id = None
+		hit = False
+		if self.cache is not None:
+			hit, browse_id = self.cache.get_browse_id(video_id)
+		if not hit:
+			try:
+				browse_id = self.ytmusic.get_watch_playlist(video_id).get("lyrics")
+			except Exception:
+				return None
+			if self.cache is not None:
+				self.cache.put_browse_id(video_id, browse_id)
+		return self._lyrics(browse_id) if browse_id else None
+
+	def _lyrics(self, browse_id: str):
+		with self._lock:
+			fut = self._fetched.get(browse_id)
+			owner = fut is None
+			if owner:
+				fut = self._fetched[browse_id] = Future()
+		if not owner:
+			return fut.result() # type: ignore
+		lyrics = None
+		try:
+			lyrics = self._fetch(browse_id)
+		finally:
+			fut.set_result(lyrics) # type: ignore
+		return lyrics
+
+	def _fetch(self, browse_id: str):
+		if self.cache is not None:
+			hit, lyrics = self.cache.get(browse_id)
+			if hit:
+				return lyrics
+		try:
+			lyrics_data = self.ytmusic.get_lyrics(browse_id)
+		except Exception:
+			return None # don't cache, might just be a network hiccup
+		lyrics = lyrics_data["lyrics"] if lyrics_data is not None and lyrics_data.get("lyrics") else None
+		if self.cache is not None:
+			self.cache.put(browse_id, lyrics)
+		return lyrics
+
+	def shutdown(self):
+		self._pool.shutdown(wait=True)
+		if self.cache is not None:
+			self.cache.close()
@@ -0,0 +1,91 @@
+"""
+persistent scan manifest of mbtag: for every file under a library root, its inode, size and mtime
+and what mbtag found in it last time. files that didn't change since aren't opened again,
+unless what was found depends on the flags of this run (see can_skip).
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+from typing import TypedDict
+
+from requests_cache.backends.sqlite import get_cache_path
+
+MANIFEST_NAME = "shira_mbtag_manifest.sqlite"
+# what a file was found to be
+NOT_SONG = "not_song"
+NO_TITLE = "no_title" # no title or artist to search for
+COMPLETE = "complete" # has every mbid tag
+PARTIAL = "partial" # has some mbid tags
+UNMATCHED = "unmatched" # searched, nothing matched
+PENDING = "pending" # not done yet: the lookup failed, or --dry-run didn't write what it found
+
+
+class ManifestEntry(TypedDict):
+	inode: int
+	size: int
+	mtime_ns: int
+	status: str
+	checked: float
+
+
+def get_file_state(path: str):
+	""":returns (inode, size, mtime_ns), a file with the same ones is assumed unchanged"""
+	stat = os.stat(path)
+	return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def is_unchanged(entry: ManifestEntry, state: tuple[int, int, int]):
+	return (entry["inode"], entry["size"], entry["mtime_ns"]) == state
+
+
+def can_skip(entry: ManifestEntry, fetch_complete: bool, fetch_partial: bool, miss_ttl: int):
+	"""whether an unchanged file would come out the same as last time"""
+	status = entry["status"]
+	if status in (NOT_SONG, NO_TITLE):
+		return True
+	if status == COMPLETE:
+		return not fetch_complete
+	if status == PARTIAL:
+		return not (fetch_complete or fetch_partial)
+	if status == UNMATCHED: # searched again once the match cache forgets the miss
+		return entry["checked"] + miss_ttl > time.time()
+	return False
+
+
+class ScanManifest:
+	"""paths are kept relative to the root they were scanned under, every root has its own entries"""
+	def __init__(self, db_path: Path | str = MANIFEST_NAME, use_cache_dir = True):
+		self.db_path = get_cache_path(db_path, use_cache_dir=use_cache_dir)
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+		with self._lock, self._conn:
+			self._conn.execute("PRAGMA journal_mode=WAL")
+			self._conn.execute(
+				"CREATE TABLE IF NOT EXISTS files (root TEXT, path TEXT, inode INTEGER, size INTEGER, mtime_ns INTEGER, status TEXT, checked REAL,"
+				" PRIMARY KEY (root, path)) WITHOUT ROWID"
+			)
+
+	def load(self, root: str) -> dict[str, ManifestEntry]:
+		""":returns relative path => entry, for every file under root"""
+		with self._lock:
+			rows = self._conn.execute("SELECT path, inode, size, mtime_ns, status, checked FROM files WHERE root = ?", (root,)).fetchall()
+		return { path: { "inode": inode, "size": size, "mtime_ns": mtime_ns, "status": status, "checked": checked } for path, inode, size, mtime_ns, status, checked in rows }
+
+	def update(self, root: str, entries: Iterable[tuple[str, ManifestEntry]]):
+		with self._lock, self._conn:
+			self._conn.executemany(
+				"INSERT OR REPLACE INTO files (root, path, inode, size, mtime_ns, status, checked) VALUES (?, ?, ?, ?, ?, ?, ?)",
+				((root, path, e["inode"], e["size"], e["mtime_ns"], e["status"], e["checked"]) for path, e in entries)
+			)
+
+	def forget(self, root: str, paths: Iterable[str]):
+		"""deletes the entries of files that are gone"""
+		with self._lock, self._conn:
+			self._conn.executemany("DELETE FROM files WHERE root = ? AND path = ?", ((root, path) for path in paths))
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
@@ -0,0 +1,374 @@
+"""
+offline MusicBrainz: a local index of a MusicBrainz data dump, searched instead of /ws/2 (see MBSong's dump_index).
+no rate limit and no network, so bulk retagging runs at thousands of lookups per second.
+
+the index is a SQLite database: recordings, releases, release groups and artist credits,
+plus FTS5 tables over the normalized (musicbrainz.normalize) titles and artist names. it can be built from
+- the JSON dump of releases (release.tar.xz from https://data.metabrainz.org/pub/musicbrainz/data/json-dumps/,
+  or the extracted mbdump/release file), one release per line with media, tracks and recordings
+- the extracted mbdump folder of the TSV (postgres) dump, mbdump.tar.bz2 and mbdump-derived.tar.bz2
+
+mbdump import <dump> [--index path], then mbtag --dump-index path / shiradl --mb-dump-index path
+"""
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import sqlite3
+import tarfile
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import click
+from requests_cache.backends.sqlite import get_cache_path
+
+from .musicbrainz import MBArtist, MBRecording, normalize
+
+DUMP_INDEX_NAME = "shira_musicbrainz_dump.sqlite"
+SEARCH_LIMIT = 25 # recordings per search, like a /ws/2 result page
+IMPORT_BATCH = 10000 # rows inserted at once
+TOKEN_RE = re.compile(r"\w+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS credits (id TEXT PRIMARY KEY, json TEXT); -- artist credit, as /ws/2 'artist-credit'
+CREATE TABLE IF NOT EXISTS artists (id TEXT PRIMARY KEY, name TEXT, sort_name TEXT);
+CREATE TABLE IF NOT EXISTS release_groups (id TEXT PRIMARY KEY, title TEXT, primary_type TEXT);
+CREATE TABLE IF NOT EXISTS releases (id TEXT PRIMARY KEY, title TEXT, date TEXT, credit TEXT, release_group TEXT);
+CREATE TABLE IF NOT EXISTS recordings (rid INTEGER PRIMARY KEY, id TEXT UNIQUE, title TEXT, credit TEXT, first_release_date TEXT);
+CREATE TABLE IF NOT EXISTS recording_releases (rid INTEGER, release TEXT, PRIMARY KEY (rid, release)) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS recordings_fts USING fts5(title, artist, release, content='', tokenize='unicode61 remove_diacritics 2');
+CREATE VIRTUAL TABLE IF NOT EXISTS artists_fts USING fts5(name, sort_name, content='', tokenize='unicode61 remove_diacritics 2');
+"""
+
+# TSV dump tables: (file in mbdump/, staging table, columns used (by position), optional)
+TSV_TABLES = [
+	("artist", "t_artist", { 0: "id", 1: "gid", 2: "name", 3: "sort_name" }, False),
+	("artist_credit_name", "t_acn", { 0: "credit", 1: "position", 2: "artist", 3: "name", 4: "join_phrase" }, False),
+	("release_group_primary_type", "t_rgtype", { 0: "id", 1: "name" }, False),
+	("release_group", "t_rg", { 0: "id", 1: "gid", 2: "name", 4: "type" }, False),
+	("release", "t_release", { 0: "id", 1: "gid", 2: "name", 3: "credit", 4: "release_group" }, False),
+	("release_country", "t_rdate", { 0: "release", 2: "y", 3: "m", 4: "d" }, True),
+	("release_unknown_country", "t_rdate", { 0: "release", 1: "y", 2: "m", 3: "d" }, True),
+	("medium", "t_medium", { 0: "id", 1: "release" }, False),
+	("track", "t_track", { 2: "recording", 3: "medium" }, False),
+	("recording", "t_recording", { 0: "id", 1: "gid", 2: "name", 3: "credit" }, False),
+	("recording_first_release_date", "t_frd", { 0: "recording", 1: "y", 2: "m", 3: "d" }, True), # in mbdump-derived
+]
+TSV_ESCAPES = { "\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\r": "\r" }
+TSV_ESCAPE_RE = re.compile(r"\\[\\tnr]")
+
+
+def format_date(y, m, d):
+	""":returns YYYY, YYYY-MM or YYYY-MM-DD, None without a year"""
+	if y is None:
+		return None
+	if m is None:
+		return f"{int(y):04d}"
+	if d is None:
+		return f"{int(y):04d}-{int(m):02d}"
+	return f"{int(y):04d}-{int(m):02d}-{int(d):02d}"
+
+
+def get_credit_names(credit_json: str | None):
+	"""credited names, artist names and sort names of an artist credit, for the fts"""
+	if credit_json is None:
+		return ""
+	names = []
+	for c in json.loads(credit_json):
+		names += [c.get("name", ""), c["artist"].get("name", ""), c["artist"].get("sort-name", "")]
+	return " ".join(names)
+
+
+def get_fts_query(columns: dict[str, str]):
+	""":param columns: column => text, every (normalized) word of it is required in that column"""
+	terms = []
+	for column, text in columns.items():
+		terms += [f'{column} : "{token}"' for token in TOKEN_RE.findall(normalize(text))]
+	return " AND ".join(terms)
+
+
+def open_dump_file(path: Path, name: str) -> Iterator[str]:
+	""":returns the lines of a (possibly compressed, possibly tarred) dump file. name is the file looked for inside a tar"""
+	if tarfile.is_tarfile(path):
+		with tarfile.open(path) as tar:
+			for member in tar:
+				if member.isfile() and Path(member.name).name == name:
+					f = tar.extractfile(member)
+					if f is not None:
+						yield from (line.decode("utf8") for line in f)
+					return
+		raise click.ClickException(f"no '{name}' in {path}")
+	opener = { ".xz": lzma.open, ".gz": gzip.open, ".bz2": bz2.open }.get(path.suffix, open)
+	with opener(path, "rt", encoding="utf8") as f:
+		yield from f
+
+
+class MBDumpIndex:
+	"""
+	read side of the index: search_recordings / search_artists return what /ws/2/recording and /ws/2/artist
+	searches would (the fields MBSong uses), so MBSong.save_song_dict / save_artist_dict work on them as they are
+	"""
+	def __init__(self, db_path: Path | str = DUMP_INDEX_NAME, use_cache_dir = True):
+		self.db_path = get_cache_path(db_path, use_cache_dir=use_cache_dir)
+		if not self.db_path.exists():
+			raise FileNotFoundError(f"no MusicBrainz dump index at {self.db_path}, create it with 'mbdump import'")
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+	def _search(self, table: str, query: str, limit: int):
+		if query == "":
+			return []
+		with self._lock:
+			return [row[0] for row in self._conn.execute(f"SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rank LIMIT ?", (query, limit))]
+
+	def search_recordings(self, title: str, artist: str, album: str, limit = SEARCH_LIMIT) -> list[MBRecording]:
+		"""recordings with every word of title and artist, the ones also on a release called like album first"""
+		rids = self._search("recordings_fts", get_fts_query({ "title": title, "artist": artist, "release": album }), limit)
+		if len(rids) < limit:
+			rids += [rid for rid in self._search("recordings_fts", get_fts_query({ "title": title, "artist": artist }), limit) if rid not in rids]
+		return [self._get_recording(rid) for rid in rids[:limit]]
+
+	def search_artists(self, artist: str, limit = SEARCH_LIMIT) -> list[MBArtist]:
+		rowids = self._search("artists_fts", get_fts_query({ "{name sort_name}": artist }), limit)
+		with self._lock:
+			rows = [self._conn.execute("SELECT id, name, sort_name FROM artists WHERE rowid = ?", (rowid,)).fetchone() for rowid in rowids]
+		return [{ "id": id, "name": name, "sort-name": sort_name } for id, name, sort_name in rows]
+
+	def _get_recording(self, rid: int) -> MBRecording:
+		with self._lock:
+			id, title, credit, first_release_date = self._conn.execute(
+				"SELECT r.id, r.title, c.json, r.first_release_date FROM recordings r LEFT JOIN credits c ON c.id = r.credit WHERE r.rid = ?", (rid,)
+			).fetchone()
+			releases = self._conn.execute(
+				"SELECT rel.id, rel.title, rel.date, c.json, rg.id, rg.title, rg.primary_type FROM recording_releases rr"
+				" JOIN releases rel ON rel.id = rr.release LEFT JOIN credits c ON c.id = rel.credit LEFT JOIN release_groups rg ON rg.id = rel.release_group"
+				" WHERE rr.rid = ? ORDER BY rel.date IS NULL, rel.date", (rid,)
+			).fetchall()
+		recording = { "id": id, "title": title, "artist-credit": json.loads(credit) if credit is not None else [], "releases": [] }
+		if first_release_date is not None:
+			recording["first-release-date"] = first_release_date
+		for rel_id, rel_title, date, rel_credit, rg_id, rg_title, rg_type in releases:
+			release = { "id": rel_id, "title": rel_title, "release-group": { "id": rg_id, "title": rg_title, "primary-type": rg_type } }
+			if rel_credit is not None:
+				release["artist-credit"] = json.loads(rel_credit)
+			if date is not None:
+				release["date"] = date
+			recording["releases"].append(release)
+		return recording # type: ignore
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
+
+
+class MBDumpImporter:
+	"""builds an index into a temporary file next to db_path and moves it in place once complete"""
+	def __init__(self, db_path: Path):
+		self.db_path = db_path
+		self.part_path = db_path.with_name(db_path.name + ".part")
+		self.part_path.unlink(missing_ok=True)
+		self.conn = sqlite3.connect(self.part_path, isolation_level=None)
+		self.conn.execute("PRAGMA journal_mode=OFF") # a failed import is thrown away anyway
+		self.conn.execute("PRAGMA synchronous=OFF")
+		self.conn.create_function("normalize", 1, lambda text: normalize(text) if text is not None else "", deterministic=True)
+		self.conn.create_function("credit_names", 1, get_credit_names, deterministic=True)
+		self.conn.create_function("format_date", 3, format_date, deterministic=True)
+		self.conn.executescript(SCHEMA)
+
+	def _insert(self, table: str, columns: tuple[str, ...], rows: Iterable[tuple], ignore = True):
+		sql = f"INSERT {'OR IGNORE ' if ignore else ''}INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+		batch = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= IMPORT_BATCH:
+				self.conn.executemany(sql, batch)
+				batch = []
+		self.conn.executemany(sql, batch)
+
+	# json dump
+
+	def _credit(self, credit: list | None, credits: dict, artists: dict):
+		""":returns the id of an artist credit, collecting it and its artists"""
+		if not credit:
+			return None
+		credit = [{ "name": c.get("name", c["artist"]["name"]), "joinphrase": c.get("joinphrase", ""), "artist": {
+			"id": c["artist"]["id"], "name": c["artist"]["name"], "sort-name": c["artist"].get("sort-name", c["artist"]["name"])
+		} } for c in credit]
+		credit_json = json.dumps(credit, ensure_ascii=False)
+		credit_id = hashlib.sha1(credit_json.encode("utf8")).hexdigest()
+		credits[credit_id] = credit_json
+		for c in credit:
+			artists[c["artist"]["id"]] = (c["artist"]["id"], c["artist"]["name"], c["artist"]["sort-name"])
+		return credit_id
+
+	def import_json(self, lines: Iterable[str]):
+		""":param lines: of the release json dump, one release (with media, tracks and their recordings) per line"""
+		count = 0
+		credits, artists, recordings, recording_releases, releases, release_groups = {}, {}, {}, [], [], {}
+		for line in lines:
+			if line.strip() == "":
+				continue
+			rel = json.loads(line)
+			rel_credit = self._credit(rel.get("artist-credit"), credits, artists)
+			rg = rel.get("release-group")
+			if rg is not None:
+				release_groups[rg["id"]] = (rg["id"], rg.get("title"), rg.get("primary-type"))
+			releases.append((rel["id"], rel["title"], rel.get("date") or None, rel_credit, rg["id"] if rg is not None else None))
+			for medium in rel.get("media", []):
+				tracks = medium.get("tracks", []) + medium.get("data-tracks", []) + ([medium["pregap"]] if medium.get("pregap") else [])
+				for track in tracks:
+					rec = track.get("recording")
+					if rec is None:
+						continue
+					if rec["id"] not in recordings:
+						rec_credit = self._credit(rec.get("artist-credit") or track.get("artist-credit"), credits, artists)
+						recordings[rec["id"]] = (rec["id"], rec["title"], rec_credit, rec.get("first-release-date") or None)
+					recording_releases.append((rec["id"], rel["id"]))
+			count += 1
+			if count % IMPORT_BATCH == 0:
+				self._flush_json(credits, artists, recordings, recording_releases, releases, release_groups)
+		self._flush_json(credits, artists, recordings, recording_releases, releases, release_groups)
+		return count
+
+	def _flush_json(self, credits: dict, artists: dict, recordings: dict, recording_releases: list, releases: list, release_groups: dict):
+		self._insert("credits", ("id", "json"), credits.items())
+		self._insert("artists", ("id", "name", "sort_name"), artists.values())
+		self._insert("release_groups", ("id", "title", "primary_type"), release_groups.values())
+		self._insert("releases", ("id", "title", "date", "credit", "release_group"), releases)
+		self._insert("recordings", ("id", "title", "credit", "first_release_date"), recordings.values())
+		self.conn.executemany(
+			"INSERT OR IGNORE INTO recording_releases (rid, release) SELECT rid, ? FROM recordings WHERE id = ?",
+			((release, rec_id) for rec_id, release in recording_releases)
+		)
+		for collected in (credits, artists, recordings, release_groups):
+			collected.clear()
+		recording_releases.clear()
+		releases.clear()
+
+	# tsv dump
+
+	def _read_tsv(self, path: Path, columns: dict[int, str]):
+		with open(path, encoding="utf8", newline="\n") as f:
+			for line in f:
+				fields = line.rstrip("\n").split("\t")
+				yield tuple(
+					None if fields[i] == "\\N" else TSV_ESCAPE_RE.sub(lambda m: TSV_ESCAPES[m.group(0)], fields[i])
+					for i in columns
+				)
+
+	def import_tsv(self, folder: Path):
+		""":param folder: the extracted mbdump folder, with the tables of TSV_TABLES"""
+		for file_name, table, columns, optional in TSV_TABLES:
+			self.conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} ({', '.join(columns.values())})")
+			if not (folder / file_name).exists():
+				if optional:
+					continue
+				raise click.ClickException(f"'{file_name}' not found in {folder}")
+			self._insert(table, tuple(columns.values()), self._read_tsv(folder / file_name, columns), ignore=False)
+		self.conn.executescript("""
+			CREATE INDEX temp.t_artist_id ON t_artist (id);
+			CREATE INDEX temp.t_acn_credit ON t_acn (credit, position);
+			CREATE INDEX temp.t_rdate_release ON t_rdate (release);
+			CREATE INDEX temp.t_medium_id ON t_medium (id);
+			CREATE INDEX temp.t_release_id ON t_release (id);
+			CREATE INDEX temp.t_rg_id ON t_rg (id);
+			CREATE INDEX temp.t_frd_recording ON t_frd (recording);
+
+			INSERT INTO artists (id, name, sort_name) SELECT gid, name, sort_name FROM t_artist;
+			INSERT INTO credits (id, json)
+				SELECT credit, json_group_array(json_object('name', name, 'joinphrase', COALESCE(join_phrase, ''), 'artist', json(artist)))
+				FROM (
+					SELECT acn.credit, acn.name, acn.join_phrase, json_object('id', a.gid, 'name', a.name, 'sort-name', a.sort_name) AS artist
+					FROM t_acn acn JOIN t_artist a ON a.id = acn.artist ORDER BY acn.credit, CAST(acn.position AS INTEGER)
+				) GROUP BY credit;
+			INSERT INTO release_groups (id, title, primary_type)
+				SELECT rg.gid, rg.name, t.name FROM t_rg rg LEFT JOIN t_rgtype t ON t.id = rg.type;
+			INSERT INTO releases (id, title, date, credit, release_group)
+				SELECT r.gid, r.name, (
+					SELECT format_date(y, m, d) FROM t_rdate WHERE release = r.id AND y IS NOT NULL
+					ORDER BY CAST(y AS INTEGER), CAST(m AS INTEGER) IS NULL, CAST(m AS INTEGER), CAST(d AS INTEGER) IS NULL, CAST(d AS INTEGER) LIMIT 1
+				), r.credit, rg.gid
+				FROM t_release r LEFT JOIN t_rg rg ON rg.id = r.release_group;
+			INSERT INTO recordings (rid, id, title, credit, first_release_date)
+				SELECT rec.id, rec.gid, rec.name, rec.credit, (SELECT format_date(y, m, d) FROM t_frd WHERE recording = rec.id)
+				FROM t_recording rec;
+			INSERT OR IGNORE INTO recording_releases (rid, release)
+				SELECT t.recording, r.gid FROM t_track t JOIN t_medium m ON m.id = t.medium JOIN t_release r ON r.id = m.release;
+		""")
+		for _, table, _, _ in TSV_TABLES:
+			self.conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+		return self.conn.execute("SELECT COUNT(*) FROM releases").fetchone()[0]
+
+	def finish(self):
+		"""fills the fts tables and moves the index in place"""
+		self.conn.executescript("""
+			INSERT INTO recordings_fts (rowid, title, artist, release)
+				SELECT rec.rid, normalize(rec.title), normalize(credit_names(c.json)), (
+					SELECT normalize(group_concat(rel.title, ' ')) FROM recording_releases rr JOIN releases rel ON rel.id = rr.release WHERE rr.rid = rec.rid
+				)
+				FROM recordings rec LEFT JOIN credits c ON c.id = rec.credit;
+			INSERT INTO artists_fts (rowid, name, sort_name) SELECT rowid, normalize(name), normalize(sort_name) FROM artists;
+			INSERT INTO recordings_fts (recordings_fts) VALUES ('optimize');
+			INSERT INTO artists_fts (artists_fts) VALUES ('optimize');
+		""")
+		counts = { table: self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("recordings", "releases", "artists") }
+		self.conn.close()
+		os.replace(self.part_path, self.db_path)
+		return counts
+
+	def abort(self):
+		self.conn.close()
+		self.part_path.unlink(missing_ok=True)
+
+
+def import_dump(dump: Path, db_path: Path, dump_format = "auto"):
+	"""
+	:param dump: release json dump (file, .xz/.gz/.bz2 or .tar.xz) or extracted TSV mbdump folder
+	:returns rows imported per table
+	"""
+	if dump_format == "auto":
+		dump_format = "tsv" if dump.is_dir() else "json"
+	importer = MBDumpImporter(db_path)
+	try:
+		if dump_format == "tsv":
+			importer.import_tsv(dump)
+		else:
+			importer.import_json(open_dump_file(dump, "release"))
+		return importer.finish()
+	except BaseException:
+		importer.abort()
+		raise
+
+
+@click.group()
+def mbdump_cli():
+	"""Local MusicBrainz dump index, for offline mbtag / shiradl lookups."""
+
+@mbdump_cli.command("import")
+@click.argument("dump", type=click.Path(exists=True, path_type=Path))
+@click.option("--index", type=Path, default=None, help=f"Where to save the index. Defaults to {DUMP_INDEX_NAME} in the user cache folder.")
+@click.option("--format", "dump_format", type=click.Choice(["auto", "json", "tsv"]), default="auto", help="'json': the release JSON dump, 'tsv': the extracted mbdump folder. 'auto' picks tsv for folders.")
+def import_cli(dump: Path, index: Path | None, dump_format: str):
+	"""Build the index from a MusicBrainz dump, replacing the previous one."""
+	db_path = get_cache_path(index if index is not None else DUMP_INDEX_NAME, use_cache_dir=index is None)
+	counts = import_dump(dump, db_path, dump_format)
+	print(f"[ok] indexed {counts['recordings']} recordings, {counts['releases']} releases and {counts['artists']} artists into {db_path}")
+
+@mbdump_cli.command("search")
+@click.argument("title")
+@click.argument("artist")
+@click.argument("album", default="")
+@click.option("--index", type=Path, default=None, help="Index to search, see 'mbdump import --index'.")
+def search_cli(title: str, artist: str, album: str, index: Path | None):
+	"""Print the recordings the index finds for a song, like MBSong would search them."""
+	dump_index = MBDumpIndex(index if index is not None else DUMP_INDEX_NAME, use_cache_dir=index is None)
+	for rec in dump_index.search_recordings(title, artist, album):
+		artists = "".join(c["name"] + c.get("joinphrase", "") for c in rec["artist-credit"])
+		print(f"{rec['id']}  {artists} - {rec['title']} (on {', '.join(r['title'] for r in rec['releases'])})")
+
+if __name__ == "__main__":
+	mbdump_cli()
@@ -1,61 +1,263 @@
 import json
 import os
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import groupby
+from pathlib import Path
 
 import click
 from mediafile import FileTypeError, MediaFile
 
-from .musicbrainz import MBSong
+from .manifest import (
+	COMPLETE,
+	NO_TITLE,
+	NOT_SONG,
+	PARTIAL,
+	PENDING,
+	UNMATCHED,
+	ManifestEntry,
+	ScanManifest,
+	can_skip,
+	get_file_state,
+	is_unchanged,
+)
+from .mbdump import MBDumpIndex
+from .musicbrainz import MISS_TTL, MBAlbum, MBMatchCache, MBSong
 from .util import TermColors, end_path, pprint, progprint
 
 # Define supported extensions list using the keys from the TYPES dictionary
 SONG_EXTS = ["mp3", "aac", "alac", "ogg", "opus", "flac", "ape", "wv", "mpc", "asf", "aiff", "dsf", "wav"]
+# files next to songs that are never songs, not even opened. any other extension is tried
+NON_SONG_EXTS = ["jpg", "jpeg", "png", "webp", "gif", "bmp", "txt", "lrc", "nfo", "log", "cue", "m3u", "m3u8", "json", "pdf", "sfv", "md5", "ini", "db"]
 MBID_TAG_KEYS = ["mb_releasetrackid", "mb_releasegroupid", "mb_artistid", "mb_albumartistid"]
+DEFAULT_JOBS = 4
+MANIFEST_FLUSH_EVERY = 1000 # entries written to the scan manifest at once
+FOLDER_CHUNK = 64 # files of a folder kept open at once
+ALBUM_MIN_SONGS = 2 # songs of an album in a folder it takes to look the release up instead of searching for each
+SongResult = tuple[tuple[int, int, int], str, str | None] # (file state after processing, what it was found to be, status message), see manifest
+print_lock = threading.Lock() # workers print dry-run / debug output, the main thread the progress bar
 
-# Function to check if a file is a supported song file
-def is_supported_song_file(filename):
-	ext = os.path.splitext(filename)[1][1:]
-	if ext.lower() in SONG_EXTS:
-		return True
-	try:
-		MediaFile(filename)
-		return True
-	except FileTypeError:
-		return False
+# Function to check if a file could be a song, by its name only
+def is_song_candidate(filename: str):
+	ext = os.path.splitext(filename)[1][1:].lower()
+	return ext in SONG_EXTS or ext not in NON_SONG_EXTS
+
+
+def scan_library(path: str) -> Iterator[str]:
+	"""
+	yields the files under path that could be songs (see is_song_candidate), in a stable order.
+	os.scandir gets file types from the directory listing, so nothing is stat-ed or opened here
+	"""
+	if os.path.isfile(path):
+		yield path
+		return
+	dirs = [path]
+	while len(dirs) > 0:
+		directory = dirs.pop()
+		try:
+			with os.scandir(directory) as it:
+				entries = sorted(it, key=lambda entry: entry.name)
+		except OSError as e:
+			print(f"[error]: couldn't list '{directory}': {e}")
+			continue
+		subdirs = []
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				subdirs.append(entry.path)
+			elif entry.is_file() and is_song_candidate(entry.name):
+				yield entry.path
+		dirs.extend(reversed(subdirs))
 
 
-def process_directory(directory_or_file: click.Path, fetch_complete: bool, fetch_partial: bool, dry_run: bool, debug: bool):
+def process_directory(
+	directory_or_file: click.Path,
+	fetch_complete: bool,
+	fetch_partial: bool,
+	dry_run: bool,
+	debug: bool,
+	match_cache: MBMatchCache | None = None,
+	dump_index: MBDumpIndex | None = None,
+	jobs = DEFAULT_JOBS,
+	manifest: ScanManifest | None = None,
+	rescan = False,
+	miss_ttl = MISS_TTL,
+	album_lookup = True,
+):
+	"""
+	processes every song under directory_or_file, jobs at once. musicbrainz requests still respect its rate limit.
+	the files of a folder are parsed FOLDER_CHUNK at a time (each once, its handle kept until it's written),
+	then every song of the chunk is looked up and written on its own, so one big folder is spread over all workers too.
+	:param manifest: skip files that didn't change since the last run, see manifest.can_skip. only read with dry_run
+	:param rescan: process every file, and rebuild the manifest
+	:param album_lookup: songs of the same album (see get_album_key) that aren't in the match cache are matched against the tracklist
+	of the album's release, looked up once per folder (see resolve_albums), instead of searching for each one. songs not on it are searched on their own
+	"""
 	if not os.path.exists(str(directory_or_file)):
 		print(f"[error]: Path '{directory_or_file}' does not exist.")
 		return
-	if os.path.isfile(str(directory_or_file)):
-		process_song(str(directory_or_file), 0, 1, fetch_complete, fetch_partial, dry_run, debug)
-		print()
-		return
-	for root, _, files in os.walk(str(directory_or_file)):
-		for i in range(len(files)):
-			f = files[i]
-			filepath = os.path.join(root, f)
-			if not is_supported_song_file(filepath):
-				continue
-			try:
-				process_song(filepath, i, len(files), fetch_complete, fetch_partial, dry_run, debug)
-				# print()
-			except Exception as e:
-				print(f"Error processing song '{filepath}':")
-				print(e)
-		progprint(100, 100, message=f"Processed all files in {end_path(root, 2)}")
+	root = str(directory_or_file)
+	paths = list(scan_library(root))
+	stored = manifest.load(root) if manifest is not None else {} # still read with rescan, to forget the files that are gone
+	entries = stored if not rescan else {}
+	updated: list[tuple[str, ManifestEntry]] = []
+	done = 0
+	songs = 0
+	unchanged = 0
+
+	def report(path: str, result: SongResult | Exception | None):
+		nonlocal done, songs, unchanged
+		done += 1
+		if isinstance(result, Exception):
+			with print_lock:
+				print(f"Error processing song '{path}':")
+				print(result)
+			return
+		if result is None:
+			unchanged += 1
+			return
+		state, status, msg = result
+		if manifest is not None and not dry_run:
+			inode, size, mtime_ns = state
+			updated.append((os.path.relpath(path, root), { "inode": inode, "size": size, "mtime_ns": mtime_ns, "status": status, "checked": time.time() }))
+			if len(updated) >= MANIFEST_FLUSH_EVERY:
+				manifest.update(root, updated)
+				updated.clear()
+		if msg is None: # not a song
+			return
+		songs += 1
+		with print_lock:
+			progprint(done, len(paths), message=f"{end_path(path, 2)} {msg}")
+
+	def report_future(fut: Future, path: str):
+		try:
+			report(path, fut.result())
+		except Exception as e:
+			report(path, e)
+
+	with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="mbtag") as pool:
+		running: dict[Future, str] = {}
+
+		def collect(limit: int):
+			"""reports the songs that are done, waits until at most limit are still being looked up / written"""
+			while len(running) > 0:
+				finished, _ = wait(running, timeout=None if len(running) > limit else 0, return_when=FIRST_COMPLETED)
+				if len(finished) == 0:
+					return
+				for fut in finished:
+					report_future(fut, running.pop(fut))
+
+		for _, folder in groupby(paths, key=os.path.dirname): # scan_library lists the files of a folder together
+			folder = list(folder)
+			albums: dict[tuple[str, str], MBAlbum | None] = {} # None if no release was found
+			for i in range(0, len(folder), FOLDER_CHUNK):
+				collect(jobs * 2) # at most a chunk and 2 songs per worker in flight, not the whole library
+				chunk = folder[i:i + FOLDER_CHUNK]
+				opening = [pool.submit(prepare_song, path, entries.get(os.path.relpath(path, root)), fetch_complete, fetch_partial, miss_ttl) for path in chunk]
+				opened: list[tuple[str, tuple[int, int, int], MediaFile]] = []
+				for path, fut in zip(chunk, opening):
+					try:
+						state, handle, result = fut.result()
+					except Exception as e:
+						report(path, e)
+						continue
+					if handle is None:
+						report(path, result)
+					else:
+						opened.append((path, state, handle))
+
+				if album_lookup and dump_index is None: # local lookups are cheap, no point in grouping them
+					resolve_albums([handle for _, _, handle in opened], albums, debug, match_cache)
+				for path, state, handle in opened:
+					key = get_album_key(handle)
+					album = albums.get(key) if key is not None else None
+					running[pool.submit(tag_song, handle, path, state, album, dry_run, debug, match_cache, dump_index)] = path
+		collect(0)
+	if manifest is not None and not dry_run:
+		manifest.update(root, updated)
+		manifest.forget(root, stored.keys() - { os.path.relpath(path, root) for path in paths })
+	progprint(100, 100, message=f"Processed {songs} songs in {end_path(root, 2)}, {unchanged} unchanged files skipped")
 	print()
 
 
-def has_all_mbid_tags(handle: MediaFile):
+def get_album_key(handle: MediaFile):
+	"""(album artist, album) the song is grouped by within its folder, None if it has no album"""
+	if handle.album is None or handle.album == "":
+		return None
+	return str(handle.albumartist or handle.artist), str(handle.album)
+
+
+def prepare_song(path: str, entry: ManifestEntry | None, fetch_complete: bool, fetch_partial: bool, miss_ttl = MISS_TTL):
+	"""
+	parses the file, unless it didn't change since its manifest entry and can be skipped (see manifest.can_skip).
+	:returns (file state, handle, None) if it should be looked up, (file state, None, SongResult) if not, (file state, None, None) if it was skipped
+	"""
+	state = get_file_state(path)
+	if entry is not None and is_unchanged(entry, state) and can_skip(entry, fetch_complete, fetch_partial, miss_ttl):
+		return state, None, None
+	handle, status, msg = open_song(path, fetch_complete, fetch_partial)
+	if handle is None:
+		return state, None, (state, status, msg)
+	return state, handle, None
+
+
+def tag_song(
+	handle: MediaFile,
+	path: str,
+	state: tuple[int, int, int],
+	album: MBAlbum | None = None,
+	dry_run=False,
+	debug=False,
+	match_cache: MBMatchCache | None = None,
+	dump_index: MBDumpIndex | None = None,
+) -> SongResult:
+	"""looks up a song prepare_song opened and writes its ids, see lookup_song and write_song"""
+	mb, failed = lookup_song(handle, path, debug, match_cache, dump_index, album)
+	status, msg = write_song(handle, mb, failed, path, dry_run, debug)
+	if status in (COMPLETE, PARTIAL, UNMATCHED) and not dry_run:
+		state = get_file_state(path) # the ids were just written
+	return state, status, msg
+
+
+def resolve_albums(handles: list[MediaFile], albums: dict[tuple[str, str], MBAlbum | None], debug=False, match_cache: MBMatchCache | None = None):
+	"""
+	looks up the release of every album at least ALBUM_MIN_SONGS of handles still need to be searched for, adding it to albums.
+	albums already in albums aren't looked up again
+	"""
+	pending: dict[tuple[str, str], int] = {}
+	for handle in handles:
+		key = get_album_key(handle)
+		if key is None or key in albums or handle.title is None or handle.artist is None:
+			continue
+		if match_cache is not None and match_cache.get(MBMatchCache.get_key(str(handle.title), str(handle.artist), str(handle.album))) is not None:
+			continue
+		pending[key] = pending.get(key, 0) + 1
+	for key, count in pending.items():
+		if count < ALBUM_MIN_SONGS: # a single song is 1 search, its release would be 2 requests
+			continue
+		albumartist, album = key
+		mb_album = MBAlbum(album, albumartist, debug=debug)
+		try:
+			albums[key] = mb_album if mb_album.fetch_release(count) else None
+		except Exception as e:
+			albums[key] = None
+			with print_lock:
+				print(f"coundn't fetch the release of '{album}' from musicbrainz, searching its songs one by one: {e}")
+
+
+def read_mbid_tags(handle: MediaFile):
+	"""only the mbid fields, as_dict() would decode every tag including embedded covers"""
+	return { key: getattr(handle, key) for key in MBID_TAG_KEYS }
+
+
+def has_all_mbid_tags(mbid_tags: dict[str, str | None]):
 	"""these files are skipped alltogether"""
-	handle_dict = handle.as_dict()
-	return all(handle_dict.get(key) is not None for key in MBID_TAG_KEYS)
+	return all(mbid_tags.get(key) is not None for key in MBID_TAG_KEYS)
 
 
-def no_of_mbid_tags(handle: MediaFile):
-	handle_dict = handle.as_dict()
-	return sum([handle_dict.get(key) is not None for key in MBID_TAG_KEYS])
+def no_of_mbid_tags(mbid_tags: dict[str, str | None]):
+	return sum([mbid_tags.get(key) is not None for key in MBID_TAG_KEYS])
 
 def red_if_none(val: str | None):
 	if val is None:
@@ -64,29 +266,43 @@ def red_if_none(val: str | None):
 		return val
 
 
-def process_song(filepath: str, ind: int, total: int, fetch_complete: bool, fetch_partial: bool, dry_run=False, debug=False):
-	handle = MediaFile(filepath)
-	has_all = has_all_mbid_tags(handle)
-	has_some = no_of_mbid_tags(handle)
-	status = f"[song] {end_path(filepath, 2)}, has_all: {has_all}, has_some: {has_some}"
-	progprint(ind, total, message=status)
-	# pprint(handle.as_dict(), True)
+def open_song(filepath: str, fetch_complete: bool, fetch_partial: bool):
+	"""
+	parses the file and decides if it should be looked up.
+	:returns (handle, None, None) if it should, (None, what the file was found to be, see manifest, status message) if not.
+	the message is None if the file isn't a song
+	"""
+	try:
+		handle = MediaFile(filepath)
+	except FileTypeError:
+		return None, NOT_SONG, None
+	mbid_tags = read_mbid_tags(handle)
+	has_all = has_all_mbid_tags(mbid_tags)
+	has_some = no_of_mbid_tags(mbid_tags)
 
 	# by default, partials and completes are not fetched
 	continue_partials = has_some == 0 or (has_some > 0 and (fetch_partial or fetch_complete))
 	continue_complete = not has_all or (has_all and fetch_complete)
-	# print(f"continue_partials: {continue_partials}, continue_complete: {continue_complete}  ")
 
 	if not (continue_partials and continue_complete):
-		msg = f"[skipped] check args for fetching complete or partial songs. c:{int(not continue_complete)}, p:{int(not continue_partials)}  "
-		progprint(ind, total, message=msg)
-		# print(msg)
-		return
+		return None, COMPLETE if has_all else PARTIAL, f"[skipped] check args for fetching complete or partial songs. c:{int(not continue_complete)}, p:{int(not continue_partials)}  "
 	if handle.title is None or handle.artist is None:
-		msg = "[skipped] 'title' and 'artist' tags are required to search MusicBrainz  "
-		progprint(ind, total, message=msg)
-		# print(msg)
-		return
+		return None, NO_TITLE, "[skipped] 'title' and 'artist' tags are required to search MusicBrainz  "
+	return handle, None, None
+
+
+def lookup_song(
+	handle: MediaFile,
+	filepath: str,
+	debug=False,
+	match_cache: MBMatchCache | None = None,
+	dump_index: MBDumpIndex | None = None,
+	album: MBAlbum | None = None,
+):
+	"""
+	:param album: release the song is probably on, its tracklist is tried before searching (unless the match cache has the song)
+	:returns (the MBSong, whether the lookup failed)
+	"""
 	# The fallback likely won't work but i cba to fix it properly for now
 	formb_album = str(handle.album) if handle.album is not None else f"{handle.title} (Single)"
 
@@ -95,36 +311,60 @@ def process_song(filepath: str, ind: int, total: int, fetch_complete: bool, fetc
 		artist=str(handle.artist),
 		album=formb_album,
 		skip_clean_title=True, # this is only useful for youtube songs with messed up titles
-		debug=debug
+		debug=debug,
+		dump_index=dump_index,
 	)
+	key = MBMatchCache.get_key(mb.title, mb.artist, mb.album)
+	if album is not None and (match_cache is None or match_cache.get(key) is None) \
+		and mb.match_release(album, handle.track or None, handle.disc or None):
+		if match_cache is not None:
+			match_cache.put(key, mb.get_match())
+		return mb, False
 	try:
-		mb.fetch_song()
+		mb.lookup(match_cache)
 	except:
-		print("coundn't fetch tags from musicbrainz, skipping...")
+		with print_lock:
+			print(f"coundn't fetch tags from musicbrainz for '{filepath}', skipping...")
+		return mb, True
+	return mb, False
 
+
+def write_song(handle: MediaFile, mb: MBSong, failed: bool, filepath: str, dry_run=False, debug=False):
+	"""
+	writes the ids mb found with the handle the file was parsed with.
+	:returns (what the file was found to be, see manifest, status message)
+	"""
 	if debug:
-		pprint(mb.get_mbid_tags())
+		with print_lock:
+			pprint(mb.get_mbid_tags())
 	if dry_run:
-		msg = "[skipped] didn't write due to --dry-run  "
-		# progprint(ind, total, message=msg)
-		print(msg)
-		print(mb.get_mb_tags())
-		print(json.dumps(mb.get_mbid_tags(), indent=2))
-		return
-	else:
-		for [k, v] in mb.get_mbid_tags().items():
-			setattr(handle, k, v)
+		with print_lock:
+			print(f"[skipped] didn't write {end_path(filepath, 2)} due to --dry-run  ")
+			print(mb.get_mb_tags())
+			print(json.dumps(mb.get_mbid_tags(), indent=2))
+		return PENDING, "[skipped] --dry-run  "
+	mbid_tags = mb.get_mbid_tags()
+	matched = not failed and any(mbid_tags.values())
+	changed = False
+	for [k, v] in mbid_tags.items():
+		if v: # an empty id would make the file look tagged, and it'd never be searched again
+			if getattr(handle, k) != v:
+				setattr(handle, k, v)
+				changed = True
+		elif matched and getattr(handle, k) is not None: # left from an earlier match (--fetch-partial), it'd be mixed up with this one
+			delattr(handle, k)
+			changed = True
+	if changed: # nothing found, or the same ids again: the file isn't rewritten
 		handle.save()
-		ptags = mb.get_mb_tags()
-		msg = ""
-		if ptags is not None:
-			if ptags["artist"] is None or ptags["title"] is None or ptags["album"] is None:
+	found = no_of_mbid_tags(read_mbid_tags(handle))
+	status = PENDING if failed else COMPLETE if found == len(MBID_TAG_KEYS) else PARTIAL if found > 0 else UNMATCHED
+	ptags = mb.get_mb_tags()
+	if ptags is not None:
+		if ptags["artist"] is None or ptags["title"] is None or ptags["album"] is None:
+			with print_lock:
 				pprint(ptags)
-			msg = f"[ok] written IDs for result: {red_if_none(ptags['artist'])} - {red_if_none(ptags['title'])} (on {red_if_none(ptags['album'])})  "
-		else:
-			msg = "[ok] written!  "
-		# print(msg)
-		progprint(ind, total, message=msg)
+		return status, f"[ok] written IDs for result: {red_if_none(ptags['artist'])} - {red_if_none(ptags['title'])} (on {red_if_none(ptags['album'])})  "
+	return status, "[ok] written!  "
 
 @click.command()
 @click.argument("input_path", type=click.Path(exists=True, file_okay=True, resolve_path=True))
@@ -132,8 +372,25 @@ def process_song(filepath: str, ind: int, total: int, fetch_complete: bool, fetc
 @click.option("--fetch-partial", "-p", is_flag=True, help="Fetch from MusicBrainz even if has some mb_* tags present.")
 @click.option("--dry-run", "-d", is_flag=True, help="Don't write to any files, just print out the mb_* tags")
 @click.option("--debug", "-g", is_flag=True, help="Prints out extra information for debugging. Does not imply --dry-run.")
-def mbtag_cli(input_path: click.Path, fetch_complete=False, fetch_partial=False, dry_run=False, debug=False):
-	process_directory(input_path, fetch_complete, fetch_partial, dry_run, debug)
+@click.option("--no-match-cache", is_flag=True, help="Always search MusicBrainz, instead of reusing what earlier runs matched (or didn't) for the same title, artist and album.")
+@click.option("--miss-ttl", type=int, default=MISS_TTL, help="Seconds a song nothing matched for isn't searched again.")
+@click.option("--jobs", "-j", type=click.IntRange(1, 64), default=DEFAULT_JOBS, help="Number of files read, looked up and written at once.")
+@click.option("--rescan", is_flag=True, help="Open every file again, even the ones that didn't change since the last run, and rebuild the scan manifest.")
+@click.option("--no-manifest", is_flag=True, help="Don't read or write the scan manifest, open every file.")
+@click.option("--no-album-lookup", is_flag=True, help="Search for every song on its own, instead of looking up the release of each album in a folder once and matching its songs against the tracklist.")
+@click.option("--dump-index", type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None, help="Search this local MusicBrainz dump index (see 'mbdump import') instead of the MusicBrainz API.")
+def mbtag_cli(input_path: click.Path, fetch_complete=False, fetch_partial=False, dry_run=False, debug=False, no_match_cache=False, miss_ttl=MISS_TTL, jobs=DEFAULT_JOBS, rescan=False, no_manifest=False, no_album_lookup=False, dump_index: Path | None = None):
+	index = MBDumpIndex(dump_index, use_cache_dir=False) if dump_index is not None else None
+	# local lookups are as fast as the match cache, and their misses shouldn't hide what the API would find later
+	match_cache = MBMatchCache(miss_ttl=miss_ttl) if not no_match_cache and index is None else None
+	manifest = ScanManifest() if not no_manifest else None
+	process_directory(input_path, fetch_complete, fetch_partial, dry_run, debug, match_cache, index, jobs, manifest, rescan, miss_ttl, not no_album_lookup)
+	if manifest is not None:
+		manifest.close()
+	if match_cache is not None:
+		match_cache.close()
+	if index is not None:
+		index.close()
 
 if __name__ == "__main__":
 	mbtag_cli()
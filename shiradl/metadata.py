@@ -1,15 +1,18 @@
 import datetime
 import random
 import re
+import threading
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from requests_cache import CachedSession
-
-from .tagging import Tags, get_1x1_cover
+from .session import POOL_MAXSIZE, session
+from .tagging import Tags, cover_store, get_1x1_cover
 
 TIGER_SINGLE = "tiger:is_single:true"
-req = CachedSession("shira_requests_cache", expire_after=60, use_cache_dir=True)
+THUMBNAIL_PROBE_WORKERS = 4 # thumbnails of a track probed at once, in order of preference
+_thumbnail_pool: ThreadPoolExecutor | None = None # shared by every track, see get_thumbnail_pool
+_thumbnail_pool_lock = threading.Lock()
 
 def parse_datestring(datestr: str):
 	"""parse YYYYMMDD or YYYY-MM-DD into { year: str, month: str, day: str }"""
@@ -116,39 +119,66 @@ def soundcloud_extractor(info):
 
 	return md_keys, add_values
 
+def get_thumbnail_candidates(info):
+	"""thumbnail urls to try, best first: maxresdefault, then the others by preference. only jpg/png"""
+	thumbs = [str(t["url"]) for t in reversed(info.get("thumbnails") or [])]
+	maxres = [u for u in thumbs if u.endswith("/maxresdefault.jpg") or u.endswith("/maxresdefault.png")]
+	others = [u for u in thumbs if u.endswith(".jpg") or u.endswith(".png")]
+	return list(dict.fromkeys(maxres + others))
+
+def ping_thumbnail(url: str):
+	"""False if url 404s. doesn't download the image"""
+	try:
+		res = session.head(url, allow_redirects=True)
+		if res.status_code in (405, 501): # no HEAD support, ask for a single byte instead
+			res = session.get(url, headers={ "Range": "bytes=0-0" })
+	except Exception:
+		return False
+	return res.status_code != 404
+
+def get_thumbnail_pool():
+	"""the pool thumbnails are probed on, created on first use. as many threads as the session keeps connections per host"""
+	global _thumbnail_pool
+	with _thumbnail_pool_lock:
+		if _thumbnail_pool is None:
+			_thumbnail_pool = ThreadPoolExecutor(max_workers=POOL_MAXSIZE, thread_name_prefix="thumbnail")
+		return _thumbnail_pool
+
+def shutdown_thumbnail_pool():
+	global _thumbnail_pool
+	with _thumbnail_pool_lock:
+		if _thumbnail_pool is not None:
+			_thumbnail_pool.shutdown(wait=True, cancel_futures=True)
+			_thumbnail_pool = None
+
 def get_youtube_maxres_thumbnail(info):
-	# sometimes info["thumbnail"] results in the fallback youtube 404 gray thumbnail
-	pinged_urls = []
-	thumbs = list(reversed(info["thumbnails"]))
-
-	def ping_yt(url: str):
-		res = req.get(str(t["url"]))
-		pinged_urls.append(t["url"])
-		return res
-
-	for t in thumbs: # try to get maxresdefault
-		if t["url"] in pinged_urls:
-			continue
-		if t["url"].endswith("/maxresdefault.jpg") or t["url"].endswith("/maxresdefault.png"):
-			res = ping_yt(t["url"])
-			if res.status_code == 404:
-				continue
-			return str(t["url"])
-	for t in thumbs: # otherwise, just take the one with the best preference but out format
-		if t["url"] in pinged_urls:
-			continue
-		if t["url"].endswith(".jpg") or t["url"].endswith(".png"):
-			res = ping_yt(t["url"])
-			if res.status_code == 404:
-				continue
-			return str(t["url"])
+	"""
+	best thumbnail that exists. sometimes info["thumbnail"] results in the fallback youtube 404 gray thumbnail
+	candidates are pinged a few at a time in order of preference, without downloading them.
+	the winner is only downloaded once, by cover_store
+	"""
+	candidates = get_thumbnail_candidates(info)
+	if len(candidates) == 0:
+		return str(info["thumbnail"])
+	pool = get_thumbnail_pool()
+	pings = [pool.submit(ping_thumbnail, url) for url in candidates[:THUMBNAIL_PROBE_WORKERS]]
+	try:
+		for i, url in enumerate(candidates):
+			if pings[i].result():
+				return url
+			if i + THUMBNAIL_PROBE_WORKERS < len(candidates): # keeps THUMBNAIL_PROBE_WORKERS in flight
+				pings.append(pool.submit(ping_thumbnail, candidates[i + THUMBNAIL_PROBE_WORKERS]))
+	finally:
+		for ping in pings: # the ones after the winner aren't needed
+			ping.cancel()
 	return str(info["thumbnail"])
 
 # based on the original https://github.com/KraXen72/tiger
-def smart_metadata(info, temp_location: Path, cover_format = "JPEG", cover_crop_method = "auto"):
+def smart_metadata(info, temp_location: Path, cover_format = "JPEG", cover_crop_method = "auto", with_cover = True):
 	"""
 	grabs as much info as it can from all over the place
 	gets the most likely tag and returns a dict
+	:param with_cover: square the thumbnail into cover_hash. if False, only cover_url is set, see CoverProcessor
 	"""
 	
 	thumbnail = get_youtube_maxres_thumbnail(info)
@@ -163,14 +193,15 @@ def smart_metadata(info, temp_location: Path, cover_format = "JPEG", cover_crop_
 		"year": "",
 		"date": "",
 		"cover_url": thumbnail,
-		"cover_bytes": get_1x1_cover(
+	}
+	if with_cover:
+		md["cover_hash"] = cover_store.put(get_1x1_cover(
 			thumbnail, 
 			temp_location, 
 			info.get("id") or clean_title(info.get("title")) or str(random.randint(0, 9) * "16"), 
 			cover_format, 
 			cover_crop_method
-		)
-	}
+		))
 	md_keys = { "title": [], "artist": [], "albumartist": [], "album": [], "year": [], } # keys to check from the 'info object'. site specific.
 	add_values = { "title": [], "artist": [], "albumartist": [], "album": [], "year": [], }
 	others = { "title": [], "artist": [], "albumartist": [], "album": [], "year": [], }
@@ -0,0 +1,100 @@
+"""
+minimal mp4 (m4a) box helpers, just enough to check and fix the layout of downloaded files
+without running ffmpeg again.
+"""
+import os
+import struct
+from io import BytesIO
+from pathlib import Path
+
+# boxes which only contain other boxes, on the way from moov to the chunk offset tables
+CONTAINER_BOXES = { b"moov", b"trak", b"mdia", b"minf", b"stbl" }
+
+
+def is_faststart_mp4(file_path: Path):
+	"""
+	checks the top-level boxes of an mp4 file: True if moov comes before mdat and the file isn't fragmented.
+	youtube serves fragmented (DASH) m4a, which has to be remuxed.
+	"""
+	seen_moov = False
+	with open(file_path, "rb") as f:
+		while header := f.read(8):
+			if len(header) < 8:
+				break
+			size = int.from_bytes(header[:4], "big")
+			box = header[4:]
+			header_size = 8
+			if size == 1: # 64-bit size follows the type
+				size = int.from_bytes(f.read(8), "big")
+				header_size = 16
+			if box == b"moof" or (box == b"mdat" and not seen_moov):
+				return False
+			if box == b"moov":
+				seen_moov = True
+			if size == 0: # box extends to the end of the file
+				break
+			if size < header_size:
+				return False # corrupt, let ffmpeg deal with it
+			f.seek(size - header_size, os.SEEK_CUR)
+	return seen_moov
+
+
+def iter_boxes(data: bytes | memoryview, start = 0, end: int | None = None):
+	"""yields (type, box start, payload start, box end) for the boxes between start and end"""
+	end = len(data) if end is None else end
+	pos = start
+	while pos + 8 <= end:
+		size, box = struct.unpack(">I4s", data[pos:pos + 8])
+		header_size = 8
+		if size == 1:
+			size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+			header_size = 16
+		elif size == 0:
+			size = end - pos
+		if size < header_size or pos + size > end:
+			raise ValueError(f"invalid mp4 box {box!r} at {pos}")
+		yield box, pos, pos + header_size, pos + size
+		pos += size
+
+
+def _shift_chunk_offsets(moov: bytearray, start: int, end: int, delta: int):
+	"""adds delta to every stco/co64 entry inside moov[start:end]"""
+	for box, _, payload, box_end in iter_boxes(moov, start, end):
+		if box in CONTAINER_BOXES:
+			_shift_chunk_offsets(moov, payload, box_end, delta)
+		elif box in (b"stco", b"co64"):
+			count = struct.unpack(">I", moov[payload + 4:payload + 8])[0]
+			fmt, width = (">I", 4) if box == b"stco" else (">Q", 8)
+			for i in range(count):
+				at = payload + 8 + i * width
+				offset = struct.unpack(fmt, moov[at:at + width])[0] + delta
+				if box == b"stco" and offset > 0xFFFFFFFF:
+					raise OverflowError("chunk offset doesn't fit into stco")
+				moov[at:at + width] = struct.pack(fmt, offset)
+
+
+def move_moov_to_front(data: bytes):
+	"""
+	in-memory qt-faststart: moves moov right behind ftyp and fixes up the chunk offsets.
+	returns data unchanged if moov already is in front of mdat, or if it can't be moved safely.
+	"""
+	boxes = list(iter_boxes(data))
+	types = [b[0] for b in boxes]
+	if types[:1] != [b"ftyp"] or b"moov" not in types or b"mdat" not in types or b"moof" in types \
+		or types.index(b"moov") < types.index(b"mdat"):
+		return data
+	_, moov_start, moov_payload, moov_end = boxes[types.index(b"moov")]
+	moov = bytearray(data[moov_start:moov_end])
+	try:
+		_shift_chunk_offsets(moov, moov_payload - moov_start, len(moov), len(moov))
+	except (OverflowError, ValueError):
+		return data # still a valid file, just not faststart
+
+	out = BytesIO()
+	for box, start, _, end in boxes:
+		if box == b"moov":
+			continue
+		out.write(data[start:end])
+		if box == b"ftyp":
+			out.write(moov)
+	return out.getvalue()
@@ -1,13 +1,25 @@
 import json
 import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
 from importlib.metadata import version as _pkg_version
-from typing import TypedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, TypedDict
 
-from requests_cache import CachedSession
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests_cache.backends.sqlite import get_cache_path
 
 from .metadata import clean_title, parse_datestring
+from .ratelimit import TokenBucket
+from .session import POOL_MAXSIZE, session
 from .tagging import Tags
 
+if TYPE_CHECKING:
+	from .mbdump import MBDumpIndex
+
 # it's better if this is a "submodule" of shira (a part of it)
 # works on it's own (name == __main__), but everything apart from the musibrainz logic doesen't live in it
 # it's in a separate python module is to have a separate command & to separate the code
@@ -42,6 +54,29 @@ MBRecording = TypedDict("MBRecording", {
 	"artist-credit": list[MBArtistCredit],
 	"releases": list[MBRelease]
 })
+
+MBTrack = TypedDict("MBTrack", {
+	"id": str,
+	"title": str,
+	"position": int,
+	"artist-credit": list[MBArtistCredit],
+	"recording": MBRecording
+})
+
+class MBMatch(TypedDict):
+	"""what MBSong matched, the names and ids taken from MusicBrainz. all None if nothing matched"""
+	title: str | None
+	artist: str | list[str] | None
+	album: str | None
+	date: str | None
+	mb_releasetrackid: str | None
+	mb_releasegroupid: str | None
+	mb_artistid: str | list[str] | None
+
+MATCH_CACHE_NAME = "shira_musicbrainz_matches.sqlite"
+MATCH_TTL = 30 * 24 * 3600 # matched songs, MusicBrainz ids don't change
+MISS_TTL = 24 * 3600 # songs nothing matched, might be added to MusicBrainz any time
+RELEASE_INC = "recordings+artist-credits+release-groups" # everything the tracklist matching in MBAlbum needs
  
 leading_zero_re = r"(?<=\b)0+(?=[1-9])" # strips all leading zeros
 
@@ -57,6 +92,19 @@ yeet_regexes = [
 
 hyphens_re = r"‐|‑|‒|–|—|―|⁃|－" # non-standard hyphens
 
+# normalize() in one pass: all yeet_regexes as one alternation, hyphens and the fullwidth slash as a translate table
+yeet_re = re.compile("|".join(f"(?:{r})" for r in yeet_regexes))
+normalize_table = str.maketrans({ **dict.fromkeys(hyphens_re.split("|"), "-"), "／": "/" })
+NORMALIZE_CACHE_SIZE = 8192 # a search result page has up to 25 recordings with a few dozen releases between them
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(text: str):
+	"""
+	lowercases, drops leading zeros, feat. and commas, unifies hyphens and slashes.
+	memoized, so every recording/release title of a search result is normalized once, not once per comparison
+	"""
+	return yeet_re.sub("", text.lower().strip().translate(normalize_table)).strip()
+
 def normalized_compare_regex(in1: str, in2: str, strict = True, debug = False):
 	"""
 	compares 2 strings after normalization
@@ -64,13 +112,7 @@ def normalized_compare_regex(in1: str, in2: str, strict = True, debug = False):
 	- e.g. Sci-Fi matches Sci—Fi  
 	:param strict: if off, it will check if in1 is a substring of in2 rather than direct comparison
 	"""
-	expr = [in1.lower().strip(), in2.lower().strip()]
-	for i in range(len(expr)):
-		for yeet_re in yeet_regexes:
-			expr[i] = re.sub(yeet_re, "", expr[i])
-		expr[i] = expr[i].replace("／", "/")
-		expr[i] = re.sub(hyphens_re, "-", expr[i])
-		expr[i] = expr[i].strip()
+	expr = [normalize(in1), normalize(in2)]
 	
 	if debug:
 		print(f"e1: {in1} e2: {in2}, strict:{strict}")
@@ -132,6 +174,127 @@ def check_title_match(title: str, r_dict: MBRecording, debug = False):
 	return title == r_dict["title"] or title.lower() == r_dict["title"].lower() \
 		or normalized_compare_regex(title, r_dict["title"], debug=debug)
 
+class RateLimitedAdapter(HTTPAdapter):
+	"""
+	takes a token from the limiter before every request that actually goes out (cache hits never get here).
+	503s (MusicBrainz' answer to going over the limit) are retried after Retry-After / a backoff
+	"""
+	def __init__(self, limiter: TokenBucket, retries = 3, **kwargs):
+		super().__init__(**kwargs)
+		self.limiter = limiter
+		self.retries = retries
+
+	def send(self, request, **kwargs): # type: ignore
+		for attempt in range(self.retries + 1):
+			self.limiter.acquire()
+			res = super().send(request, **kwargs)
+			if res.status_code != 503 or attempt == self.retries:
+				return res
+			retry_after = res.headers.get("Retry-After", "")
+			time.sleep(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+			res.close()
+		return res # type: ignore # unreachable
+
+class MBClient:
+	"""
+	the one MusicBrainz web service client every lookup goes through (MBSong, musicbrainz_enrich_tags, mbtag).
+	requests are limited to 1 per second across all threads and processes, see TokenBucket
+	"""
+	def __init__(self, rate = 1.0, state_path: Path | None = None, req: Session = session):
+		self.base = "https://musicbrainz.org/ws/2"
+		self.default_params = { "fmt": "json" }
+		self.head = { "User-Agent": f"shiradl/{_pkg_version('shiradl')} ( https://github.com/KraXen72/shira )" }
+		state_path = state_path if state_path is not None else Path(get_cache_path("shira_musicbrainz.ratelimit", use_cache_dir=True))
+		self.limiter = TokenBucket(rate, 1, state_path)
+		self.req = req
+		self.req.mount("https://musicbrainz.org/", RateLimitedAdapter(self.limiter, pool_maxsize=POOL_MAXSIZE))
+
+	def get(self, endpoint: str, params: dict, expire_after: int | None = None):
+		""":param endpoint: e.g. 'recording'"""
+		kwargs = { "expire_after": expire_after } if expire_after is not None else {}
+		return self.req.get(f"{self.base}/{endpoint}", params={ **params, **self.default_params }, headers=self.head, **kwargs)
+
+_mb_client: MBClient | None = None
+_mb_client_lock = threading.Lock()
+
+def get_mb_client():
+	"""the shared MBClient, created on first use"""
+	global _mb_client
+	with _mb_client_lock:
+		if _mb_client is None:
+			_mb_client = MBClient()
+		return _mb_client
+
+class MBMatchCache:
+	"""
+	persistent cache of MBSong results (MBMatch), keyed by the normalized (title, artist, album) being looked up.
+	misses are cached too, for a shorter time, so unmatched songs don't query MusicBrainz on every run.
+	failed lookups (network errors, 5xx) are never cached
+	"""
+	def __init__(self, db_path: Path | str = MATCH_CACHE_NAME, use_cache_dir = True, match_ttl = MATCH_TTL, miss_ttl = MISS_TTL):
+		self.db_path = get_cache_path(db_path, use_cache_dir=use_cache_dir)
+		self.match_ttl = match_ttl
+		self.miss_ttl = miss_ttl
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+		with self._lock:
+			self._conn.execute("PRAGMA journal_mode=WAL") # mbtag and shiradl can run next to each other
+			self._conn.execute("PRAGMA busy_timeout=5000")
+			self._conn.execute("CREATE TABLE IF NOT EXISTS matches (key TEXT PRIMARY KEY, match TEXT, expires REAL)")
+
+	@staticmethod
+	def get_key(title: str, artist: str, album: str):
+		return json.dumps([normalize(title), normalize(artist), normalize(album)], ensure_ascii=False)
+
+	def get(self, key: str) -> MBMatch | None:
+		""":returns the cached match (which might be a miss, see is_miss), None if there's none or it expired"""
+		with self._lock:
+			row = self._conn.execute("SELECT match FROM matches WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def put(self, key: str, match: MBMatch):
+		ttl = self.miss_ttl if is_miss(match) else self.match_ttl
+		if ttl <= 0:
+			return
+		with self._lock:
+			self._conn.execute("INSERT OR REPLACE INTO matches (key, match, expires) VALUES (?, ?, ?)", (key, json.dumps(match, ensure_ascii=False), time.time() + ttl))
+
+	def stats(self):
+		""":returns { "path", "matches", "misses", "expired" }"""
+		now = time.time()
+		counts = { "path": str(self.db_path), "matches": 0, "misses": 0, "expired": 0 }
+		with self._lock:
+			rows = self._conn.execute("SELECT match, expires FROM matches").fetchall()
+		for match, expires in rows:
+			if expires <= now:
+				counts["expired"] += 1
+			else:
+				counts["misses" if is_miss(json.loads(match)) else "matches"] += 1
+		return counts
+
+	def prune(self):
+		"""deletes expired entries. :returns how many"""
+		with self._lock:
+			return self._conn.execute("DELETE FROM matches WHERE expires <= ?", (time.time(),)).rowcount
+
+	def close(self):
+		with self._lock:
+			self._conn.close()
+
+_match_cache: MBMatchCache | None = None
+
+def get_match_cache():
+	"""the shared MBMatchCache, created on first use"""
+	global _match_cache
+	with _mb_client_lock:
+		if _match_cache is None:
+			_match_cache = MBMatchCache()
+		return _match_cache
+
+def is_miss(match: MBMatch):
+	"""no recording matched (an artist might have, through fetch_artist)"""
+	return match["mb_releasetrackid"] is None
+
 def get_mb_artistids(a_list: list[MBArtistCredit], return_single = False):
 	"""get artist mdid or list of mbids"""
 	if len(a_list) == 1 or return_single:
@@ -149,17 +312,17 @@ class MBSong:
 		album: str = "",
 		debug = False,
 		skip_clean_title = False,
-		cache_lifetime_seconds = 3600
+		cache_lifetime_seconds: int | None = None, # None for the session's musicbrainz ttl
+		dump_index: "MBDumpIndex | None" = None # search this local dump instead of the MusicBrainz api
 	):
 		if title == "":
 			raise Exception("title is required")
 		self.title = title if skip_clean_title else clean_title(title)
 		self.artist = artist
 		self.album = album
-		self.base = "https://musicbrainz.org/ws/2"
-		self.default_params = { "fmt": "json" }
-		self.req = CachedSession("shira_requests_cache", expire_after=cache_lifetime_seconds, use_cache_dir=True)
-		self.head = { "User-Agent": f"shiradl/{_pkg_version('shiradl')} ( https://github.com/KraXen72/shira )" }
+		self.dump_index = dump_index
+		self.client = get_mb_client() if dump_index is None else None
+		self.cache_lifetime_seconds = cache_lifetime_seconds
 
 		self.song_dict = None # MBRecording
 		self.artist_dict = None # MBArtistCredit
@@ -168,18 +331,36 @@ class MBSong:
 		self.mb_releasetrackid = None # song mbid
 		self.mb_releasegroupid = None # album mbid
 		self.mb_artistid = None # artist mbid
+		self.match: MBMatch | None = None # set by lookup(), from the match cache (then the dicts above stay None) or once fetched
 		self.debug = debug
 
+	def lookup(self, match_cache: MBMatchCache | None = None):
+		"""like fetch_song, but the result is looked up in / saved to match_cache. :returns the MBMatch"""
+		key = MBMatchCache.get_key(self.title, self.artist, self.album) if match_cache is not None else ""
+		if match_cache is not None:
+			self.match = match_cache.get(key)
+			if self.match is not None:
+				if self.debug:
+					print("match cache hit:", key)
+				return self.match
+		self.fetch_song()
+		self.match = self.get_match()
+		if match_cache is not None:
+			match_cache.put(key, self.match)
+		return self.match
+
 	def fetch_song(self):
 		"""
 		ping mb api to get song (/recording)
 		subsequently calls fetch_arist if nothing is found
 		"""
+		if self.dump_index is not None:
+			self.save_song_dict(self.dump_index.search_recordings(self.title, self.artist, self.album))
+			return
 		params = {
 			"query": f'{self.title} AND artist:"{self.artist}" AND release:"{self.album}"',
-			**self.default_params
 		}
-		res = self.req.get(f"{self.base}/recording", params=params, headers=self.head)
+		res = self.client.get("recording", params, self.cache_lifetime_seconds) # type: ignore
 		if self.debug:
 			print(res.url, res.status_code)
 			print("fetch_song query:", params["query"])
@@ -191,11 +372,13 @@ class MBSong:
 
 	def fetch_artist(self):
 		"""ping mb api to get artist (/artist)"""
+		if self.dump_index is not None:
+			self.save_artist_dict(self.dump_index.search_artists(self.artist))
+			return
 		params = {
 			"query": self.artist,
-			**self.default_params
 		}
-		res = self.req.get(f"{self.base}/artist", params=params, headers=self.head)
+		res = self.client.get("artist", params, self.cache_lifetime_seconds) # type: ignore
 		if self.debug:
 			print(res.url)
 			print("fetch_artist query:", params["query"])
@@ -258,6 +441,25 @@ class MBSong:
 		if self.song_dict is None:
 			self.fetch_artist()
 
+	def match_release(self, album: "MBAlbum", tracknumber: int | None = None, discnumber: int | None = None):
+		"""
+		matches the song against the tracklist of album (see MBAlbum.find_track) instead of searching for it.
+		:returns whether a track matched, the song is then looked up like fetch_song would
+		"""
+		track = album.find_track(self.title, self.artist, tracknumber, discnumber)
+		if track is None or album.release is None:
+			return False
+		release = album.get_release()
+		credit = track.get("artist-credit") or track["recording"].get("artist-credit") or release["artist-credit"]
+		self.song_dict = { **track["recording"], "artist-credit": credit, "releases": [release] }
+		self.artist_dict = credit
+		self.album_dict = release
+		self.mb_releasetrackid = track["recording"]["id"]
+		self.mb_releasegroupid = release["release-group"]["id"]
+		self.mb_artistid = get_mb_artistids(credit)
+		self.match = self.get_match()
+		return True
+
 	def save_artist_dict(self, artists: list[MBArtist]):
 		"""find most similar artist"""
 		for a in artists:
@@ -291,15 +493,34 @@ class MBSong:
 			else:
 				print(f"unknown date format {return_val}, skipping date metadata")
 
+	def get_match(self) -> MBMatch:
+		"""what was matched, in the form MBMatchCache keeps. Does no fetching itself."""
+		if self.match is not None:
+			return self.match
+		artist = None
+		if self.artist_dict is not None: # TODO fix multi-value tags
+			artist = [a["artist"]["name"] for a in self.artist_dict] if isinstance(self.artist_dict, list) else self.artist_dict["name"]
+		return {
+			"title": self.song_dict.get("title") if self.song_dict is not None else None,
+			"artist": artist,
+			"album": self.album_dict.get("title") if self.album_dict is not None else None,
+			"date": self.get_date_str(),
+			"mb_releasetrackid": self.mb_releasetrackid,
+			"mb_releasegroupid": self.mb_releasegroupid,
+			"mb_artistid": self.mb_artistid,
+		}
+
 	def get_mbid_tags(self):
 		"""get mbid tags with proper keys"""
 		# !! make sure only supported fields are multi-value tags, otherwise auxio might crash (don't do multi-value album artists)
-		first_mb_artistid = self.mb_artistid[0] if isinstance(self.mb_artistid, list) else self.mb_artistid
+		match = self.get_match()
+		mb_artistid = match["mb_artistid"]
+		first_mb_artistid = mb_artistid[0] if isinstance(mb_artistid, list) else mb_artistid
 		
 		return {
-			"mb_releasetrackid": self.mb_releasetrackid,
-			"mb_releasegroupid": self.mb_releasegroupid,
-			"mb_artistid": self.mb_artistid,
+			"mb_releasetrackid": match["mb_releasetrackid"],
+			"mb_releasegroupid": match["mb_releasegroupid"],
+			"mb_artistid": mb_artistid,
 			"mb_albumartistid": first_mb_artistid
 		}
 
@@ -310,37 +531,107 @@ class MBSong:
 		otherwise all 3 will be None.  
 		Does no fetching itself.
 		"""
-		artist = None
-		if self.artist_dict is not None:
-			artist = self.artist_dict[0]["artist"]["name"] if isinstance(self.artist_dict, list) else self.artist_dict["name"]
+		match = self.get_match()
+		artist = match["artist"]
 		return {
-			"title": self.song_dict.get("title") if self.song_dict is not None else None,
-			"artist": artist,
-			"album": self.album_dict.get("title") if self.album_dict is not None else None,
+			"title": match["title"],
+			"artist": artist[0] if isinstance(artist, list) else artist,
+			"album": match["album"],
 		}
 
-def musicbrainz_enrich_tags(tags: Tags, skip_encode = False, exclude_tags: list[str] = [], use_mbid_data = True):  # noqa: B006
-	"""takes in a tags dict, adds mbid tags and (by default) also other mb info, returns it"""
+class MBAlbum:
+	"""
+	MusicBrainz release of a folder of songs: searched once (/release), fetched once with its tracklist (/release/{id}),
+	then every song of the folder is matched against the tracklist with MBSong.match_release, 2 requests instead of one per song
+	"""
+	def __init__(self, album: str, albumartist: str, debug = False, cache_lifetime_seconds: int | None = None):
+		self.album = album
+		self.albumartist = albumartist
+		self.client = get_mb_client()
+		self.cache_lifetime_seconds = cache_lifetime_seconds
+		self.debug = debug
+		self.release = None # the release lookup response, with media > tracks > recording
+
+	def fetch_release(self, track_count = 0):
+		"""
+		searches for the release, then looks up the first matching one.
+		:param track_count: songs in the folder, releases with at least this many tracks are preferred
+		:returns whether a release was found
+		"""
+		params = { "query": f'release:"{self.album}" AND artist:"{self.albumartist}"' }
+		res = self.client.get("release", params, self.cache_lifetime_seconds)
+		if self.debug:
+			print(res.url, res.status_code)
+		if not (res.status_code and res.status_code >= 200 and res.status_code < 300):
+			raise Exception(f"fetch_release: status code {res.status_code}")
+		candidates = [
+			r for r in json.loads(res.text)["releases"]
+			if check_barealbum_match(self.album, r) and len(r.get("artist-credit", [])) > 0 and check_artist_match(self.albumartist, r["artist-credit"])
+		]
+		if len(candidates) == 0:
+			return False
+		release = next((r for r in candidates if r.get("track-count", 0) >= track_count), candidates[0])
+		res = self.client.get(f"release/{release['id']}", { "inc": RELEASE_INC }, self.cache_lifetime_seconds)
+		if not (res.status_code and res.status_code >= 200 and res.status_code < 300):
+			raise Exception(f"fetch_release: status code {res.status_code}")
+		self.release = json.loads(res.text)
+		return True
+
+	def get_release(self) -> MBRelease:
+		"""the release without its tracklist, shaped like the releases of a recording search result"""
+		release = self.release or {}
+		return { k: v for k, v in release.items() if k != "media" } # type: ignore
+
+	def find_track(self, title: str, artist: str, tracknumber: int | None = None, discnumber: int | None = None) -> MBTrack | None:
+		"""
+		the track at tracknumber (on discnumber) if its title matches, otherwise the first track whose title and artist match.
+		track titles can differ from recording titles, both are tried
+		"""
+		if self.release is None:
+			return None
+		tracks = [(medium.get("position", 1), t) for medium in self.release.get("media", []) for t in medium.get("tracks", [])]
+		def title_match(t: MBTrack):
+			return check_title_match(title, t) or check_title_match(title, t["recording"]) # type: ignore
+		if tracknumber is not None:
+			for disc, t in tracks:
+				if t.get("position") == tracknumber and (discnumber is None or disc == discnumber) and title_match(t):
+					return t
+		for _, t in tracks:
+			credit = t.get("artist-credit") or t["recording"].get("artist-credit") or self.release.get("artist-credit", [])
+			if title_match(t) and len(credit) > 0 and check_artist_match(artist, credit):
+				return t
+		return None
+
+def musicbrainz_enrich_tags(
+	tags: Tags,
+	skip_encode = False,
+	exclude_tags: list[str] = [],  # noqa: B006
+	use_mbid_data = True,
+	match_cache: MBMatchCache | None = None,
+	dump_index: "MBDumpIndex | None" = None,
+):
+	"""
+	takes in a tags dict, adds mbid tags and (by default) also other mb info, returns it
+	:param match_cache: reuse (and save) the result of earlier lookups of the same song
+	:param dump_index: look the song up in a local MusicBrainz dump instead of the api
+	"""
 
-	mb = MBSong(title=tags["title"], artist=str(tags["artist"]), album=tags["album"])
+	mb = MBSong(title=tags["title"], artist=str(tags["artist"]), album=tags["album"], dump_index=dump_index)
 	try:
-		mb.fetch_song()
+		match = mb.lookup(match_cache)
 	except:
 		print("coundn't fetch tags from musicbrainz, skipping...")
 		return tags
 
 	if use_mbid_data:
-		if mb.artist_dict:
-			if isinstance(mb.artist_dict, list): # TODO fix multi-value tags
-				tags["artist"] = [a["artist"]["name"] for a in mb.artist_dict ]
-			else: # TODO consider using mb.album_dict to get album artist?
-				tags["artist"] = mb.artist_dict["name"]
-			tags["albumartist"] = mb.artist_dict[0]["artist"]["name"] if isinstance(mb.artist_dict, list) else mb.artist_dict["name"]
-		if mb.album_dict:
-			tags["album"] = mb.album_dict["title"]
-		if mb.song_dict:
-			tags["title"] = mb.song_dict["title"]
-			_release_date = mb.get_date_str()
+		if match["artist"]:
+			tags["artist"] = match["artist"] # TODO consider using the album to get album artist?
+			tags["albumartist"] = match["artist"][0] if isinstance(match["artist"], list) else match["artist"]
+		if match["album"]:
+			tags["album"] = match["album"]
+		if match["title"]:
+			tags["title"] = match["title"]
+			_release_date = match["date"]
 			# print("mb", _release_date)
 			if _release_date:
 				tags["date"] = _release_date
@@ -0,0 +1,103 @@
+"""
+staged producer/consumer pipeline for the download loop
+
+every stage runs its own pool of worker threads, and stages are connected by bounded queues.
+a slow stage (e.g. tagging) blocks the stages in front of it once its queue is full,
+so work (and temp files on disk) can't pile up faster than it is being finished.
+"""
+import queue
+import threading
+from collections.abc import Callable, Iterable
+from typing import Any
+
+_DONE = object() # sentinel, passed down the pipeline once a stage runs out of work
+
+
+class Stage:
+	"""
+	a named step of the pipeline.
+	func takes a job and returns it (passed on to the next stage) or None (job is finished early, e.g. skipped)
+	:param workers: how many jobs this stage processes at once
+	:param queue_size: how many jobs can wait in front of this stage, defaults to workers
+	"""
+	def __init__(self, name: str, func: Callable[[Any], Any], workers = 1, queue_size: int | None = None):
+		self.name = name
+		self.func = func
+		self.workers = max(1, workers)
+		self.queue_size = max(1, queue_size if queue_size is not None else self.workers)
+
+
+class Pipeline:
+	"""
+	runs jobs through stages in order.
+	:param on_error: called as on_error(job, stage, exception) when a stage raises, the job is then dropped
+	:param on_done: called as on_done(job, failed) exactly once per job, when it leaves the pipeline
+	"""
+	def __init__(
+		self,
+		stages: list[Stage],
+		on_error: Callable[[Any, Stage, Exception], None] | None = None,
+		on_done: Callable[[Any, bool], None] | None = None,
+	):
+		if len(stages) == 0:
+			raise Exception("pipeline needs at least one stage")
+		self.stages = stages
+		self.on_error = on_error
+		self.on_done = on_done
+		self.queues: list[queue.Queue] = [queue.Queue(maxsize=s.queue_size) for s in stages]
+		self.failed: list[Any] = []
+		self._lock = threading.Lock()
+
+	def max_in_flight(self, first: int = 0, last: int | None = None):
+		"""upper bound of jobs that can be between (and inside) stages first..last at once"""
+		span = self.stages[first:(last + 1 if last is not None else None)]
+		return sum(s.workers for s in span) + sum(s.queue_size for s in span[1:])
+
+	def _finish(self, job, failed: bool):
+		if failed:
+			with self._lock:
+				self.failed.append(job)
+		if self.on_done is not None:
+			self.on_done(job, failed)
+
+	def _work(self, i: int):
+		stage = self.stages[i]
+		inbox = self.queues[i]
+		outbox = self.queues[i + 1] if i + 1 < len(self.stages) else None
+		while True:
+			job = inbox.get()
+			if job is _DONE:
+				inbox.put(_DONE) # let the other workers of this stage know as well
+				return
+			try:
+				result = stage.func(job)
+			except Exception as e:
+				if self.on_error is not None:
+					self.on_error(job, stage, e)
+				self._finish(job, True)
+				continue
+			if result is None or outbox is None:
+				self._finish(job if result is None else result, False)
+			else:
+				outbox.put(result)
+
+	def run(self, jobs: Iterable[Any]):
+		"""blocks until every job went through the pipeline. returns the list of failed jobs"""
+		threads = [
+			[threading.Thread(target=self._work, args=(i,), name=f"{stage.name}-{w}", daemon=True) for w in range(stage.workers)]
+			for i, stage in enumerate(self.stages)
+		]
+		for stage_threads in threads:
+			for t in stage_threads:
+				t.start()
+
+		for job in jobs:
+			self.queues[0].put(job)
+		self.queues[0].put(_DONE)
+
+		for i, stage_threads in enumerate(threads):
+			for t in stage_threads:
+				t.join()
+			if i + 1 < len(self.stages):
+				self.queues[i + 1].put(_DONE)
+		return self.failed
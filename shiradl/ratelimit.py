@@ -0,0 +1,87 @@
+"""
+token bucket rate limiter, shared by every thread and (through a locked state file) every process on the machine.
+used to stay under the MusicBrainz limit of 1 request per second, even with parallel shiradl / mbtag runs.
+"""
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+if os.name == "nt":
+	import msvcrt
+else:
+	import fcntl
+
+_STATE = struct.Struct("<dd") # tokens, last refill (time.time())
+
+
+class _FileLock:
+	"""exclusive lock on an open file, blocks until it's acquired"""
+	def __init__(self, f):
+		self.f = f
+
+	def __enter__(self):
+		if os.name == "nt":
+			self.f.seek(0)
+			msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, _STATE.size) # type: ignore
+		else:
+			fcntl.flock(self.f.fileno(), fcntl.LOCK_EX) # type: ignore
+		return self
+
+	def __exit__(self, *_):
+		if os.name == "nt":
+			self.f.seek(0)
+			msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, _STATE.size) # type: ignore
+		else:
+			fcntl.flock(self.f.fileno(), fcntl.LOCK_UN) # type: ignore
+
+
+class TokenBucket:
+	"""
+	:param rate: tokens added per second
+	:param capacity: most tokens the bucket holds, i.e. the largest burst
+	:param state_path: file the bucket lives in, so processes using the same file share it. in memory if None
+	"""
+	def __init__(self, rate: float, capacity: float = 1, state_path: Path | None = None):
+		self.rate = rate
+		self.capacity = capacity
+		self.state_path = state_path
+		self._lock = threading.Lock()
+		self._tokens = capacity
+		self._last = time.time()
+		if state_path is not None:
+			state_path.parent.mkdir(parents=True, exist_ok=True)
+
+	def _take(self, tokens: float, last: float, now: float):
+		""":returns (wait time, new tokens, new last refill). wait time is 0 if a token was taken"""
+		tokens = min(self.capacity, tokens + max(0.0, now - last) * self.rate)
+		now = max(now, last)
+		if tokens >= 1:
+			return 0.0, tokens - 1, now
+		return (1 - tokens) / self.rate, tokens, now
+
+	def _try_acquire(self):
+		if self.state_path is None:
+			wait, self._tokens, self._last = self._take(self._tokens, self._last, time.time())
+			return wait
+		with open(self.state_path, "a+b") as f, _FileLock(f):
+			now = time.time() # only once the lock is held, another process might have just taken a token
+			f.seek(0)
+			raw = f.read(_STATE.size)
+			tokens, last = _STATE.unpack(raw) if len(raw) == _STATE.size else (self.capacity, now)
+			wait, tokens, last = self._take(tokens, last, now)
+			f.seek(0)
+			f.truncate()
+			f.write(_STATE.pack(tokens, last))
+			f.flush() # before the lock is released
+		return wait
+
+	def acquire(self):
+		"""blocks until a token is available and takes it"""
+		while True:
+			with self._lock:
+				wait = self._try_acquire()
+			if wait <= 0:
+				return
+			time.sleep(wait)
@@ -0,0 +1,154 @@
+"""
+timing instrumentation of a run: timed spans (a pipeline stage of a track, or a step inside one), http requests and cache hits per host,
+bytes downloaded and time spent in subprocesses (ffmpeg, ffprobe).
+everything is collected by the process-wide recorder, and written out as one json report with --report, see Recorder.report
+"""
+import json
+import math
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, TypedDict
+from urllib.parse import urlparse
+
+
+class Span(TypedDict):
+	name: str
+	track: str | None
+	start: float # seconds since the run started
+	seconds: float
+	failed: bool
+
+
+class HostStats(TypedDict):
+	requests: int
+	cache_hits: int
+	cache_misses: int
+	bytes: int # of responses that weren't cached, as far as they declared a Content-Length
+
+
+def get_percentile(sorted_values: list[float], percentile: float):
+	"""nearest-rank percentile of already sorted values"""
+	if len(sorted_values) == 0:
+		return 0.0
+	return sorted_values[max(0, math.ceil(percentile / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(values: list[float]):
+	""":returns { "count", "total", "p50", "p95", "max" } of durations in seconds"""
+	values = sorted(values)
+	return {
+		"count": len(values),
+		"total": round(sum(values), 6),
+		"p50": round(get_percentile(values, 50), 6),
+		"p95": round(get_percentile(values, 95), 6),
+		"max": round(values[-1], 6) if len(values) > 0 else 0.0,
+	}
+
+
+class Recorder:
+	"""thread safe, every worker of every stage records into the same one"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		"""forgets everything recorded so far, the run starts now"""
+		with self._lock:
+			self.started = time.time()
+			self._start = time.perf_counter()
+			self.spans: list[Span] = []
+			self.hosts: dict[str, HostStats] = {}
+			self.subprocesses: dict[str, list[float]] = {}
+			self.downloaded_bytes = 0
+
+	def add_span(self, name: str, track: str | None, start: float, seconds: float, failed = False):
+		""":param start: time.perf_counter() when the span started"""
+		span: Span = { "name": name, "track": track, "start": round(start - self._start, 6), "seconds": round(seconds, 6), "failed": failed }
+		with self._lock:
+			self.spans.append(span)
+
+	@contextmanager
+	def span(self, name: str, track: str | None = None):
+		"""times the with block. spans that raised are recorded too, as failed"""
+		start = time.perf_counter()
+		failed = True
+		try:
+			yield
+			failed = False
+		finally:
+			self.add_span(name, track, start, time.perf_counter() - start, failed)
+
+	def timed(self, name: str, func: Callable[[Any], Any], get_track: Callable[[Any], str | None] = lambda _: None):
+		"""wraps a pipeline stage func, so every job it processes is a span"""
+		def timed_func(job):
+			with self.span(name, get_track(job)):
+				return func(job)
+		return timed_func
+
+	def add_request(self, url: str, from_cache: bool, size: int | str | None = None):
+		host = urlparse(url).hostname or "unknown"
+		with self._lock:
+			stats = self.hosts.setdefault(host, { "requests": 0, "cache_hits": 0, "cache_misses": 0, "bytes": 0 })
+			stats["requests"] += 1
+			if from_cache:
+				stats["cache_hits"] += 1
+			else:
+				stats["cache_misses"] += 1
+				stats["bytes"] += int(size) if size else 0
+
+	def record_response(self, response, *args, **kwargs):
+		"""requests response hook, for sessions that aren't ours (ytmusicapi)"""
+		self.add_request(response.url, getattr(response, "from_cache", False), response.headers.get("Content-Length"))
+		return response
+
+	def add_download(self, size: int):
+		with self._lock:
+			self.downloaded_bytes += size
+
+	def run_subprocess(self, cmd: list, **kwargs):
+		"""subprocess.run, timed under the name of the executable"""
+		name = Path(str(cmd[0])).stem
+		start = time.perf_counter()
+		try:
+			return subprocess.run(cmd, **kwargs)
+		finally:
+			seconds = time.perf_counter() - start
+			with self._lock:
+				self.subprocesses.setdefault(name, []).append(seconds)
+
+	def report(self, **extra):
+		"""
+		:param extra: added to the top level of the report as is, e.g. track counts
+		:returns { "started", "wall_seconds", **extra, "stages": { name: summarize() }, "http": { host: HostStats },
+		"downloaded_bytes", "subprocesses": { name: summarize() }, "spans": [Span] }
+		"""
+		with self._lock:
+			spans = list(self.spans)
+			hosts = { host: dict(stats) for host, stats in self.hosts.items() }
+			subprocesses = { name: list(values) for name, values in self.subprocesses.items() }
+			downloaded_bytes = self.downloaded_bytes
+		durations: dict[str, list[float]] = {}
+		for span in spans:
+			durations.setdefault(span["name"], []).append(span["seconds"])
+		return {
+			"started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+			"wall_seconds": round(time.perf_counter() - self._start, 6),
+			**extra,
+			"stages": { name: summarize(values) for name, values in durations.items() },
+			"http": dict(sorted(hosts.items())),
+			"downloaded_bytes": downloaded_bytes,
+			"subprocesses": { name: summarize(values) for name, values in subprocesses.items() },
+			"spans": sorted(spans, key=lambda span: span["start"]),
+		}
+
+	def write(self, path: Path, **extra):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_text(json.dumps(self.report(**extra), indent=2), encoding="utf8")
+
+
+recorder = Recorder()
@@ -0,0 +1,172 @@
+"""
+the one http session of the process: musicbrainz, covers and thumbnails all go through it.
+one cache database (in WAL mode, so readers don't block the writer), one keep-alive connection pool per host, safe to use from several threads.
+ytmusicapi and yt-dlp bring their own sessions.
+
+cache lifetimes are set per endpoint group (see ENDPOINTS, configure()), the database is kept under a size by prune(),
+which drops expired responses first and then the least recently used ones.
+image bodies are kept out of the database by default, the content-addressed cover store already has them on disk.
+"""
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests_cache import DO_NOT_CACHE, CachedSession
+from requests_cache.policy.expiration import get_expiration_seconds, get_url_expiration
+
+from .report import recorder
+
+CACHE_NAME = "shira_requests_cache"
+DEFAULT_EXPIRE_AFTER = 3600
+# url patterns of each endpoint group, see requests_cache's urls_expire_after
+ENDPOINTS = {
+	"musicbrainz": ("musicbrainz.org/ws/2",),
+	"thumbnails": ("i.ytimg.com",), # youtube thumbnails
+	"covers": ("*.googleusercontent.com", "*.sndcdn.com"), # youtube music covers, soundcloud artwork
+}
+DEFAULT_TTLS = { "musicbrainz": 3600, "thumbnails": 3600, "covers": 3600 } # seconds, -1 to never expire, 0 to not cache
+POOL_CONNECTIONS = 8 # hosts kept pooled
+POOL_MAXSIZE = 16 # connections kept alive per host, enough for every stage worker to have one
+ACCESS_TABLE = "shira_access" # cache key => last time it was read or written, for lru eviction
+ACCESS_FLUSH_EVERY = 256 # accesses kept in memory before they're written
+VACUUM_MIN_FREED = 32 * 1024 ** 2 # bytes prune() has to free before the database is rewritten to give them back to the disk
+
+
+def get_urls_expire_after(ttls: dict[str, int]):
+	""":param ttls: seconds per endpoint group, missing groups get DEFAULT_TTLS"""
+	urls_expire_after = {}
+	for group, patterns in ENDPOINTS.items():
+		ttl = ttls.get(group, DEFAULT_TTLS[group])
+		for pattern in patterns:
+			urls_expire_after[pattern] = DO_NOT_CACHE if ttl == 0 else ttl
+	return urls_expire_after
+
+
+def get_endpoint_group(url: str):
+	""":returns the ENDPOINTS group url belongs to, 'other' if none"""
+	for group, patterns in ENDPOINTS.items():
+		if get_url_expiration(url, dict.fromkeys(patterns, 1)) is not None:
+			return group
+	return "other"
+
+
+def is_not_image(response):
+	"""filter_fn keeping image bodies out of the cache. HEAD responses (thumbnail probes) have no body and stay cached"""
+	return response.request.method != "GET" or not response.headers.get("Content-Type", "").startswith("image/")
+
+
+class ShiraSession(CachedSession):
+	"""CachedSession that remembers when each cache entry was last used, so prune() can evict the least recently used"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._accessed: dict[str, float] = {}
+		self._access_lock = threading.Lock()
+		with self.cache.responses.connection(commit=True) as con:
+			con.execute(f"CREATE TABLE IF NOT EXISTS {ACCESS_TABLE} (key TEXT PRIMARY KEY, accessed REAL)")
+
+	def send(self, request, *args, **kwargs):
+		response = super().send(request, *args, **kwargs)
+		recorder.add_request(request.url, getattr(response, "from_cache", False), response.headers.get("Content-Length"))
+		key = getattr(response, "cache_key", None)
+		if key:
+			with self._access_lock:
+				self._accessed[key] = time.time()
+				flush = len(self._accessed) >= ACCESS_FLUSH_EVERY
+			if flush:
+				self.flush_access()
+		return response
+
+	def flush_access(self):
+		with self._access_lock:
+			accessed, self._accessed = self._accessed, {}
+		if not accessed:
+			return
+		with self.cache.responses.connection(commit=True) as con:
+			con.executemany(f"INSERT OR REPLACE INTO {ACCESS_TABLE} (key, accessed) VALUES (?, ?)", accessed.items())
+
+	def configure(self, ttls: dict[str, int] | None = None, images_in_sqlite = False):
+		"""
+		:param ttls: cache lifetime in seconds per endpoint group, see ENDPOINTS and DEFAULT_TTLS
+		:param images_in_sqlite: also cache image bodies in the database
+		"""
+		self.settings.urls_expire_after = get_urls_expire_after(ttls or {})
+		self.settings.filter_fn = None if images_in_sqlite else is_not_image
+
+	def url_expire_after(self, url: str):
+		""":returns how long a response from url is cached for, in seconds. -1 never expires, 0 isn't cached"""
+		expire_after = get_url_expiration(url, self.settings.urls_expire_after)
+		if expire_after is None:
+			expire_after = self.settings.expire_after
+		if expire_after == DO_NOT_CACHE:
+			return 0
+		return get_expiration_seconds(expire_after)
+
+	def stats(self):
+		""":returns { "path", "file_size", "groups": { group: { "responses", "expired", "bytes" } } }"""
+		self.flush_access()
+		groups = { group: { "responses": 0, "expired": 0, "bytes": 0 } for group in (*ENDPOINTS, "other") }
+		responses = self.cache.responses
+		now = time.time()
+		with responses.connection() as con:
+			rows = con.execute(f"SELECT key, value, expires FROM {responses.table_name}").fetchall()
+		for key, value, expires in rows:
+			response = responses.deserialize(key, value)
+			group = groups[get_endpoint_group(response.url) if response is not None else "other"]
+			group["responses"] += 1
+			group["expired"] += expires is not None and expires <= now
+			group["bytes"] += len(value)
+		return { "path": str(responses.db_path), "file_size": responses.size(), "groups": groups }
+
+	def get_used_size(self):
+		""":returns bytes the pages in use of the cache database take up, more than prune() counts but read without scanning anything"""
+		with self.cache.responses.connection() as con:
+			page_count, = con.execute("PRAGMA page_count").fetchone()
+			free_count, = con.execute("PRAGMA freelist_count").fetchone()
+			page_size, = con.execute("PRAGMA page_size").fetchone()
+		return (page_count - free_count) * page_size
+
+	def prune(self, max_size = 0, vacuum: bool | None = None):
+		"""
+		deletes expired responses, then the least recently used ones until the bodies take up at most max_size bytes.
+		:param max_size: 0 only deletes expired responses
+		:param vacuum: rewrite the database after deleting something, so the file shrinks. by default only if VACUUM_MIN_FREED bytes were freed
+		:returns (responses deleted, bytes freed)
+		"""
+		self.flush_access()
+		responses = self.cache.responses
+		with responses.connection() as con:
+			before_count, before_size = con.execute(f"SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM {responses.table_name}").fetchone()
+			evicted = []
+			if max_size > 0:
+				now = time.time()
+				rows = con.execute(
+					f"SELECT r.key, LENGTH(r.value), r.expires FROM {responses.table_name} r LEFT JOIN {ACCESS_TABLE} a ON a.key = r.key"
+					" ORDER BY COALESCE(a.accessed, 0) ASC"
+				).fetchall()
+				size = sum(length for _, length, expires in rows if expires is None or expires > now)
+				for key, length, expires in rows:
+					if size <= max_size:
+						break
+					if expires is None or expires > now: # expired ones are deleted anyway
+						evicted.append(key)
+						size -= length
+		self.cache.delete(*evicted, expired=True, vacuum=False)
+		with responses.connection(commit=True) as con:
+			con.execute(f"DELETE FROM {ACCESS_TABLE} WHERE key NOT IN (SELECT key FROM {responses.table_name})")
+			after_count, after_size = con.execute(f"SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM {responses.table_name}").fetchone()
+		count, freed = before_count - after_count, before_size - after_size
+		if count > 0 and (vacuum or (vacuum is None and freed >= VACUUM_MIN_FREED)):
+			responses.vacuum()
+		return count, freed
+
+
+def create_session():
+	session = ShiraSession(CACHE_NAME, expire_after=DEFAULT_EXPIRE_AFTER, use_cache_dir=True, wal=True)
+	session.configure()
+	adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+session = create_session()
@@ -0,0 +1,123 @@
+"""
+squaring covers: crop or pad a thumbnail to 1:1 (square_cover), deciding which from the colors near its corners.
+kept apart from tagging, the processes of a CoverProcessor import this module only, not the http session.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from statistics import mean, stdev
+
+from PIL import Image, ImageFilter, ImageOps
+
+AVG_THRESHOLD = 10
+CHANNEL_THRESHOLD = 15
+CROP_PROXY_WIDTH = 160 # determine_image_crop works on a copy reduced to about this width
+CROP_CACHE_SIZE = 4096
+crop_decisions: OrderedDict[str, tuple[str, tuple[int, int, int] | None]] = OrderedDict() # image hash => determine_image_crop result
+crop_decisions_lock = threading.Lock()
+
+def get_dominant_color(pil_img: Image.Image) -> tuple[int, int, int, int]:
+	img = pil_img.copy().convert("RGBA")
+	img = img.resize((1, 1), resample=Image.Resampling.NEAREST)
+	
+	pixel = img.getpixel((0, 0))
+
+	# Explicitly ensure the return type is always Tuple[int, int, int, int]
+	if isinstance(pixel, tuple) and len(pixel) == 4:
+		return pixel
+	else:
+		return (0,0,0,255)
+
+def sample_image_corners(rgb_image, width, height, border_offset = 50):
+	sample_colors = []
+	regions = [
+		(border_offset, border_offset), # topleft
+		(width - border_offset, border_offset), #topright
+		(border_offset, height - border_offset),   #botleft
+		(width - border_offset, height - border_offset), #botright
+		# (border_slice_center, height//2), #left center
+		# (width//2 + height//2 + border_slice_center, height//2) #right center
+	]
+	for sx, sy in regions:
+		r, g, b = rgb_image.getpixel((sx, sy))
+		sample_colors.append((r, g, b))
+	return sample_colors
+
+def determine_image_crop(image_bytes: bytes, pil_img: Image.Image | None = None):
+	"""
+	samples 4 pixels near the corners of the thumbnail (which is first smoothed and reduced to 64 colors)
+
+	returns 'crop' if average of standard deviation of r, g and b color channels 
+	from each sample point is lower than a than a threshold, otherwise returns 'pad'
+
+	the thumbnail is reduced to ~CROP_PROXY_WIDTH first (sample offsets scaled along), filtering the full size image is slow.
+	decisions are cached by image hash. pass pil_img if image_bytes are already decoded
+	"""
+	digest = hashlib.sha1(image_bytes).hexdigest()
+	with crop_decisions_lock:
+		if digest in crop_decisions:
+			crop_decisions.move_to_end(digest)
+			return crop_decisions[digest]
+
+	pil_img = pil_img if pil_img is not None else Image.open(BytesIO(image_bytes))
+	rgb_image = pil_img if pil_img.mode == "RGB" else pil_img.convert("RGB")
+	factor = max(1, rgb_image.width // CROP_PROXY_WIDTH)
+	proxy = rgb_image.reduce(factor) if factor > 1 else rgb_image
+	filt_image = proxy.filter(ImageFilter.SMOOTH).convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
+	rgb_filt_image = filt_image.convert("RGB")
+	
+	width, height = rgb_filt_image.size
+	sample_colors50 = sample_image_corners(rgb_filt_image, width, height, max(1, round(50 / factor)))
+	sample_colors0 = sample_image_corners(rgb_filt_image, width, height, 1)
+
+	reds, greens, blues = zip(*sample_colors50, strict=True)
+	dev_red = stdev(reds)
+	dev_green = stdev(greens)
+	dev_blue = stdev(blues)
+	avg_dev = mean([dev_red, dev_green, dev_blue])
+
+	# if 4 true corners are 100% equal, fill with that.
+	# TODO later, crop the borders off of a black-bordered thumbnail for real cropping
+	fill_recc = sample_colors0[0] if len(set(sample_colors0)) == 1 else None
+	# print("average:", avg_dev, "colors:", dev_red, dev_green, dev_blue)
+
+	if avg_dev < AVG_THRESHOLD and dev_red < CHANNEL_THRESHOLD and dev_green < CHANNEL_THRESHOLD and dev_blue < CHANNEL_THRESHOLD:
+		decision = "crop", fill_recc
+	else:
+		decision = "pad", fill_recc
+	with crop_decisions_lock:
+		crop_decisions[digest] = decision
+		while len(crop_decisions) > CROP_CACHE_SIZE:
+			crop_decisions.popitem(last=False)
+	return decision
+
+def square_cover(image_bytes: bytes, cover_format = "JPEG", cover_crop_method = "auto"):
+	"""crops or pads a thumbnail to 1:1. bytes in, bytes out, so it can run in a CoverProcessor"""
+	pil_img = Image.open(BytesIO(image_bytes))
+
+	width, height = pil_img.size
+	aspect_ratio = width / height
+
+	if aspect_ratio == 1:
+		return image_bytes
+
+	width, height = pil_img.size
+	recc_fill_color = None
+
+	if cover_crop_method == "auto":
+		cover_crop_method, recc_fill_color = determine_image_crop(image_bytes, pil_img)
+	
+	if cover_crop_method == "crop":
+		img_half = round(width / 2)
+		rect_half = round(height / 2)
+		pil_img = pil_img.crop((img_half - rect_half, 0, img_half + rect_half, height))
+	else:
+		dominant_color = get_dominant_color(pil_img) if recc_fill_color is None else recc_fill_color
+		pil_img = ImageOps.pad(pil_img, (width, width), color=dominant_color, centering=(0.5, 0.5))
+
+	output_bytes = BytesIO()
+	pil_img.save(output_bytes, format=cover_format)
+	output_bytes.seek(0)
+
+	return output_bytes.read()
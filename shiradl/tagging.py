@@ -1,23 +1,26 @@
 from __future__ import annotations
 
-import functools
+import hashlib
+import multiprocessing
 import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from io import BytesIO
 from pathlib import Path
-from statistics import mean, stdev
 from typing import NotRequired, TypedDict
 
 from dateutil import parser
 from mediafile import Image as MFImage
 from mediafile import ImageType, MediaFile
-from PIL import Image, ImageFilter, ImageOps
-from requests_cache import CachedSession
 
-AVG_THRESHOLD = 10
-CHANNEL_THRESHOLD = 15
+from .covers import CoverStore
+from .mp4 import move_moov_to_front
+from .session import session
+from .squaring import square_cover
+
 MV_SEPARATOR = "/"#" & " # TODO make this configurable
 MV_SEPARATOR_VISUAL = " & "
-req = CachedSession("shira_requests_cache", expire_after=3600, use_cache_dir=True)
+cover_store = CoverStore(session=session, url_expire_after=session.url_expire_after)
 
 class Tags(TypedDict):
 	title: str
@@ -29,20 +32,28 @@ class Tags(TypedDict):
 	year: str
 	date: str
 	cover_url: str
-	cover_bytes: NotRequired[bytes]
+	cover_hash: NotRequired[str] # set if the cover isn't just cover_url, e.g. cropped or local. see get_cover_hash
 	rating: NotRequired[int]
 	comments: NotRequired[str]
 	lyrics: NotRequired[str]
 
 fallback_mv_keys = ["artist", "albumartist"]
 
-def metadata_applier(tags: Tags, fixed_location: Path, exclude_tags: list[str], fallback_mv = True):
-	"""set fallback_mv = True until auxio supports proper multi-value m4a tags from mutagen"""
-	handle = MediaFile(fixed_location)
-	handle.delete()
-	# print({**tags, "cover_bytes": ""})
+def metadata_applier(tags: Tags, fixed_location: Path, exclude_tags: list[str], fallback_mv = True, in_memory = False):
+	"""
+	set fallback_mv = True until auxio supports proper multi-value m4a tags from mutagen
+	:param in_memory: tag a copy of the file in memory and return it's bytes (with moov moved to the front for m4a),
+	fixed_location is left untouched. this way the tagged file only gets written once, see Dl.write_final_location
+	"""
+	buffer = BytesIO(Path(fixed_location).read_bytes()) if in_memory else None
+	handle = MediaFile(buffer if buffer is not None else fixed_location)
+	if buffer is not None:
+		handle.mgfile.tags.clear() # type: ignore # same as delete(), without writing
+	else:
+		handle.delete()
+	# print(tags)
 	for k, v in tags.items():
-		if k in exclude_tags or k in ["cover_url", "cover_bytes"]: 
+		if k in exclude_tags or k in ["cover_url", "cover_hash"]: 
 			continue
 		if k == "date":
 			v = parser.isoparse(str(v)).date()
@@ -55,18 +66,23 @@ def metadata_applier(tags: Tags, fixed_location: Path, exclude_tags: list[str],
 			setattr(handle, k, v)
 	
 	if "cover" not in exclude_tags:
-		cover_bytes = tags.get("cover_bytes") or get_cover(tags["cover_url"])
-		handle.images = [ MFImage(data=cover_bytes, desc="Cover", type=ImageType.front) ]
+		handle.images = [ MFImage(data=cover_store.get(get_cover_hash(tags)), desc="Cover", type=ImageType.front) ]
 
 	handle.disc = 1
 	handle.disctotal = 1
 	handle.save()
+	if buffer is not None:
+		return move_moov_to_front(buffer.getvalue()) if handle.type in ("aac", "alac") else buffer.getvalue()
+	return None
 
 # cover shenanigans
 
-@functools.lru_cache
 def get_cover(url):
-	return req.get(url).content
+	return cover_store.get(cover_store.put_url(url))
+
+def get_cover_hash(tags: Tags):
+	"""hash of the cover in cover_store: cover_hash if set, otherwise cover_url is fetched"""
+	return tags.get("cover_hash") or cover_store.put_url(tags["cover_url"])
 
 def get_cover_local(file_path: Path, id_or_url: str, is_soundcloud: bool):
 	"""
@@ -84,95 +100,42 @@ def get_cover_local(file_path: Path, id_or_url: str, is_soundcloud: bool):
 				return fp.read_bytes()
 	return None
 
-def get_dominant_color(pil_img: Image.Image) -> tuple[int, int, int, int]:
-	img = pil_img.copy().convert("RGBA")
-	img = img.resize((1, 1), resample=Image.Resampling.NEAREST)
-	
-	pixel = img.getpixel((0, 0))
+def get_1x1_cover(url: str, temp_location: Path, uniqueid: str, cover_format = "JPEG", cover_crop_method = "auto"):
+	return square_cover(get_cover(url), cover_format, cover_crop_method)
 
-	# Explicitly ensure the return type is always Tuple[int, int, int, int]
-	if isinstance(pixel, tuple) and len(pixel) == 4:
-		return pixel
-	else:
-		return (0,0,0,255)
-
-def sample_image_corners(rgb_image, width, height, border_offset = 50):
-	sample_colors = []
-	regions = [
-		(border_offset, border_offset), # topleft
-		(width - border_offset, border_offset), #topright
-		(border_offset, height - border_offset),   #botleft
-		(width - border_offset, height - border_offset), #botright
-		# (border_slice_center, height//2), #left center
-		# (width//2 + height//2 + border_slice_center, height//2) #right center
-	]
-	for sx, sy in regions:
-		r, g, b = rgb_image.getpixel((sx, sy))
-		sample_colors.append((r, g, b))
-	return sample_colors
-
-def determine_image_crop(image_bytes: bytes):
+class CoverProcessor:
 	"""
-	samples 4 pixels near the corners and 2 from centers of side slices of the thumbnail (which is first smoothed and reduced to 64 colors)
-
-	returns 'crop' if average of standard deviation of r, g and b color channels 
-	from each sample point is lower than a than a threshold, otherwise returns 'pad'
+	squares covers (square_cover) in a pool of processes, so decoding/padding/encoding big thumbnails
+	runs on all cores and doesn't hold up the threads doing network work.
+	submit() returns a Future of the squared cover's hash in cover_store. identical thumbnails are only squared once
 	"""
-	pil_img = Image.open(BytesIO(image_bytes))
-	filt_image = pil_img.filter(ImageFilter.SMOOTH).convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
-	rgb_filt_image = filt_image.convert("RGB")
-	
-	width, height = rgb_filt_image.size
-	sample_colors50 = sample_image_corners(rgb_filt_image, width, height, 50)
-	sample_colors0 = sample_image_corners(rgb_filt_image, width, height, 1)
-
-	reds, greens, blues = [], [], []
-	for r,g,b in sample_colors50:
-		reds.append(r)
-		greens.append(g)
-		blues.append(b)
-
-	dev_red = stdev(reds)
-	dev_green = stdev(greens)
-	dev_blue = stdev(blues)
-	avg_dev = mean([dev_red, dev_green, dev_blue])
-
-	# if 4 true corners are 100% equal, fill with that.
-	# TODO later, crop the borders off of a black-bordered thumbnail for real cropping
-	fill_recc = sample_colors0[0] if len(set(sample_colors0)) == 1 else None
-	# print("average:", avg_dev, "colors:", dev_red, dev_green, dev_blue)
-
-	if avg_dev < AVG_THRESHOLD and dev_red < CHANNEL_THRESHOLD and dev_green < CHANNEL_THRESHOLD and dev_blue < CHANNEL_THRESHOLD:
-		return "crop", fill_recc
-	else:
-		return "pad", fill_recc
-
-def get_1x1_cover(url: str, temp_location: Path, uniqueid: str, cover_format = "JPEG", cover_crop_method = "auto"):
-	image_bytes = req.get(url).content
-	pil_img = Image.open(BytesIO(image_bytes))
-
-	width, height = pil_img.size
-	aspect_ratio = width / height
-
-	if aspect_ratio == 1:
-		return image_bytes
-
-	width, height = pil_img.size
-	recc_fill_color = None
-
-	if cover_crop_method == "auto":
-		cover_crop_method, recc_fill_color = determine_image_crop(image_bytes)
-	
-	if cover_crop_method == "crop":
-		img_half = round(width / 2)
-		rect_half = round(height / 2)
-		pil_img = pil_img.crop((img_half - rect_half, 0, img_half + rect_half, height))
-	else:
-		dominant_color = get_dominant_color(pil_img) if recc_fill_color is None else recc_fill_color
-		pil_img = ImageOps.pad(pil_img, (width, width), color=dominant_color, centering=(0.5, 0.5))
-
-	output_bytes = BytesIO()
-	pil_img.save(output_bytes, format=cover_format)
-	output_bytes.seek(0)
-
-	return output_bytes.read()
+	def __init__(self, workers: int | None = None, store: CoverStore = cover_store):
+		self.store = store
+		# spawn: forking a process that runs threads isn't safe. processes are only started once a cover is submitted
+		self._pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+		self._squared: dict[tuple[str, str, str], Future] = {}
+		self._lock = threading.Lock()
+
+	def submit(self, image_bytes: bytes, cover_format = "JPEG", cover_crop_method = "auto") -> Future:
+		key = (hashlib.sha1(image_bytes).hexdigest(), cover_format, cover_crop_method)
+		with self._lock:
+			fut = self._squared.get(key)
+			if fut is not None:
+				return fut
+			fut = self._squared[key] = Future()
+		squaring = self._pool.submit(square_cover, image_bytes, cover_format, cover_crop_method)
+		squaring.add_done_callback(lambda squaring: self._store(fut, squaring))
+		return fut
+
+	def submit_url(self, url: str, cover_format = "JPEG", cover_crop_method = "auto"):
+		"""fetches the thumbnail (through the store, so it's only downloaded once) in the calling thread, squares it in the pool"""
+		return self.submit(self.store.get(self.store.put_url(url)), cover_format, cover_crop_method)
+
+	def _store(self, fut: Future, squaring: Future):
+		try:
+			fut.set_result(self.store.put(squaring.result()))
+		except Exception as e:
+			fut.set_exception(e)
+
+	def shutdown(self):
+		self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,137 @@
+from io import BytesIO
+from unittest import mock
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+from shiradl import musicbrainz
+from shiradl.covers import CoverStore
+from shiradl.musicbrainz import MBMatchCache, MBSong, musicbrainz_enrich_tags
+from shiradl.session import ShiraSession
+
+
+class FakeAdapter(HTTPAdapter):
+	"""answers every request with 1000 bytes, images for .jpg urls"""
+	def __init__(self):
+		super().__init__()
+		self.sent = 0
+
+	def send(self, request, **kwargs):
+		self.sent += 1
+		content_type = "image/jpeg" if request.url.endswith(".jpg") else "application/json"
+		raw = HTTPResponse(BytesIO(b"x" * 1000), { "Content-Type": content_type }, 200, preload_content=False, request_url=request.url)
+		return self.build_response(request, raw)
+
+
+def create_session(tmp_path):
+	session = ShiraSession(tmp_path / "cache", wal=True)
+	session.configure({ "musicbrainz": 3600 })
+	adapter = FakeAdapter()
+	session.mount("https://", adapter)
+	return session, adapter
+
+
+def test_images_kept_out_of_cache(tmp_path):
+	session, adapter = create_session(tmp_path)
+	for _ in range(2):
+		session.get("https://i.ytimg.com/vi/x/maxresdefault.jpg")
+		session.head("https://i.ytimg.com/vi/x/sddefault.jpg")
+	assert adapter.sent == 3 # the image twice, the probe once
+	session.configure({ "musicbrainz": 3600 }, images_in_sqlite=True)
+	session.get("https://i.ytimg.com/vi/x/maxresdefault.jpg")
+	assert session.get("https://i.ytimg.com/vi/x/maxresdefault.jpg").from_cache
+
+
+def test_prune_evicts_least_recently_used(tmp_path):
+	session, adapter = create_session(tmp_path)
+	urls = [f"https://musicbrainz.org/ws/2/recording?query={q}" for q in "abc"]
+	for url in urls:
+		session.get(url)
+	assert session.get(urls[0]).from_cache # a is now used more recently than b
+	body_size = session.stats()["groups"]["musicbrainz"]["bytes"] // 3
+	assert session.prune(body_size * 2) == (1, body_size)
+	assert adapter.sent == 3
+	assert session.get(urls[0]).from_cache and session.get(urls[2]).from_cache
+	assert not session.get(urls[1]).from_cache
+
+
+def test_prune_without_evictions_leaves_database_alone(tmp_path):
+	session, _ = create_session(tmp_path)
+	session.get("https://musicbrainz.org/ws/2/recording?query=a")
+	session.prune(10 * 1024 ** 2)
+	db_path = session.cache.responses.db_path
+	mtime = db_path.stat().st_mtime_ns
+	with mock.patch.object(session.cache.responses, "vacuum", wraps=session.cache.responses.vacuum) as vacuum:
+		assert session.prune(10 * 1024 ** 2) == (0, 0) # what every run does at the end
+		assert db_path.stat().st_mtime_ns == mtime
+		assert session.prune(1)[0] == 1
+		vacuum.assert_not_called() # a few freed bytes aren't worth rewriting the database for
+		session.get("https://musicbrainz.org/ws/2/recording?query=b")
+		assert session.prune(1, vacuum=True)[0] == 1 # 'shiradl cache prune'
+		vacuum.assert_called_once()
+
+
+def test_cover_store_remembers_urls(tmp_path):
+	session, adapter = create_session(tmp_path)
+	url = "https://lh3.googleusercontent.com/cover.jpg"
+	digest = CoverStore(tmp_path / "covers", session, False, url_expire_after=lambda url: 3600).put_url(url)
+	store = CoverStore(tmp_path / "covers", session, False, url_expire_after=lambda url: 3600) # a later run
+	assert store.put_url(url) == digest
+	assert adapter.sent == 1
+	assert store.prune(0) == (1, 1000)
+	assert store.stats() == { "path": str(tmp_path / "covers"), "covers": 0, "bytes": 0, "urls": 0 }
+	store.close()
+
+
+def test_cache_size_estimates(tmp_path):
+	"""what a run checks before pruning, without reading every response / cover"""
+	session, _ = create_session(tmp_path)
+	session.get("https://musicbrainz.org/ws/2/recording?query=a")
+	assert session.get_used_size() >= session.stats()["groups"]["musicbrainz"]["bytes"]
+
+	store = CoverStore(tmp_path / "covers", use_cache_dir=False)
+	store.put(b"\1" * 1000)
+	assert store.get_size() is None # never measured, the first run prunes
+	store.prune(10_000)
+	assert store.get_size() == 1000
+	store.put(b"\2" * 500)
+	store.put(b"\2" * 500) # already stored
+	assert store.get_size() == 1500
+	store.close()
+	store = CoverStore(tmp_path / "covers", use_cache_dir=False) # a later run
+	assert store.get_size() == 1500
+	assert store.prune(1000) == (1, 1000)
+	assert store.get_size() == 500
+	store.close()
+
+
+def test_match_cache(tmp_path):
+	match_cache = MBMatchCache(tmp_path / "matches.sqlite", miss_ttl=3600)
+	recording = {
+		"id": "rec", "title": "Song", "first-release-date": "2020",
+		"artist-credit": [{ "name": "Artist", "artist": { "id": "art", "name": "Artist", "sort-name": "Artist" } }],
+		"releases": [{ "id": "rel", "title": "Album", "release-group": { "id": "rg" } }],
+	}
+	fetched = []
+	def fake_fetch_song(self):
+		fetched.append(self.title)
+		self.save_song_dict([recording] if self.title == "song" else [])
+
+	with (
+		mock.patch.object(MBSong, "fetch_song", fake_fetch_song),
+		mock.patch.object(MBSong, "fetch_artist", lambda self: None),
+		mock.patch.object(musicbrainz, "get_mb_client", lambda: None),
+	):
+		for _ in range(2):
+			tags = musicbrainz_enrich_tags({ "title": "song", "artist": "artist", "album": "album" }, skip_encode=True, match_cache=match_cache) # type: ignore
+			assert tags["artist"] == ["Artist"] and tags["album"] == "Album" and tags["date"] == "2020-01-01"
+			assert tags["mb_releasetrackid"] == "rec" and tags["mb_albumartistid"] == "art"
+			miss = MBSong("Other Song", "Artist", "Album")
+			assert miss.lookup(match_cache)["mb_releasetrackid"] is None
+			assert miss.get_mb_tags() == { "title": None, "artist": None, "album": None }
+	assert fetched == ["song", "Other Song"] # the second run got both from the cache
+	assert match_cache.stats()["matches"] == 1 and match_cache.stats()["misses"] == 1
+	match_cache.miss_ttl = 0
+	match_cache.put(MBMatchCache.get_key("a", "b", "c"), miss.get_match()) # misses not kept at all
+	assert match_cache.get(MBMatchCache.get_key("a", "b", "c")) is None
+	match_cache.close()
@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+from shiradl import metadata
+from shiradl.covers import CoverStore
+from shiradl.squaring import determine_image_crop, square_cover
+from shiradl.tagging import CoverProcessor
+
+
+def test_cover_store_memory_is_bounded(tmp_path):
+	store = CoverStore(tmp_path / "covers", use_cache_dir=False, memory_limit=250)
+	covers = [bytes([i]) * 100 for i in range(5)]
+	digests = [store.put(c) for c in covers]
+	assert store.put(covers[0]) == digests[0] # same bytes, same hash
+	assert store._memory_size <= 250
+	assert [store.get(d) for d in digests] == covers # evicted covers are read back from disk
+
+
+def test_cover_store_link(tmp_path):
+	store = CoverStore(tmp_path / "covers", use_cache_dir=False)
+	digest = store.put(b"cover")
+	a, b = tmp_path / "final" / "a" / "Cover.jpg", tmp_path / "final" / "b" / "Cover.jpg"
+	store.link(digest, a)
+	store.link(digest, b)
+	assert a.read_bytes() == b"cover"
+	assert os.stat(a).st_ino == os.stat(b).st_ino
+	assert os.listdir(b.parent) == ["Cover.jpg"]
+
+
+def test_determine_image_crop():
+	art = Image.effect_noise((720, 720), 80).convert("RGB")
+	bars = Image.new("RGB", (1280, 720), (30, 60, 90))
+	bars.paste(art, (280, 0))
+	frame = Image.effect_noise((1280, 720), 80).convert("RGB")
+	frame.paste(Image.new("RGB", (640, 360), (255, 0, 0)), (0, 0))
+	for img, expected in ((bars, "crop"), (frame, "pad")):
+		out = BytesIO()
+		img.save(out, "JPEG")
+		decision, _ = determine_image_crop(out.getvalue())
+		assert decision == expected
+		assert determine_image_crop(out.getvalue())[0] == expected # cached
+
+
+def test_cover_processor(tmp_path):
+	store = CoverStore(tmp_path / "covers", use_cache_dir=False)
+	processor = CoverProcessor(1, store)
+	thumbnail = BytesIO()
+	Image.effect_noise((640, 360), 60).convert("RGB").save(thumbnail, "JPEG")
+	try:
+		fut = processor.submit(thumbnail.getvalue())
+		assert processor.submit(thumbnail.getvalue()) is fut # squared once
+		assert store.get(fut.result(timeout=60)) == square_cover(thumbnail.getvalue())
+	finally:
+		processor.shutdown()
+
+
+def test_cover_processor_workers_skip_the_session():
+	"""the spawned processes only import what square_cover needs, not the http session and its cache database"""
+	check = "import sys, shiradl.squaring; sys.exit('shiradl.session' in sys.modules)"
+	assert subprocess.run([sys.executable, "-c", check], cwd=os.path.dirname(os.path.dirname(__file__))).returncode == 0
+
+
+def test_get_youtube_maxres_thumbnail():
+	base = "https://i.ytimg.com/vi/x/"
+	info = {
+		"thumbnail": base + "default.jpg",
+		"thumbnails": [{ "url": base + name } for name in ("default.jpg", "hqdefault.jpg", "sddefault.webp", "sddefault.jpg", "maxresdefault.jpg")],
+	}
+	assert metadata.get_thumbnail_candidates(info) == [base + n for n in ("maxresdefault.jpg", "sddefault.jpg", "hqdefault.jpg", "default.jpg")]
+	with mock.patch.object(metadata, "ping_thumbnail", lambda url: not url.endswith("maxresdefault.jpg")):
+		assert metadata.get_youtube_maxres_thumbnail(info) == base + "sddefault.jpg"
+	pool = metadata.get_thumbnail_pool()
+	with mock.patch.object(metadata, "ping_thumbnail", lambda url: False):
+		assert metadata.get_youtube_maxres_thumbnail(info) == base + "default.jpg"
+	assert metadata.get_thumbnail_pool() is pool # shared by every track, until Dl.close shuts it down
+	metadata.shutdown_thumbnail_pool()
+	assert metadata.get_thumbnail_pool() is not pool
+	metadata.shutdown_thumbnail_pool()
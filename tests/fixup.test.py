@@ -0,0 +1,163 @@
+import errno
+import os
+import struct
+from unittest import mock
+
+import pytest
+from mediafile import MediaFile
+
+from shiradl.dl import get_codec_name
+from shiradl import fileops
+from shiradl.fileops import STAGING_FOLDER_NAME, copy_file, move_file, sweep_staging_path, write_file
+from shiradl.mp4 import CONTAINER_BOXES, is_faststart_mp4, iter_boxes, move_moov_to_front
+from shiradl.tagging import metadata_applier
+
+
+def box(kind: bytes, payload = b""):
+	return (8 + len(payload)).to_bytes(4, "big") + kind + payload
+
+
+def build_m4a(sample: bytes, offsets_box = b"stco", moov_first = False):
+	"""smallest m4a mutagen reads: one audio track with a single chunk, sample, at the offset in its stco/co64"""
+	ftyp = box(b"ftyp", b"M4A \0\0\0\0M4A isom")
+	mdhd = box(b"mdhd", b"\0" * 12 + struct.pack(">2I", 44100, 44100) + b"\0" * 4)
+	hdlr = box(b"hdlr", b"\0" * 8 + b"soun" + b"\0" * 13)
+	stsd = box(b"stsd", b"\0" * 8) # no sample descriptions
+	def moov(offset: int):
+		offsets = box(offsets_box, b"\0" * 4 + struct.pack(">I", 1) + struct.pack(">I" if offsets_box == b"stco" else ">Q", offset))
+		return box(b"moov", box(b"trak", box(b"mdia", mdhd + hdlr + box(b"minf", box(b"stbl", stsd + offsets)))))
+	mdat = box(b"mdat", sample)
+	if moov_first:
+		return ftyp + moov(len(ftyp) + len(moov(0)) + 8) + mdat
+	return ftyp + mdat + moov(len(ftyp) + 8)
+
+
+def read_chunk_offsets(data: bytes, start = 0, end: int | None = None) -> list[int]:
+	offsets = []
+	for kind, _, payload, box_end in iter_boxes(data, start, end):
+		if kind in CONTAINER_BOXES:
+			offsets += read_chunk_offsets(data, payload, box_end)
+		elif kind in (b"stco", b"co64"):
+			fmt, width = (">I", 4) if kind == b"stco" else (">Q", 8)
+			count = struct.unpack(">I", data[payload + 4:payload + 8])[0]
+			offsets += [struct.unpack(fmt, data[payload + 8 + i * width:payload + 8 + (i + 1) * width])[0] for i in range(count)]
+	return offsets
+
+
+def test_is_faststart_mp4(tmp_path):
+	layouts = {
+		"faststart": ([box(b"ftyp", b"M4A "), box(b"moov", b"\0" * 32), box(b"mdat", b"\1" * 64)], True),
+		"moov_at_end": ([box(b"ftyp", b"M4A "), box(b"mdat", b"\1" * 64), box(b"moov", b"\0" * 32)], False),
+		"fragmented": ([box(b"ftyp", b"dash"), box(b"moov", b"\0" * 32), box(b"moof"), box(b"mdat", b"\1" * 64)], False),
+		"no_moov": ([box(b"ftyp", b"M4A ")], False),
+	}
+	for name, (boxes, expected) in layouts.items():
+		fp = tmp_path / f"{name}.m4a"
+		fp.write_bytes(b"".join(boxes))
+		assert is_faststart_mp4(fp) is expected, name
+
+
+def test_get_codec_name():
+	assert get_codec_name("mp4a.40.2") == "aac"
+	assert get_codec_name("opus") == "opus"
+	assert get_codec_name("mp3") == "mp3"
+	assert get_codec_name("none") is None
+	assert get_codec_name(None) is None
+
+
+def test_move_file_cross_device(tmp_path):
+	"""a move between filesystems copies into a .part file, which is then renamed into place"""
+	src = tmp_path / "temp" / "a.m4a"
+	src.parent.mkdir()
+	src.write_bytes(b"\1" * 100_000)
+	final_location = tmp_path / "final" / "album" / "01 a.m4a"
+	real_replace = os.replace
+
+	def replace(a, b):
+		if not str(a).endswith(".part"):
+			raise OSError(errno.EXDEV, "Invalid cross-device link")
+		real_replace(a, b)
+
+	with mock.patch("shiradl.fileops.os.replace", side_effect=replace):
+		move_file(src, final_location, "full")
+	assert final_location.read_bytes() == b"\1" * 100_000
+	assert not src.exists()
+	assert [p.name for p in final_location.parent.iterdir()] == ["01 a.m4a"]
+
+
+def test_copy_file_without_kernel_copy(tmp_path):
+	"""without copy_file_range and sendfile (windows, macos) the data is copied through userspace"""
+	src = tmp_path / "a.m4a"
+	src.write_bytes(b"\2" * 100_000)
+	for platform in ("win32", "darwin"):
+		with mock.patch.object(fileops.sys, "platform", platform), mock.patch.object(fileops, "os", wraps=os) as fake_os:
+			del fake_os.copy_file_range
+			del fake_os.sendfile
+			copy_file(src, tmp_path / f"{platform}.m4a")
+		assert (tmp_path / f"{platform}.m4a").read_bytes() == b"\2" * 100_000
+
+
+def test_copy_file_errors_are_not_hidden(tmp_path):
+	"""only 'not supported here' falls back to a plain copy, a real error isn't papered over"""
+	src = tmp_path / "a.m4a"
+	src.write_bytes(b"\3" * 1000)
+	with mock.patch.object(fileops, "_kernel_copy", side_effect=OSError(errno.EPERM, "Operation not permitted")), pytest.raises(PermissionError):
+		copy_file(src, tmp_path / "b.m4a")
+	with mock.patch.object(fileops, "_kernel_copy", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+		copy_file(src, tmp_path / "c.m4a")
+	assert (tmp_path / "c.m4a").read_bytes() == b"\3" * 1000
+
+
+def test_sweep_staging_path(tmp_path):
+	staging_path = tmp_path / "library" / STAGING_FOLDER_NAME
+	(staging_path / "killed-abc").mkdir(parents=True)
+	(staging_path / "killed-abc" / "a.m4a").write_bytes(b"\1")
+	(staging_path / "running-def").mkdir()
+	day_ago = os.stat(staging_path).st_mtime - 2 * 24 * 3600
+	os.utime(staging_path / "killed-abc", (day_ago, day_ago))
+	assert sweep_staging_path(staging_path) == 1
+	assert [p.name for p in staging_path.iterdir()] == ["running-def"] # might be another run's
+
+	temp_path = tmp_path / "temp" # picked by the user, never swept
+	(temp_path / "old").mkdir(parents=True)
+	os.utime(temp_path / "old", (day_ago, day_ago))
+	assert sweep_staging_path(temp_path) == 0 and (temp_path / "old").exists()
+
+
+def test_move_moov_to_front():
+	sample = b"\1\2\3\4" * 16
+	for offsets_box in (b"stco", b"co64"):
+		data = build_m4a(sample, offsets_box)
+		[offset] = read_chunk_offsets(data)
+		assert data[offset:offset + len(sample)] == sample
+
+		moved = move_moov_to_front(data)
+		assert len(moved) == len(data)
+		assert [kind for kind, *_ in iter_boxes(moved)] == [b"ftyp", b"moov", b"mdat"]
+		[offset] = read_chunk_offsets(moved)
+		assert moved[offset:offset + len(sample)] == sample, offsets_box
+
+	faststart = build_m4a(sample, moov_first=True)
+	assert move_moov_to_front(faststart) is faststart
+
+
+def test_metadata_applier_in_memory(tmp_path):
+	"""the tagged copy is written once, with moov in front and the chunk offsets still pointing at the audio"""
+	sample = b"\5\6\7\10" * 16
+	fixed_location = tmp_path / "temp" / "a.m4a"
+	fixed_location.parent.mkdir()
+	fixed_location.write_bytes(build_m4a(sample))
+	final_location = tmp_path / "final" / "01 Lemon.m4a"
+
+	data = metadata_applier({ "title": "Lemon", "artist": "米津玄師", "album": "Lemon", "track": 1 }, fixed_location, ["cover"], in_memory=True) # type: ignore
+	assert data is not None
+	assert fixed_location.read_bytes() == build_m4a(sample) # left untouched
+	write_file(data, final_location)
+
+	assert is_faststart_mp4(final_location)
+	written = final_location.read_bytes()
+	[offset] = read_chunk_offsets(written)
+	assert written[offset:offset + len(sample)] == sample
+	handle = MediaFile(final_location)
+	assert (handle.title, handle.artist, handle.album, handle.track, handle.disc) == ("Lemon", "米津玄師", "Lemon", 1, 1)
+	assert [p.name for p in final_location.parent.iterdir()] == ["01 Lemon.m4a"]
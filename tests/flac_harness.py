@@ -0,0 +1,16 @@
+"""flac files for tests and benchmarks (benchmarks.e2e) without any audio tools, kept apart from test_harness so importing it is cheap"""
+import struct
+from pathlib import Path
+
+from mediafile import MediaFile
+
+
+def write_flac(path: Path, **tags):
+	"""smallest flac mediafile reads: a STREAMINFO block (44.1kHz, 2 channels, 16 bit) and no audio"""
+	streaminfo = struct.pack(">HH", 4096, 4096) + b"\0" * 6 + ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, "big") + b"\0" * 16
+	path.parent.mkdir(parents=True, exist_ok=True)
+	path.write_bytes(b"fLaC" + bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo)
+	handle = MediaFile(path)
+	for k, v in tags.items():
+		setattr(handle, k, v)
+	handle.save()
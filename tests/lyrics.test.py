@@ -0,0 +1,56 @@
+import threading
+import time
+
+from shiradl.lyrics import LyricsCache, LyricsFetcher
+
+
+class FakeYTMusic:
+	def __init__(self):
+		self.calls: list[str] = []
+		self.lock = threading.Lock()
+
+	def get_watch_playlist(self, video_id: str):
+		with self.lock:
+			self.calls.append(f"watch:{video_id}")
+		return { "lyrics": None if video_id == "nolyrics" else f"MPLY_{video_id}" }
+
+	def get_lyrics(self, browse_id: str):
+		time.sleep(0.01)
+		with self.lock:
+			self.calls.append(f"lyrics:{browse_id}")
+		return None if browse_id == "MPLY_empty" else { "lyrics": f"lyrics of {browse_id}" }
+
+
+def test_lyrics_fetched_once_and_cached(tmp_path):
+	ytm = FakeYTMusic()
+	fetcher = LyricsFetcher(ytm, LyricsCache(tmp_path / "lyrics.sqlite", use_cache_dir=False), workers=4) # type: ignore
+	futures = [fetcher.submit(browse_id="MPLY_a") for _ in range(8)] + [fetcher.submit(browse_id="MPLY_empty")]
+	results = [f.result() for f in futures]
+	fetcher.shutdown()
+
+	assert results == ["lyrics of MPLY_a"] * 8 + [None]
+	assert sorted(ytm.calls) == ["lyrics:MPLY_a", "lyrics:MPLY_empty"]
+
+	# second run: everything comes from the persistent cache, including the negative result
+	ytm.calls.clear()
+	fetcher = LyricsFetcher(ytm, LyricsCache(tmp_path / "lyrics.sqlite", use_cache_dir=False)) # type: ignore
+	assert fetcher.submit(browse_id="MPLY_a").result() == "lyrics of MPLY_a"
+	assert fetcher.submit(browse_id="MPLY_empty").result() is None
+	fetcher.shutdown()
+	assert ytm.calls == []
+
+
+def test_lyrics_by_video_id(tmp_path):
+	ytm = FakeYTMusic()
+	cache_path = tmp_path / "lyrics.sqlite"
+	fetcher = LyricsFetcher(ytm, LyricsCache(cache_path, use_cache_dir=False)) # type: ignore
+	assert fetcher.submit(video_id="abc").result() == "lyrics of MPLY_abc"
+	assert fetcher.submit(video_id="nolyrics").result() is None
+	fetcher.shutdown()
+
+	ytm.calls.clear()
+	fetcher = LyricsFetcher(ytm, LyricsCache(cache_path, use_cache_dir=False)) # type: ignore
+	assert fetcher.submit(video_id="abc").result() == "lyrics of MPLY_abc"
+	assert fetcher.submit(video_id="nolyrics").result() is None
+	fetcher.shutdown()
+	assert ytm.calls == []
@@ -0,0 +1,51 @@
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from shiradl import musicbrainz
+from shiradl.mbdump import MBDumpIndex, import_dump
+from shiradl.musicbrainz import MBSong, musicbrainz_enrich_tags
+
+FIXTURES = Path(__file__).parent / "fixtures" / "mbdump"
+
+
+@pytest.fixture(params=["json", "tsv"])
+def dump_index(request, tmp_path):
+	dump = FIXTURES / "release" if request.param == "json" else FIXTURES / "tsv"
+	import_dump(dump, tmp_path / "dump.sqlite", request.param)
+	index = MBDumpIndex(tmp_path / "dump.sqlite", use_cache_dir=False)
+	yield index
+	index.close()
+
+
+def no_requests():
+	raise AssertionError("the MusicBrainz api shouldn't be used with a dump index")
+
+
+def test_both_formats_index_the_same(tmp_path):
+	results = []
+	for dump_format, dump in (("json", FIXTURES / "release"), ("tsv", FIXTURES / "tsv")):
+		counts = import_dump(dump, tmp_path / f"{dump_format}.sqlite", dump_format)
+		index = MBDumpIndex(tmp_path / f"{dump_format}.sqlite", use_cache_dir=False)
+		results.append((counts, index.search_recordings("look at the sky", "porter robinson", "nurture"), index.search_artists("yoasobi")))
+		index.close()
+	assert results[0] == results[1]
+	assert results[0][0]["recordings"] == 6
+
+
+def test_dump_index_match(dump_index: MBDumpIndex):
+	with mock.patch.object(musicbrainz, "get_mb_client", no_requests):
+		tags = musicbrainz_enrich_tags({ "title": "Lemon", "artist": "米津玄師", "album": "Lemon" }, skip_encode=True, dump_index=dump_index) # type: ignore
+		assert tags["artist"] == ["米津玄師"] and tags["album"] == "Lemon" and tags["date"] == "2018-02-27" # the first release of the recording
+		assert tags["mb_releasetrackid"].startswith("e89498ba")
+
+		# every word of the title and artist has to be there
+		assert [r["id"][:8] for r in dump_index.search_recordings("lemon", "n.e.r.d", "")] == ["6493ea27"]
+		assert dump_index.search_recordings("lemon", "madeon", "") == []
+
+		# no recording: only the artist is looked up
+		miss = MBSong("Unreleased Song", "Porter Robinson", "", dump_index=dump_index)
+		miss.fetch_song()
+		assert miss.get_match()["mb_releasetrackid"] is None
+		assert miss.get_mbid_tags()["mb_artistid"].startswith("d07c898e") # type: ignore
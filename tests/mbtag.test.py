@@ -0,0 +1,157 @@
+import json
+import threading
+from collections import Counter
+from pathlib import Path
+from unittest import mock
+
+from flac_harness import write_flac
+from mediafile import MediaFile
+
+from shiradl import mbtag, musicbrainz
+from shiradl.manifest import PARTIAL, PENDING, ScanManifest
+from shiradl.mbdump import MBDumpIndex, import_dump
+from shiradl.mbtag import process_directory, scan_library
+from shiradl.musicbrainz import MBMatchCache
+
+FIXTURES = Path(__file__).parent / "fixtures" / "mbdump"
+
+
+def create_library(library: Path):
+	write_flac(library / "Kenshi Yonezu" / "Lemon" / "01 Lemon.flac", title="Lemon", artist="米津玄師", album="Lemon")
+	write_flac(library / "Porter Robinson" / "Nurture" / "01.flac", title="Look at the Sky", artist="Porter Robinson", album="Nurture")
+	write_flac(library / "Porter Robinson" / "done.flac", title="Musician", artist="Porter Robinson", album="Nurture", **dict.fromkeys(mbtag.MBID_TAG_KEYS, "x"))
+	(library / "Porter Robinson" / "Nurture" / "cover.jpg").write_bytes(b"not opened")
+	(library / "Porter Robinson" / "notes.xyz").write_bytes(b"opened, not a song")
+
+
+def run_mbtag(tmp_path: Path, library: Path, **kwargs):
+	""":returns how many times each file was opened"""
+	if not (tmp_path / "dump.sqlite").exists():
+		import_dump(FIXTURES / "release", tmp_path / "dump.sqlite", "json")
+	dump_index = MBDumpIndex(tmp_path / "dump.sqlite", use_cache_dir=False)
+	opened = Counter()
+	real_mediafile = mbtag.MediaFile
+	def counting_mediafile(path, *args, **kwargs):
+		opened[Path(path).name] += 1
+		return real_mediafile(path, *args, **kwargs)
+
+	with mock.patch.object(mbtag, "MediaFile", counting_mediafile), mock.patch.object(musicbrainz, "get_mb_client", lambda: None):
+		process_directory(library, False, False, False, False, dump_index=dump_index, **kwargs) # type: ignore
+	dump_index.close()
+	return opened
+
+
+def test_mbtag_library(tmp_path):
+	library = tmp_path / "library"
+	create_library(library)
+	scanned = [Path(p).relative_to(library).as_posix() for p in scan_library(str(library))]
+	assert scanned == ["Kenshi Yonezu/Lemon/01 Lemon.flac", "Porter Robinson/done.flac", "Porter Robinson/notes.xyz", "Porter Robinson/Nurture/01.flac"] # files before subfolders, like os.walk
+
+	opened = run_mbtag(tmp_path, library, jobs=3)
+	assert opened == { "01 Lemon.flac": 1, "01.flac": 1, "done.flac": 1, "notes.xyz": 1 } # every file parsed once, cover.jpg never
+	assert MediaFile(library / "Kenshi Yonezu" / "Lemon" / "01 Lemon.flac").mb_releasetrackid.startswith("e89498ba")
+	assert MediaFile(library / "Porter Robinson" / "Nurture" / "01.flac").mb_releasetrackid.startswith("b5d25f2b")
+	assert MediaFile(library / "Porter Robinson" / "done.flac").mb_releasetrackid == "x" # complete, skipped
+
+
+def test_mbtag_folder_spread_over_workers(tmp_path):
+	library = tmp_path / "library"
+	for i in range(3):
+		write_flac(library / f"{i:02d}.flac", title=f"Song {i}", artist="Porter Robinson", album=f"Single {i}")
+	together = threading.Barrier(3, timeout=5) # only passed if the 3 songs of the folder are looked up at once
+	threads = set()
+	real_lookup_song = mbtag.lookup_song
+	def lookup_song(*args, **kwargs):
+		threads.add(threading.current_thread().name)
+		together.wait()
+		return real_lookup_song(*args, **kwargs)
+
+	with mock.patch.object(mbtag, "lookup_song", lookup_song):
+		run_mbtag(tmp_path, library, jobs=3)
+	assert len(threads) == 3 and not together.broken
+
+
+def test_mbtag_rematch_clears_old_ids(tmp_path):
+	path = tmp_path / "01.flac"
+	write_flac(path, title="Lemon", artist="米津玄師", **dict.fromkeys(mbtag.MBID_TAG_KEYS, "old"))
+	mb = mock.Mock(get_mb_tags=lambda: None, get_mbid_tags=lambda: { "mb_releasetrackid": "new", "mb_releasegroupid": "", "mb_artistid": "new", "mb_albumartistid": None })
+	assert mbtag.write_song(MediaFile(path), mb, True, str(path))[0] == PENDING # the lookup failed, what the file had is kept
+	assert mbtag.read_mbid_tags(MediaFile(path)) == { "mb_releasetrackid": "new", "mb_releasegroupid": "old", "mb_artistid": "new", "mb_albumartistid": "old" }
+
+	assert mbtag.write_song(MediaFile(path), mb, False, str(path))[0] == PARTIAL
+	assert mbtag.read_mbid_tags(MediaFile(path)) == { "mb_releasetrackid": "new", "mb_releasegroupid": None, "mb_artistid": "new", "mb_albumartistid": None } # no "" either
+
+
+def test_mbtag_unchanged_ids_not_saved(tmp_path):
+	path = tmp_path / "01.flac"
+	write_flac(path, title="Lemon", artist="米津玄師", mb_releasetrackid="same")
+	mtime = path.stat().st_mtime_ns
+	nothing = mock.Mock(get_mb_tags=lambda: None, get_mbid_tags=lambda: dict.fromkeys(mbtag.MBID_TAG_KEYS))
+	same = mock.Mock(get_mb_tags=lambda: None, get_mbid_tags=lambda: { **dict.fromkeys(mbtag.MBID_TAG_KEYS), "mb_releasetrackid": "same" })
+	for mb, failed in ((nothing, True), (nothing, False), (same, False)):
+		handle = MediaFile(path)
+		with mock.patch.object(handle, "save") as save:
+			mbtag.write_song(handle, mb, failed, str(path))
+		save.assert_not_called()
+	assert path.stat().st_mtime_ns == mtime
+
+
+def test_mbtag_manifest(tmp_path):
+	library = tmp_path / "library"
+	create_library(library)
+	manifest = ScanManifest(tmp_path / "manifest.sqlite", use_cache_dir=False)
+	assert sum(run_mbtag(tmp_path, library, manifest=manifest).values()) == 4
+	assert run_mbtag(tmp_path, library, manifest=manifest) == {} # nothing changed, even the written files
+
+	write_flac(library / "Porter Robinson" / "Nurture" / "01.flac", title="Look at the Sky", artist="Porter Robinson", album="Nurture") # ids gone
+	(library / "Porter Robinson" / "notes.xyz").unlink()
+	assert run_mbtag(tmp_path, library, manifest=manifest) == { "01.flac": 1 }
+	assert MediaFile(library / "Porter Robinson" / "Nurture" / "01.flac").mb_releasetrackid.startswith("b5d25f2b")
+	assert "Porter Robinson/notes.xyz" not in manifest.load(str(library))
+
+	(library / "Porter Robinson" / "done.flac").unlink()
+	assert sum(run_mbtag(tmp_path, library, manifest=manifest, rescan=True).values()) == 2
+	assert sorted(manifest.load(str(library))) == ["Kenshi Yonezu/Lemon/01 Lemon.flac", "Porter Robinson/Nurture/01.flac"] # done.flac forgotten
+	manifest.close()
+
+
+class FakeClient:
+	"""MBClient answering release searches / lookups for Porter Robinson's Nurture, nothing for anything else"""
+	credit = [{ "name": "Porter Robinson", "joinphrase": "", "artist": { "id": "porter", "name": "Porter Robinson", "sort-name": "Robinson, Porter" } }]
+	release = { "id": "nurture", "title": "Nurture", "date": "2021-04-23", "artist-credit": credit, "release-group": { "id": "nurture-rg", "title": "Nurture" } }
+	tracks = [
+		{ "id": "t1", "position": 1, "title": "Look at the Sky", "recording": { "id": "look-at-the-sky", "title": "Look at the Sky", "first-release-date": "2021-01-28" } },
+		{ "id": "t2", "position": 2, "title": "Musician", "artist-credit": credit, "recording": { "id": "musician", "title": "Musician" } },
+	]
+
+	def __init__(self):
+		self.requests = []
+
+	def get(self, endpoint: str, params: dict, expire_after=None):
+		self.requests.append(endpoint)
+		if endpoint == "release":
+			body = { "releases": [{ **self.release, "id": "deluxe", "title": "Nurture (Deluxe)" }, { **self.release, "track-count": 14 }] }
+		elif endpoint == "release/nurture":
+			body = { **self.release, "media": [{ "position": 1, "tracks": self.tracks }] }
+		else:
+			body = { "recordings": [], "artists": [] }
+		return mock.Mock(status_code=200, text=json.dumps(body), url=endpoint)
+
+
+def test_mbtag_album_lookup(tmp_path):
+	library = tmp_path / "library"
+	write_flac(library / "Nurture" / "01.flac", title="Look at the Sky", artist="Porter Robinson", album="Nurture", track=1)
+	write_flac(library / "Nurture" / "02.flac", title="musician", artist="Porter Robinson", album="Nurture", track=5) # wrong track number, found by title
+	write_flac(library / "Nurture" / "03.flac", title="Bonus", artist="Porter Robinson", album="Nurture", track=3) # not on the release
+	client = FakeClient()
+	match_cache = MBMatchCache(tmp_path / "matches.sqlite")
+	for _ in range(2):
+		with mock.patch.object(musicbrainz, "get_mb_client", lambda: client):
+			process_directory(library, False, False, False, False, match_cache=match_cache, rescan=True) # type: ignore
+	assert client.requests == ["release", "release/nurture", "recording", "artist"] # the second run got everything from the match cache
+	match_cache.close()
+
+	sky = MediaFile(library / "Nurture" / "01.flac")
+	assert (sky.mb_releasetrackid, sky.mb_releasegroupid, sky.mb_artistid) == ("look-at-the-sky", "nurture-rg", "porter")
+	assert MediaFile(library / "Nurture" / "02.flac").mb_releasetrackid == "musician"
+	assert MediaFile(library / "Nurture" / "03.flac").mb_releasetrackid is None
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from shiradl.pipeline import Pipeline, Stage
+
+
+def test_pipeline_counts_failures_and_skips():
+	done = []
+
+	def fail_odd(n: int):
+		if n % 2:
+			raise Exception(f"odd {n}")
+		return n
+
+	pipeline = Pipeline(
+		[Stage("skip", lambda n: None if n == 4 else n, 2), Stage("fail", fail_odd, 3), Stage("last", lambda n: n)],
+		on_done=lambda n, failed: done.append((n, failed)),
+	)
+	failed = pipeline.run(range(10))
+
+	assert sorted(failed) == [1, 3, 5, 7, 9]
+	assert sorted(done) == [(n, n % 2 == 1) for n in range(10)]
+
+
+def test_pipeline_backpressure():
+	"""a slow last stage must block the stages in front of it instead of letting jobs pile up"""
+	in_flight = 0
+	peak = 0
+	lock = threading.Lock()
+
+	def produce(n: int):
+		nonlocal in_flight, peak
+		with lock:
+			in_flight += 1
+			peak = max(peak, in_flight)
+		return n
+
+	def consume(n: int):
+		nonlocal in_flight
+		time.sleep(0.005)
+		with lock:
+			in_flight -= 1
+		return n
+
+	pipeline = Pipeline([Stage("produce", produce, 4), Stage("middle", lambda n: n, 1), Stage("consume", consume, 1)])
+	assert pipeline.run(range(50)) == []
+	assert peak <= pipeline.max_in_flight(0)
@@ -0,0 +1,31 @@
+import threading
+import time
+
+from shiradl.ratelimit import TokenBucket
+
+
+def test_token_bucket_shared_state(tmp_path):
+	"""two buckets on the same state file (like two processes) share the rate"""
+	buckets = [TokenBucket(20, 1, tmp_path / "state"), TokenBucket(20, 1, tmp_path / "state")]
+	taken: list[float] = []
+
+	def take(bucket: TokenBucket):
+		for _ in range(5):
+			bucket.acquire()
+			taken.append(time.monotonic())
+
+	threads = [threading.Thread(target=take, args=(b,)) for b in buckets]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	taken.sort()
+	assert taken[-1] - taken[0] >= 9 / 20 * 0.9 # 10 tokens, the first one is free
+
+
+def test_token_bucket_in_memory():
+	bucket = TokenBucket(50, 1)
+	start = time.monotonic()
+	for _ in range(6):
+		bucket.acquire()
+	assert time.monotonic() - start >= 5 / 50 * 0.9
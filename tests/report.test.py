@@ -0,0 +1,34 @@
+import json
+import sys
+
+import pytest
+
+from shiradl.report import Recorder, get_percentile, summarize
+
+
+def test_summarize():
+	assert get_percentile([], 50) == 0.0
+	assert summarize([float(i) for i in range(100, 0, -1)]) == { "count": 100, "total": 5050.0, "p50": 50.0, "p95": 95.0, "max": 100.0 }
+
+
+def test_recorder_report(tmp_path):
+	recorder = Recorder()
+	download = recorder.timed("download", lambda job: job, lambda job: job["id"])
+	assert download({ "id": "a" }) == { "id": "a" }
+	with pytest.raises(ValueError), recorder.span("tag", "b"):
+		raise ValueError()
+	recorder.add_request("https://musicbrainz.org/ws/2/recording?query=x", False, "1000")
+	recorder.add_request("https://musicbrainz.org/ws/2/recording?query=x", True, "1000")
+	recorder.add_download(5000)
+	recorder.run_subprocess([sys.executable, "-c", "pass"], check=True)
+
+	recorder.write(tmp_path / "run.json", tracks=2)
+	report = json.loads((tmp_path / "run.json").read_text(encoding="utf8"))
+	assert report["tracks"] == 2 and report["downloaded_bytes"] == 5000
+	assert set(report["stages"]) == { "download", "tag" } and report["stages"]["download"]["count"] == 1
+	assert [(s["name"], s["track"], s["failed"]) for s in report["spans"]] == [("download", "a", False), ("tag", "b", True)]
+	assert report["http"] == { "musicbrainz.org": { "requests": 2, "cache_hits": 1, "cache_misses": 1, "bytes": 1000 } }
+	assert report["subprocesses"][next(iter(report["subprocesses"]))]["count"] == 1
+
+	recorder.reset()
+	assert recorder.report()["spans"] == [] and recorder.report()["http"] == {}